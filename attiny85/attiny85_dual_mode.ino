@@ -18,6 +18,36 @@
 
 #define IFACE_THRSHOLD (5000)
 
+// I2C register map, multi byte registers are big endian. Writing a
+// register address, optionally followed by a length, selects a block that
+// the next read returns in one transaction. The block is a snapshot taken
+// when the address is written and reads wrap at the end of the map. Once
+// the block is served, or when no address was written, reads return the
+// legacy muxed word. Combined write/read transactions need a TinyWireS
+// that runs the receive callback before a request (repeated start).
+#define REG_WORD      0x00  // u16 pin state in the MSB, 10bit ADC
+#define REG_ADC       0x02  // u16 10bit ADC
+#define REG_PIN       0x04  // u8  pin state
+#define REG_SAMPLES   0x05  // u32 samples taken since power up
+#define REG_TIMESTAMP 0x09  // u32 micros() of the latest sample
+#define REG_ADC_OVS   0x0D  // u16 12bit ADC, oversampled over 16 samples
+#define REG_VERSION   0x0F  // u8  register map version
+#define REG_SIZE      0x10
+#define REG_MAP_VERSION 1
+
+// Oversampling gains OVS_BITS of resolution from 4 ^ OVS_BITS samples
+#define OVS_BITS      2
+#define OVS_SAMPLES   (1 << (2 * OVS_BITS))
+
+// Binary framed UART protocol
+// Request: BIN_CMD, sequence number of the first frame, number of frames
+// Reply: burst of frames of BIN_SYNC, sequence, muxed word msb, lsb, xor
+#define BIN_CMD       0xA5
+#define BIN_SYNC      0x5A
+#define BIN_MAX_BURST 32
+#define BIN_FRAME_LEN 5
+#define BIN_TIMEOUT   20
+
 const uint8_t analogInPin  = A3;
 const uint8_t digitalInPin = A2;
 boolean       firstByte    = true;
@@ -30,11 +60,27 @@ unsigned long startMillis  = 0;
 // Operation mode 0= Serial, 1 = I2C
 uint8_t       mode         = 0;
 
-// Variable that will be used in the future when user has register select commands
+// Register index of the legacy word
 uint8_t       reg_idx      = 1;
 
 // Readings buffer
 uint16_t      readings[2];
+
+// Live register map, updated by the i2c loop with interrupts off, and the
+// snapshot served to the master
+uint8_t       regs[REG_SIZE];
+uint8_t       reg_snap[REG_SIZE];
+uint8_t       reg_ptr      = 0;
+// Bytes of the selected block left to serve, 0 in legacy mode
+uint8_t       reg_left     = 0;
+
+uint32_t      samples      = 0;
+uint16_t      ovs_sum      = 0;
+uint8_t       ovs_count    = 0;
+uint16_t      ovs_value    = 0;
+
+// Binary reply frame
+uint8_t       frame[BIN_FRAME_LEN];
 SoftwareSerial tinySerial(RXPIN, TXPIN);
 
 void setup()
@@ -48,6 +94,8 @@ void i2c_setup()
 {
     TinyWireS.begin(I2C_SLAVE_ADDRESS); // join i2c network
     TinyWireS.onRequest(requestEvent);
+    TinyWireS.onReceive(receiveEvent);
+    regs[REG_VERSION] = REG_MAP_VERSION;
 }
 
 /* Enable Serial */
@@ -63,6 +111,48 @@ void serial_end()
     tinySerial.end();
 }
 
+/* Wait for the next byte of a command, returns -1 on timeout */
+int serial_read_timeout()
+{
+    unsigned long start = millis();
+    while (tinySerial.available() <= 0)
+    {
+      if (millis() - start > BIN_TIMEOUT) return -1;
+    }
+    return tinySerial.read();
+}
+
+/* Sample and send a burst of binary frames. The word is muxed the same way
+   as in i2c mode, the MSB is the pin state and the ADC is 10 bit */
+void send_frames(uint8_t seq, uint8_t count)
+{
+    for (uint8_t i = 0; i < count; i++)
+    {
+      uint16_t adc = analogRead(analogInPin);
+      uint8_t hbyte = (uint8_t) ((adc >> 8) & 0x03);
+      if (digitalRead(digitalInPin)) hbyte |= 0x80;
+
+      frame[0] = BIN_SYNC;
+      frame[1] = seq + i;
+      frame[2] = hbyte;
+      frame[3] = (uint8_t) (adc & 0xff);
+      frame[4] = frame[1] ^ frame[2] ^ frame[3];
+      tinySerial.write(frame, BIN_FRAME_LEN);
+    }
+}
+
+/* Handle a binary request after its command byte has been received */
+void serial_binary()
+{
+    int seq = serial_read_timeout();
+    if (seq < 0) return;
+    int count = serial_read_timeout();
+    if (count < 0) return;
+
+    if (count > BIN_MAX_BURST) count = BIN_MAX_BURST;
+    send_frames((uint8_t) seq, (uint8_t) count);
+}
+
 /* Main loop for UART mode */
 void serial_loop()
 {
@@ -74,6 +164,13 @@ void serial_loop()
       // get incoming byte:
       ser_byte = tinySerial.read();
 
+      // Binary requests are answered without the ASCII safety delay
+      if (ser_byte == BIN_CMD)
+      {
+        serial_binary();
+        return;
+      }
+
       //Safety delay
       delay(2);
       if (ser_byte >= 49 && ser_byte <= 50)
@@ -86,15 +183,51 @@ void serial_loop()
     }
 }
 
+/* Store a big endian value in the register map */
+void reg_put16(uint8_t addr, uint16_t value)
+{
+    regs[addr] = (uint8_t) (value >> 8);
+    regs[addr + 1] = (uint8_t) (value & 0xff);
+}
+
+void reg_put32(uint8_t addr, uint32_t value)
+{
+    reg_put16(addr, (uint16_t) (value >> 16));
+    reg_put16(addr + 2, (uint16_t) (value & 0xffff));
+}
+
 /* Main loop for i2c mode */
 void i2c_loop()
 {
     // This needs to be here
     TinyWireS_stop_check();
-    
-    // Querry the sensors and store it in the buffer
-    readings[0] = digitalRead(digitalInPin);
-    readings[1] = analogRead(analogInPin);
+
+    // Querry the sensors
+    uint8_t pin = digitalRead(digitalInPin);
+    uint16_t adc = analogRead(analogInPin);
+    uint32_t now = micros();
+
+    ovs_sum += adc;
+    if (++ovs_count == OVS_SAMPLES)
+    {
+      ovs_value = ovs_sum >> OVS_BITS;
+      ovs_sum = 0;
+      ovs_count = 0;
+    }
+    samples++;
+
+    // Publish the readings and registers at once, a request served from
+    // the interrupt never sees half an update
+    noInterrupts();
+    readings[0] = pin;
+    readings[1] = adc;
+    reg_put16(REG_WORD, adc | (pin ? 0x8000 : 0));
+    reg_put16(REG_ADC, adc);
+    regs[REG_PIN] = pin;
+    reg_put32(REG_SAMPLES, samples);
+    reg_put32(REG_TIMESTAMP, now);
+    reg_put16(REG_ADC_OVS, ovs_value);
+    interrupts();
 }
 
 /* Main loop, hwdetect, and select from the two operation loops */
@@ -134,15 +267,40 @@ void detect_jumper()
   }
 }
 
-/* Placeholder for write operations coming from master */
-void receiveEvent(uint8_t reg_addr)
+/* Select a register block: the address and an optional length, the whole
+   rest of the map by default. Takes the snapshot the block is read from */
+void receiveEvent(uint8_t count)
 {
+  if (!count) return;
+  uint8_t addr = TinyWireS.receive();
+  uint8_t len = REG_SIZE - (addr % REG_SIZE);
+  if (count > 1)
+  {
+    len = TinyWireS.receive();
+    count--;
+  }
+  // The map is read only, ignore anything else that was written
+  while (--count) TinyWireS.receive();
+
+  reg_ptr = addr % REG_SIZE;
+  reg_left = len;
+  for (uint8_t i = 0; i < REG_SIZE; i++) reg_snap[i] = regs[i];
+  firstByte = true;
 }
 
 /* Gets called when the ATtiny receives an i2c request
    Sending a uint16_t will involve two requests in sequence */
 void requestEvent()
 {
+  // Serve the selected register block
+  if (reg_left)
+  {
+    TinyWireS.send(reg_snap[reg_ptr]);
+    reg_ptr = (reg_ptr + 1) % REG_SIZE;
+    reg_left--;
+    return;
+  }
+
   if (firstByte)
   {
     //byte lbyte = (byte) ((reading >> 8) & 0xff);
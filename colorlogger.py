@@ -7,16 +7,68 @@ __version__ = "0.0.1"
 __email__ = "minos197@gmail.com"
 __date__ = "04-03-2016"
 
+import os
 import re
-from datetime import datetime
-from inspect import getframeinfo, stack
+import sys
+import time
+import atexit
+import threading
+from collections import deque
+import pimetrics
+
+LOG_LINES = pimetrics.counter("smartpi_log_lines_total",
+                              "Log lines emitted", ["level"])
+LOG_DROPPED = pimetrics.counter("smartpi_log_dropped_total",
+                                "Log lines the file sink dropped").labels()
+QUEUE_DEPTH = pimetrics.gauge("smartpi_queue_depth",
+                              "Jobs waiting in a queue", ["queue"])
+
+# Code objects of the logging pipeline, skipped when resolving the caller
+_INTERNAL_CODES = set()
+# Cache of (code object, line number) -> (function, line, module)
+_CALL_SITES = {}
+
+
+def log_internal(func):
+    """Decorator that marks a function as part of the logging pipeline, so
+    it is never reported as the call site of a message."""
+
+    _INTERNAL_CODES.add(func.__code__)
+    return func
+
+
+def callsite(depth=1):
+    """Return (function, line, module) of the first frame outside the
+    logging pipeline, walking up from depth frames above the caller."""
+
+    frame = sys._getframe(depth + 1)
+    while frame is not None and frame.f_code in _INTERNAL_CODES:
+        frame = frame.f_back
+    if frame is None:
+        return None
+
+    key = (frame.f_code, frame.f_lineno)
+    try:
+        return _CALL_SITES[key]
+    except KeyError:
+        site = (frame.f_code.co_name, frame.f_lineno,
+                frame.f_code.co_filename)
+        _CALL_SITES[key] = site
+        return site
 
 
 def colorlogger(logtype):
     """Decorator that allows custom methods for clogger."""
 
+    lines = LOG_LINES.labels(logtype)
+
     def clog_decorator(func):
+        @log_internal
         def clog_wrapper(self, *args):
+            # Filter on level before any formatting or I/O takes place
+            if logtype not in CLogger.ENABLED:
+                return
+            lines.inc()
             return CLogger._color_stdout(func(self, *args), logtype)
         return clog_wrapper
     return clog_decorator
@@ -24,6 +76,9 @@ def colorlogger(logtype):
 
 class ANSIColors(object):
 
+    TEST_INPUT = re.compile(r'^\033\[[3/9]{1}[0-9]{1}(?:;4)?m{1}$')
+    TEST_UNDERLINE = re.compile(r'^\033\[[3/9]{1}[0-9]{1}(?:;4){1}m{1}.+$')
+
     @classmethod
     def setup(self):
         """ Create class attributes for common ANSI colors"""
@@ -64,25 +119,229 @@ class ANSIColors(object):
 
         colors = lne[::2]
         # Do a sanity check on input and allow dual mode input
-        test_input = re.compile(r'^\033\[[3/9]{1}[0-9]{1}(?:;4)?m{1}$')
-        test_underline = re.compile(r'^\033\[[3/9]{1}[0-9]{1}(?:;4){1}m{1}.+$')
-        if not filter(test_input.findall, colors):
-            for i in range(len(colors)):
-                exec("colors[%d] = ANSIColors.%s" % (i, colors[i]))
-        cline = ["%s%s" % (x) for x in zip(colors, lne[1:][::2])]
+        if not filter(self.TEST_INPUT.match, colors):
+            colors = [getattr(ANSIColors, c) for c in colors]
 
         # Compose the string
-        pline = ""
-        for c in cline:
-            pline += c
+        pline = []
+        for c in ["%s%s" % (x) for x in zip(colors, lne[1::2])]:
+            pline.append(c)
             # If the line contains a underline it needs to be terminated
-            if test_underline.findall(c):
-                pline += ANSIColors.UEND
-            pline += sep
-        print pline + ANSIColors.END
+            if self.TEST_UNDERLINE.match(c):
+                pline.append(ANSIColors.UEND)
+            pline.append(sep)
+        pline.append(ANSIColors.END)
+        print "".join(pline)
+
+
+class FileSink(object):
+    """ Buffered log file writer.
+
+    Lines are appended to an in memory buffer and written out by a
+    background thread through a single long lived file handle, so logging
+    threads never wait on disk I/O. The buffer is flushed every
+    flush_interval seconds or as soon as it holds buffer_size bytes.
+
+    fsync policy: never, flush (after every buffer flush) or always (the
+    writer flushes and syncs as soon as any line is pending).
+
+    The file is rotated when it grows over max_bytes or is older than
+    rotate_interval seconds (0 disables either check). Up to backup_count
+    rotated files are kept as path.1 ... path.N, optionally gzipped in the
+    background. If more than max_pending lines are waiting the newest lines
+    are dropped and counted in stats. """
+
+    FSYNC_POLICIES = ["never", "flush", "always"]
+
+    def __init__(self,
+                 path,
+                 flush_interval=1.0,
+                 buffer_size=64 * 1024,
+                 fsync="never",
+                 max_bytes=0,
+                 rotate_interval=0,
+                 backup_count=5,
+                 compress=False,
+                 max_pending=100000):
+
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("Fsync policy %s is not supported, select from "
+                             "%s" % (fsync, ", ".join(self.FSYNC_POLICIES)))
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.max_pending = max_pending
+
+        self.lines = deque()
+        self.pending_bytes = 0
+        self.running = True
+        self.cond = threading.Condition()
+        self.compressor = None
+        self.io_lock = threading.Lock()
+        self.stats = {"lines": 0, "bytes": 0, "flushes": 0,
+                      "rotations": 0, "dropped": 0}
+        self._open()
+
+        self.writer = threading.Thread(target=self._run, name="FileSink")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _open(self):
+        self.fp = open(self.path, "a")
+        self.size = self.fp.tell()
+        self.opened = time.time()
+
+    def write(self, line):
+        """ Queue a line for writing, returns without touching the disk.
+        Lines written after close are dropped """
+
+        with self.cond:
+            if not self.running or len(self.lines) >= self.max_pending:
+                self.stats["dropped"] += 1
+                LOG_DROPPED.inc()
+                return
+            self.lines.append(line)
+            self.pending_bytes += len(line)
+            if self.fsync == "always" or \
+                    self.pending_bytes >= self.buffer_size:
+                self.cond.notify()
+
+    def _run(self):
+        """ Writer thread loop """
+
+        while True:
+            with self.cond:
+                if self.running and \
+                        (self.fsync != "always" or not self.lines) and \
+                        self.pending_bytes < self.buffer_size:
+                    self.cond.wait(self.flush_interval)
+                lines, self.lines = self.lines, deque()
+                self.pending_bytes = 0
+                running = self.running
+            if lines:
+                self._write_out(lines)
+            if not running:
+                return
+
+    def _write_out(self, lines):
+        with self.io_lock:
+            if self.fp.closed:
+                return
+            self._write_lines(lines)
+
+    def _write_lines(self, lines):
+        try:
+            if self._should_rotate():
+                self._rotate()
+            data = "".join(lines)
+            self.fp.write(data)
+            self.fp.flush()
+            if self.fsync != "never":
+                os.fsync(self.fp.fileno())
+            self.size += len(data)
+            self.stats["lines"] += len(lines)
+            self.stats["bytes"] += len(data)
+            self.stats["flushes"] += 1
+        except (IOError, OSError):
+            # Logging should never take down the application
+            self.stats["dropped"] += len(lines)
+            LOG_DROPPED.inc(len(lines))
+
+    def _should_rotate(self):
+        if self.max_bytes and self.size >= self.max_bytes:
+            return True
+        if self.rotate_interval and \
+                time.time() - self.opened >= self.rotate_interval:
+            return True
+        return False
+
+    def _backup_name(self, idx):
+        return "%s.%d%s" % (self.path, idx, ".gz" if self.compress else "")
+
+    def _rotate(self):
+        """ Shift the backup files and reopen a fresh log file """
+
+        self.fp.close()
+        # Do not shift backups while the previous one is being compressed
+        if self.compressor:
+            self.compressor.join()
+
+        for idx in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(self._backup_name(idx)):
+                os.rename(self._backup_name(idx), self._backup_name(idx + 1))
+
+        if self.backup_count:
+            rotated = "%s.1" % self.path
+            os.rename(self.path, rotated)
+            if self.compress:
+                self.compressor = threading.Thread(target=self._compress,
+                                                   args=(rotated,),
+                                                   name="FileSinkCompress")
+                self.compressor.daemon = True
+                self.compressor.start()
+        else:
+            os.remove(self.path)
+
+        self._open()
+        self.stats["rotations"] += 1
+
+    @staticmethod
+    def _compress(path):
+        """ Gzip a rotated file and remove the original """
+        import gzip
+        import shutil
+
+        with open(path, "rb") as src:
+            with gzip.open(path + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(path)
+
+    def flush(self):
+        """ Write out the pending lines from the calling thread, does nothing
+        once the sink is closed """
+
+        with self.cond:
+            if not self.running:
+                return
+            lines, self.lines = self.lines, deque()
+            self.pending_bytes = 0
+        if lines:
+            self._write_out(lines)
+
+    def close(self):
+        """ Write out pending lines, stop the writer and close the file.
+        Closing again does nothing """
+
+        with self.cond:
+            if not self.running:
+                return
+            self.running = False
+            self.cond.notify()
+        self.writer.join()
+        if self.compressor:
+            self.compressor.join()
+        with self.io_lock:
+            self.fp.close()
 
 
 class CLogger(object):
+    """ Logging is safe from any number of threads. The configuration
+    methods serialize on a lock and publish their results by replacing
+    whole objects (the ENABLED set, the template dictionaries, the sink),
+    so the log calls read them without taking any lock. The level check in
+    particular is a single set lookup """
+
+    # Per second timestamp cache and the stream the tty check applies to
+    _ts_sec = None
+    _ts = ""
+    _out = (None, False)
+    _config_lock = threading.RLock()
+    sink = None
 
     def __init__(self):
         raise ValueError('Clogger is not meant to be instantiated.\n'
@@ -99,38 +358,93 @@ class CLogger(object):
               level="error",
               path="",
               alt_levels=None,
-              pattern=None):
-
-        self.LOG_PATH = path
-        self.LOG_LABEL = label
-        self.cprint = ANSIColors.setup()
-        self.set_def_colors(alt_levels)
-        self.set_level(level)
+              pattern=None,
+              file_opts=None):
+
+        with self._config_lock:
+            self.LOG_PATH = path
+            self.LOG_LABEL = label
+            self.set_sink(path, **(file_opts or {}))
+            self.cprint = ANSIColors.setup()
+            self._out = (None, False)
+            self.set_def_colors(alt_levels)
+            self.set_level(level)
         return self
 
+    @classmethod
+    def set_sink(self, path, **file_opts):
+        """ Replace the log file sink, file_opts are passed to FileSink """
+
+        with self._config_lock:
+            self.close()
+            self.LOG_PATH = path
+            if path:
+                try:
+                    sink = FileSink(path, **file_opts)
+                except IOError:
+                    return
+                self.sink = sink
+
+    @classmethod
+    def close(self):
+        """ Flush and close the log file """
+
+        with self._config_lock:
+            # Detach the sink first, lines logged meanwhile are not lost in
+            # a closed file
+            sink, self.sink = self.sink, None
+            if sink:
+                sink.close()
+
     @classmethod
     def set_def_colors(self, color_dict=None):
         """ Set the default colors for different levels of debuggin """
 
         # Create the default dictionary
-        self.DLEVELS = {"info": [0, "BLUE"],
-                        "warning": [1, "YELLOW"],
-                        "error": [2, "HRED"],
-                        "debug": [3, "WHITE"],
-                        "ver_debug": [4, "WHITE"]}
+        levels = {"info": [0, "BLUE"],
+                  "warning": [1, "YELLOW"],
+                  "error": [2, "HRED"],
+                  "debug": [3, "WHITE"],
+                  "ver_debug": [4, "WHITE"]}
         # Extract the log base collor if it exists
         try:
             c = color_dict.pop("base_color")
         except (KeyError, AttributeError):
             c = "CYAN"
-        self.BASE_COLOR = ["%s%s" % (pre, c) for pre in ["", "U"]]
 
         if isinstance(color_dict, dict):
             # Update only the valid entries
-            self.DLEVELS.update({k: [v[0], color_dict[k]] for k, v
-                                in self.DLEVELS.iteritems()
-                                if k in color_dict and color_dict[k]
-                                in ANSIColors.color_list})
+            levels.update({k: [v[0], color_dict[k]] for k, v
+                           in levels.iteritems()
+                           if k in color_dict and color_dict[k]
+                           in ANSIColors.color_list})
+        with self._config_lock:
+            self.DLEVELS = levels
+            self.BASE_COLOR = ["%s%s" % (pre, c) for pre in ["", "U"]]
+            self._compile_templates()
+
+    @classmethod
+    def _compile_templates(self):
+        """ Prerender the static parts of the log line of every level. A line
+        is rendered as t[0] + time + t[1] + label + t[2] + message + t[3] """
+
+        def uend(code):
+            return ANSIColors.UEND if code.endswith(";4m") else ""
+
+        base, ubase = [getattr(ANSIColors, c) for c in self.BASE_COLOR]
+        # Built aside and swapped in, loggers never see a partial table
+        templates = {}
+        plain = {}
+        for ltype, (_, clr) in self.DLEVELS.iteritems():
+            clr = getattr(ANSIColors, clr)
+            tag = "[%s]:%s " % (ltype, " " * (7 - len(ltype)))
+            templates[ltype] = (base,
+                                uend(base) + " " + ubase,
+                                uend(ubase) + " " + clr + tag,
+                                uend(clr) + " " + ANSIColors.END + "\n")
+            plain[ltype] = ("", " ", " " + tag, "\n")
+        self.TEMPLATES = templates
+        self.PLAIN_TEMPLATES = plain
 
     @classmethod
     def set_level(self, lv="info"):
@@ -142,49 +456,68 @@ class CLogger(object):
             except KeyError:
                 raise ValueError("Error, supported debug levels"
                                  "are: %s" % ", ".join(self.DLEVELS.keys()))
-        self.LEVEL = lv
+        # Precompute the levels that pass the filter for cheap gating, the
+        # set is replaced in one assignment and read without a lock
+        enabled = frozenset([k for k, v in self.DLEVELS.iteritems()
+                             if v[0] <= lv])
+        with self._config_lock:
+            self.LEVEL = lv
+            self.ENABLED = enabled
+
+    @classmethod
+    def enabled(self, ltype):
+        """ Return True if messages of type ltype will be logged """
+
+        return ltype in self.ENABLED
 
     @classmethod
     def _log(self, msg, *args):
+        """ Format and store a message. Expensive messages can be passed as
+        a callable that returns the text, it will only be called if the
+        message passes the level filter """
 
-        msg = [datetime.now().strftime('%F %T'),
+        if callable(msg):
+            msg = msg()
+        msg = [self._timestamp(),
                "%s" % self.LOG_LABEL, (msg % args)]
-        # To file
-        if self.LOG_PATH:
-            try:
-                fp = open(self.LOG_PATH, 'a')
-                fp.write(" ".join(msg) + '\n')
-            except:
-                pass
+        # To file, through a local in case the sink is swapped meanwhile
+        sink = self.sink
+        if sink:
+            sink.write(" ".join(msg) + '\n')
         return msg
 
     @classmethod
-    def _color_stdout(self, dataset, ltype):
-        """ Print text with preformated color for debug level """
+    def _timestamp(self):
+        """ Return the current time as text, rendered once per second """
 
-        lv_no, lv_clr = self.DLEVELS[ltype]
-        if (self.LEVEL < lv_no):
-            return
+        now = int(time.time())
+        if now != self._ts_sec:
+            self._ts = time.strftime('%F %T', time.localtime(now))
+            self._ts_sec = now
+        return self._ts
 
-        pattern = self.BASE_COLOR + [lv_clr]
-        # Compose the line
-        colored_line = [
-            item for pair in zip(
-                pattern,
-                dataset) for item in pair]
-        # Add log type information and padding
-        padding = " " * (7 - len(ltype))
+    @classmethod
+    @log_internal
+    def _color_stdout(self, dataset, ltype):
+        """ Print text with preformated color for debug level """
 
-        colored_line[-1] = "[%s]:%s %s" % (ltype, padding, colored_line[-1])
+        out = sys.stdout
+        # Skip the ANSI codes when output is redirected to a pipe or file.
+        # The stream and its tty flag are cached as one tuple
+        cached, tty = self._out
+        if out is not cached:
+            tty = hasattr(out, "isatty") and out.isatty()
+            self._out = (out, tty)
+        tmpl = (self.TEMPLATES if tty else self.PLAIN_TEMPLATES)[ltype]
 
+        details = ""
         if self.LEVEL == self.DLEVELS["ver_debug"][0]:
+            site = callsite()
+            if site:
+                details = " >> Called by %s() at %d in %s" % site
 
-            #print "\n".join(stack())
-            mod, line, fn, _, _ = getframeinfo(stack()[-3][0])
-            details = " >> Called by %s() at %d in %s" % (fn, line, mod)
-            colored_line[-1] = colored_line[-1] + details
-
-        self.cprint(colored_line)
+        out.write("".join([tmpl[0], dataset[0], tmpl[1], dataset[1], tmpl[2],
+                           dataset[2], details, tmpl[3]]))
 
     @classmethod
     @colorlogger("error")
@@ -207,6 +540,17 @@ class CLogger(object):
         return self._log(msg, *args)
 
 
+def _log_pending():
+    sink = CLogger.sink
+    return len(sink.lines) if sink else 0
+
+
+# The gauge and the exit handler follow the current sink, replaced sinks
+# are not kept alive
+QUEUE_DEPTH.labels("log").set_function(_log_pending)
+atexit.register(CLogger.close)
+
+
 if __name__ == '__main__':
     log = CLogger.setup("colortest", "ver_debug")
 
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""piadc.py: Vectorized processing of the ATTINY85 ADC/PIN samples.
+   Demuxing, oversampling, filters, pin hysteresis and conversion of counts
+   to physical units, each a NumPy operation over a whole batch"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import numpy as np
+from pisampler import demux
+
+ADC_BITS = 10
+ADC_COUNTS = 1 << ADC_BITS
+
+
+def words(raw):
+    """ Array of the big endian muxed words in a byte string, as read from
+    the slave """
+
+    return np.frombuffer(raw, dtype=">u2")
+
+
+def decimate(x, factor):
+    """ Mean of every factor consecutive samples, a trailing partial block
+    is dropped """
+
+    if factor == 1:
+        return np.asarray(x, dtype="f8")
+    n = len(x) // factor * factor
+    return np.asarray(x[:n], dtype="f8").reshape(-1, factor).mean(axis=1)
+
+
+def oversample(adc, bits):
+    """ Gain bits of resolution by summing blocks of 4 ** bits samples and
+    shifting the sum right by bits. Only works when the input carries at
+    least an LSB of noise. Results range from 0 to 2 ** (10 + bits) - 1 """
+
+    factor = 4 ** bits
+    n = len(adc) // factor * factor
+    sums = np.asarray(adc[:n]).reshape(-1, factor).sum(axis=1,
+                                                        dtype=np.uint32)
+    return np.right_shift(sums, bits)
+
+
+def _windows(x, n):
+    """ (n, len(x) - n + 1) array of the sliding windows of x, one shifted
+    copy per row. Filters use short windows, where this is cheaper than
+    building a strided view """
+
+    m = max(len(x) - n + 1, 0)
+    return np.array([x[i:i + m] for i in range(n)])
+
+
+def moving_average(x, n):
+    """ Mean of every window of n samples, len(x) - n + 1 results """
+
+    c = np.concatenate(([0.0], np.cumsum(x, dtype="f8")))
+    return (c[n:] - c[:-n]) / n
+
+
+def median_filter(x, n):
+    """ Median of every window of n samples, len(x) - n + 1 results. Removes
+    single sample spikes that an average would smear """
+
+    ordered = np.sort(_windows(x, n), axis=0)
+    if n % 2:
+        return ordered[n // 2]
+    return (ordered[n // 2 - 1] + ordered[n // 2]) / 2.0
+
+
+def hysteresis(x, low, high, initial=0):
+    """ Two level threshold. The state turns 1 when x reaches high, 0 when
+    it falls to low and otherwise holds, starting from initial """
+
+    x = np.asarray(x)
+    up = x >= high
+    # Index of the latest sample at or beyond a threshold, -1 before any
+    last = np.maximum.accumulate(np.where(up | (x <= low),
+                                          np.arange(len(x)), -1))
+    state = up.take(last)
+    state[:np.searchsorted(last, 0)] = initial
+    return state.view("u1")
+
+
+def debounce_pin(pin, window=8, low=0.25, high=0.75, initial=0):
+    """ Clean pin state of a noisy or bouncing PIN bit, the hysteresis of
+    its moving average. Returns len(pin) - window + 1 states """
+
+    # Integer window sums against scaled thresholds, cheaper than means
+    c = np.concatenate(([0], np.cumsum(pin, dtype="i4")))
+    return hysteresis(c[window:] - c[:-window], low * window, high * window,
+                      initial)
+
+
+class Calibration(object):
+    """ Conversion of ADC counts to physical units through a lookup table
+    with an entry for each of the 1024 counts. Integer 10bit counts are a
+    single table lookup, filtered or oversampled values interpolate
+    between entries """
+
+    def __init__(self, table, unit=""):
+        self.table = np.asarray(table, dtype="f8")
+        if self.table.shape != (ADC_COUNTS,):
+            raise ValueError("Calibration tables need %d entries" %
+                             ADC_COUNTS)
+        self.unit = unit
+        self.counts = np.arange(ADC_COUNTS, dtype="f8")
+
+    @classmethod
+    def linear(cls, vref=3.3, offset=0.0, unit="V"):
+        """ Voltage at the ADC pin, count * vref / 1024 + offset """
+
+        return cls(np.arange(ADC_COUNTS) * (vref / ADC_COUNTS) + offset,
+                   unit)
+
+    @classmethod
+    def from_points(cls, counts, values, unit=""):
+        """ Piecewise linear table through measured (count, value) points,
+        constant beyond the first and last point """
+
+        return cls(np.interp(np.arange(ADC_COUNTS), counts, values), unit)
+
+    @classmethod
+    def from_function(cls, fn, unit=""):
+        """ Table of fn evaluated on an array of every count, i.e a
+        thermistor equation """
+
+        return cls(fn(np.arange(ADC_COUNTS, dtype="f8")), unit)
+
+    def convert(self, counts, bits=ADC_BITS):
+        """ Values of counts sampled with bits of resolution """
+
+        counts = np.asarray(counts)
+        if bits == ADC_BITS and counts.dtype.kind in "ui":
+            return self.table.take(np.clip(counts, 0, ADC_COUNTS - 1))
+        scaled = counts / float(1 << (bits - ADC_BITS)) \
+            if bits != ADC_BITS else counts
+        return np.interp(scaled, self.counts, self.table)
+
+
+class ADCPipeline(object):
+    """ Processing chain for a stream of muxed words that arrives in
+    batches, such as the blocks of ADCSampler or windows of its ring.
+
+    ADC counts are oversampled by oversample bits (or averaged over
+    decimate samples), then median and moving average filtered and
+    converted by the calibration if one is given. The PIN bit is debounced
+    with hysteresis over pin_window samples. Samples that do not complete
+    a block or a filter window are kept for the next batch, so the output
+    matches processing the whole stream at once. ADC results come at the
+    decimated rate, pin states at the input rate. """
+
+    def __init__(self, oversample=0, decimate=1, median=1, average=1,
+                 calibration=None, pin_window=1, pin_low=0.25,
+                 pin_high=0.75):
+        self.bits = ADC_BITS + oversample
+        self.oversample = oversample
+        self.factor = 4 ** oversample if oversample else decimate
+        self.median = median
+        self.average = average
+        self.calibration = calibration
+        self.pin_window = pin_window
+        self.pin_low = pin_low
+        self.pin_high = pin_high
+        self.reset()
+
+    def reset(self):
+        """ Forget the carried samples and the pin state """
+
+        self.raw = np.zeros(0, dtype="u2")
+        self.med_tail = np.zeros(0, dtype="f8")
+        self.avg_tail = np.zeros(0, dtype="f8")
+        self.pin_tail = np.zeros(0, dtype="u1")
+        self.pin_state = 0
+
+    def _adc(self, adc):
+        raw = np.concatenate((self.raw, adc))
+        used = len(raw) // self.factor * self.factor
+        self.raw = raw[used:]
+        if self.oversample:
+            x = oversample(raw[:used], self.oversample).astype("f8")
+        else:
+            x = decimate(raw[:used], self.factor)
+
+        if self.median > 1:
+            x = np.concatenate((self.med_tail, x))
+            self.med_tail = x[max(len(x) - self.median + 1, 0):]
+            x = median_filter(x, self.median)
+        if self.average > 1:
+            x = np.concatenate((self.avg_tail, x))
+            self.avg_tail = x[max(len(x) - self.average + 1, 0):]
+            x = moving_average(x, self.average)
+        return x
+
+    def _pin(self, pin):
+        if self.pin_window <= 1:
+            return pin.astype("u1")
+        x = np.concatenate((self.pin_tail, pin))
+        self.pin_tail = x[max(len(x) - self.pin_window + 1, 0):]
+        states = debounce_pin(x, self.pin_window, self.pin_low,
+                              self.pin_high, self.pin_state)
+        if len(states):
+            self.pin_state = states[-1]
+        return states
+
+    def process(self, data):
+        """ Process a batch of muxed words. Returns a dictionary with the
+        filtered counts (adc), their calibrated values (value, if there is
+        a calibration) and the debounced pin states (pin) """
+
+        return self.process_samples(*demux(np.asarray(data, dtype="u2")))
+
+    def process_samples(self, adc, pin):
+        """ Process a batch of demuxed samples, i.e the adc and pin fields
+        of a SampleRing window """
+
+        result = {"adc": self._adc(adc), "pin": self._pin(pin)}
+        if self.calibration:
+            result["value"] = self.calibration.convert(result["adc"],
+                                                       self.bits)
+        return result
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""pibcast.py: Encodings for PiBlinker.led_bcast. An encoding turns text
+   into a schedule of (duration, pin mask) frames and decodes a timeline of
+   (timestamp, pin mask) samples back to text"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import re
+import random
+from bisect import bisect_right
+
+# Dense symbols, bit 0 drives RED, bit 1 GREEN and bit 2 BLUE so the seven
+# colors and off carry three bits per slot
+SYMBOLS = [None, "RED", "GREEN", "YELLOW", "BLUE", "PURPLE", "CYAN", "WHITE"]
+
+
+def crc8(data, poly=0x07):
+    """ CRC-8 of a byte string """
+
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xFF
+    return crc
+
+
+def history_timeline(history):
+    """ Convert FakeGPIO history entries (time, pin, value) to a timeline of
+    (time, pin mask) samples """
+
+    mask = 0
+    timeline = []
+    for t, pin, value in history:
+        mask = mask | (1 << pin) if value else mask & ~(1 << pin)
+        timeline.append((t, mask))
+    return timeline
+
+
+def simulate(schedule, jitter=0.0, sample_rate=None, flip=0.0, seed=None):
+    """ Timeline of a schedule as a receiver would see it. Frames start on
+    an absolute grid displaced by gaussian jitter in seconds. If sample_rate
+    is set the LEDs are sampled at that rate, like a camera, and each pin of
+    every sample is inverted with probability flip """
+
+    rng = random.Random(seed)
+    timeline = []
+    t = 0.0
+    last = 0.0
+    for duration, mask in schedule:
+        last = max(last, t + rng.gauss(0, jitter) if jitter else t)
+        timeline.append((last, mask))
+        t += duration
+    timeline.append((max(last, t), 0))
+    if not sample_rate:
+        return timeline
+
+    pins = reduce(lambda a, b: a | b, [m for _, m in timeline], 0)
+    pins = [1 << p for p in range(pins.bit_length()) if pins >> p & 1]
+    times = [s[0] for s in timeline]
+    samples = []
+    for i in range(int(times[-1] * sample_rate) + 1):
+        ts = i / float(sample_rate)
+        mask = timeline[bisect_right(times, ts) - 1][1]
+        for p in pins:
+            if flip and rng.random() < flip:
+                mask ^= p
+        samples.append((ts, mask))
+    return samples
+
+
+class BcastEncoding(object):
+    """ Base class of the led_bcast encodings. masks maps the LED colors to
+    pin masks, as PiBlinker.LED_MASKS """
+
+    name = None
+
+    def __init__(self, masks):
+        self.masks = masks
+
+    def encode(self, data):
+        """ Return the schedule of (duration, pin mask) frames for data """
+        raise NotImplementedError
+
+    def decode(self, timeline):
+        """ Recover the data from a timeline of (time, pin mask) samples,
+        returns None if nothing valid was found """
+        raise NotImplementedError
+
+    def expected(self, data):
+        """ The text decode() returns for a clean broadcast of data """
+        return data
+
+
+class LegacyEncoding(BcastEncoding):
+    """ The original blink count scheme. Every number of the text is shown
+    as a long GREEN pulse, RED, GREEN and BLUE pulse counts for the
+    hundreds, tens and units, and a long RED pulse """
+
+    name = "legacy"
+
+    def __init__(self, masks, long=1.0, short=0.2, gap=0.5):
+        super(LegacyEncoding, self).__init__(masks)
+        self.long = long
+        self.short = short
+        self.gap = gap
+
+    def _blink(self, color, times, period):
+        # Same pattern as PiBlinker.blink, off first, ends off
+        return [(period, 0), (period, self.masks[color])] * times
+
+    def encode(self, data):
+        schedule = []
+        for number in map(int, re.findall(r"\d+", data)):
+            schedule += self._blink("GREEN", 1, self.long)
+            for color, count in [("RED", number / 100),
+                                 ("GREEN", (number % 100) / 10),
+                                 ("BLUE", number % 10)]:
+                schedule.append((self.gap, 0))
+                schedule += self._blink(color, count, self.short)
+            schedule.append((self.gap, 0))
+            schedule += self._blink("RED", 1, self.long)
+        schedule.append((0, 0))
+        return schedule
+
+    def _pulses(self, timeline):
+        """ (mask, duration) of every lit interval. Intervals shorter than
+        a quarter of a short pulse are glitches and extend the preceding
+        one """
+
+        runs = []
+        for (t, mask), (end, _) in zip(timeline, timeline[1:]):
+            if runs and runs[-1][0] == mask:
+                runs[-1][2] = end
+            else:
+                runs.append([mask, t, end])
+        pulses = []
+        for mask, t, end in runs:
+            if pulses and (pulses[-1][0] == mask or
+                           end - t < self.short / 4):
+                pulses[-1][2] = end
+            else:
+                pulses.append([mask, t, end])
+        return [(mask, end - t) for mask, t, end in pulses if mask]
+
+    def decode(self, timeline):
+        threshold = (self.long + self.short) / 2.0
+        numbers = []
+        counts = None
+        for mask, duration in self._pulses(timeline):
+            if duration >= threshold:
+                if mask == self.masks["GREEN"]:
+                    counts = {"RED": 0, "GREEN": 0, "BLUE": 0}
+                elif mask == self.masks["RED"] and counts is not None:
+                    numbers.append(100 * counts["RED"] +
+                                   10 * counts["GREEN"] + counts["BLUE"])
+                    counts = None
+                continue
+            for color in counts or []:
+                if mask == self.masks[color]:
+                    counts[color] += 1
+        return ".".join(map(str, numbers)) if numbers else None
+
+    def expected(self, data):
+        return ".".join(str(int(n)) for n in re.findall(r"\d+", data))
+
+
+class DenseEncoding(BcastEncoding):
+    """ Fixed slot encoding using every LED color. Each slot shows one of
+    eight symbols (the seven colors or off) for 1/rate seconds and carries
+    three bits. A frame is a WHITE, off, WHITE, off preamble, followed by
+    the length, the data bytes and their CRC-8, then the LEDs go off. """
+
+    name = "dense"
+
+    PREAMBLE = [7, 0, 7, 0]
+
+    def __init__(self, masks, rate=10):
+        super(DenseEncoding, self).__init__(masks)
+        self.rate = float(rate)
+        self.symbol_masks = [self.masks[c] if c else 0 for c in SYMBOLS]
+        self.bit_masks = [self.masks[c] for c in ["RED", "GREEN", "BLUE"]]
+
+    def encode(self, data):
+        if len(data) > 255:
+            raise ValueError("Broadcasts are limited to 255 bytes")
+        frame = chr(len(data)) + data
+        frame += chr(crc8(frame))
+
+        bits = "".join(bin(b)[2:].zfill(8) for b in bytearray(frame))
+        bits += "0" * (-len(bits) % 3)
+        symbols = self.PREAMBLE + [int(bits[i:i + 3], 2)
+                                   for i in range(0, len(bits), 3)]
+        slot = 1 / self.rate
+        return [(slot, self.symbol_masks[s]) for s in symbols] + [(0, 0)]
+
+    def _symbol(self, mask):
+        # Pins are independent channels, a partially wrong mask still
+        # decodes the bits that are right
+        return sum(1 << i for i, m in enumerate(self.bit_masks) if mask & m)
+
+    def _read(self, times, timeline, t0, n):
+        """ Symbols of the n slots starting at t0, sampled at the centers """
+
+        slot = 1 / self.rate
+        return [self._symbol(timeline[max(bisect_right(
+                times, t0 + (k + 0.5) * slot) - 1, 0)][1]) for k in range(n)]
+
+    def _bytes(self, symbols):
+        bits = "".join(bin(s)[2:].zfill(3) for s in symbols)
+        return bytearray(int(bits[i:i + 8], 2)
+                         for i in range(0, len(bits) - 7, 8))
+
+    def decode(self, timeline):
+        if not timeline:
+            return None
+        times = [t for t, _ in timeline]
+        slot = 1 / self.rate
+        n = len(self.PREAMBLE)
+        for t0, mask in timeline:
+            # A frame can only start where the LEDs are WHITE
+            if self._symbol(mask) != 7:
+                continue
+            if self._read(times, timeline, t0, n) != self.PREAMBLE:
+                continue
+            start = t0 + n * slot
+            length = self._bytes(self._read(times, timeline, start, 3))[0]
+            nsym = (8 * (length + 2) + 2) / 3
+            frame = self._bytes(self._read(times, timeline, start, nsym))
+            frame = bytes(frame[:length + 2])
+            if len(frame) == length + 2 and crc8(frame[:-1]) == \
+                    ord(frame[-1]):
+                return frame[1:-1]
+        return None
+
+
+BCAST_ENCODINGS = {e.name: e for e in [LegacyEncoding, DenseEncoding]}
+
+
+def bcast_encoding(encoding, masks, rate=10):
+    """ Resolve an encoding name (or instance) to a BcastEncoding object """
+
+    if isinstance(encoding, BcastEncoding):
+        return encoding
+    if encoding == "dense":
+        return DenseEncoding(masks, rate)
+    try:
+        return BCAST_ENCODINGS[encoding](masks)
+    except KeyError:
+        raise ValueError("Broadcast encoding %s is not supported, select "
+                         "from %s" % (encoding, ", ".join(BCAST_ENCODINGS)))
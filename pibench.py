@@ -0,0 +1,1268 @@
+#!/usr/bin/env python
+
+"""pibench.py: Micro benchmarks for the PiBlinker library. Benchmarks use
+   the file backed stand-ins where possible so they run without hardware"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import time
+from itertools import cycle
+from piclock import monotonic
+from piblinker import PiBlinker, PiBlinkerError, WiringPiGPIO, gpio_backend
+
+
+def timeit(func, *args, **kwargs):
+    """ Time repeated calls of func. Returns a list of per call latencies
+    in seconds"""
+
+    rounds = kwargs.pop("rounds", 1000)
+    samples = []
+    for _ in range(rounds):
+        start = time.time()
+        func(*args)
+        samples.append(time.time() - start)
+    return samples
+
+
+def summary(name, samples):
+    """ Reduce a list of latencies to a dictionary of statistics """
+
+    samples = sorted(samples)
+    return {"name": name,
+            "rounds": len(samples),
+            "mean_us": 1e6 * sum(samples) / len(samples),
+            "min_us": 1e6 * samples[0],
+            "p50_us": 1e6 * samples[len(samples) // 2],
+            "p99_us": 1e6 * samples[int(len(samples) * 0.99)]}
+
+
+def report(results):
+    """ Print a table of latency results followed by any counter results """
+
+    print "%-28s %8s %12s %12s %12s" % ("benchmark", "rounds",
+                                         "mean(us)", "p50(us)", "p99(us)")
+    for r in [r for r in results if "mean_us" in r]:
+        print "%-28s %8d %12.1f %12.1f %12.1f" % (r["name"], r["rounds"],
+                                                   r["mean_us"], r["p50_us"],
+                                                   r["p99_us"])
+    for r in [r for r in results if "mean_us" not in r]:
+        print "%-28s %s" % (r["name"], ", ".join(
+            "%s=%s" % (k, v) for k, v in sorted(r.items()) if k != "name"))
+
+
+def bench_set_led(rounds=1000):
+    """ Latency of PiBlinker.set_led on the fake backend, when the LED state
+    changes and when the cached state makes the call a no-op """
+
+    pb = PiBlinker.setup(log_level="error", gpio="fake")
+    try:
+        modes = cycle(["ON", "OFF"])
+        results = [summary("set_led[toggle]",
+                           timeit(lambda: pb.set_led("WHITE", next(modes)),
+                                  rounds=rounds)),
+                   summary("set_led[unchanged]",
+                           timeit(pb.set_led, "RED", "OFF", rounds=rounds))]
+    finally:
+        pb.gpio.close()
+    return results
+
+
+def bench_blink_timing(times=20, periods=(0.005, 0.02, 0.1)):
+    """ Accuracy of the blink period, from the timestamps the fake backend
+    records for every pin write """
+
+    results = []
+    for period in periods:
+        pb = PiBlinker.setup(log_level="error", gpio="fake")
+        start = time.time()
+        pb.blink("RED", times, period)
+        duration = time.time() - start
+        edges = [t for t, pin, _ in pb.gpio.history if pin == 17]
+        errors = sorted(abs(b - a - period) for a, b in zip(edges, edges[1:]))
+        results.append({"name": "blink_timing[%dms]" % (1e3 * period),
+                        "edges": len(edges),
+                        "error_mean_us": round(1e6 * sum(errors) /
+                                               len(errors)),
+                        "error_max_us": round(1e6 * errors[-1]),
+                        "overshoot_ms": round(1e3 * (duration - 2 * times *
+                                                     period), 2)})
+        pb.gpio.close()
+    return results
+
+
+def bench_gpio_write(backends=("fake",), rounds=1000, pin=17):
+    """ Per write latency of the GPIO backends.
+
+    The subprocess path is benchmarked through the wiringpi backend with
+    the gpio command replaced by true, so the figure is the cost of the
+    fork/exec alone on machines without wiringPi installed. """
+
+    results = []
+    for name in backends:
+        if name == "subprocess":
+            backend = WiringPiGPIO(gpio_cmd="true")
+        else:
+            backend = gpio_backend(name)
+        try:
+            backend.export(pin)
+            # Subprocesses are slow, do not keep the user waiting
+            n = max(rounds // 10, 10) if name == "subprocess" else rounds
+            levels = cycle([1, 0])
+            samples = timeit(lambda: backend.write(pin, next(levels)),
+                             rounds=n)
+            results.append(summary("gpio_write[%s]" % name, samples))
+        finally:
+            backend.close()
+    return results
+
+
+def bench_notify(rounds=1000, period=0.001):
+    """ Caller side latency of a notification in sync and async mode """
+
+    results = []
+    for mode in ["sync", "async"]:
+        pb = PiBlinker.setup(log_level="error", gpio="fake", notify=mode,
+                             overflow="coalesce")
+        try:
+            samples = timeit(pb.notify, "RED", 1, period, rounds=rounds)
+            results.append(summary("notify[%s]" % mode, samples))
+            if mode == "async":
+                print "notify[async] counters:", pb.notify_stats()
+        finally:
+            if pb.blink_queue:
+                pb.blink_queue.stop(drain=False)
+            pb.gpio.close()
+    return results
+
+
+def bench_led_writes(rounds=10):
+    """ Hardware writes issued by the LED state cache against the one write
+    per pin per set_led call of the uncached implementation """
+
+    import piblinker
+
+    workloads = [("blink[RED]", lambda pb: pb.blink("RED", 3, 0)),
+                 ("blink[WHITE]", lambda pb: pb.blink("WHITE", 3, 0)),
+                 ("blink[mixed]", lambda pb: [pb.blink(c, 3, 0) for c in
+                                              ["RED", "YELLOW", "WHITE"]]),
+                 ("led_bcast", lambda pb: pb.led_bcast("192.168.1.10"))]
+    results = []
+    # Pulse timing is irrelevant for counting writes
+    sleep, piblinker.time.sleep = piblinker.time.sleep, lambda s: None
+    try:
+        for name, workload in workloads:
+            pb = PiBlinker.setup(log_level="error", gpio="fake")
+            for _ in range(rounds):
+                workload(pb)
+            stats = dict(pb.pin_writes)
+            stats["saved"] = stats["requested"] - stats["written"]
+            stats["hw_writes"] = pb.gpio.writes
+            stats["name"] = "led_writes[%s]" % name
+            results.append(stats)
+            pb.gpio.close()
+    finally:
+        piblinker.time.sleep = sleep
+    return results
+
+
+def bench_log_levels(rounds=1000):
+    """ Cost of a CLogger call at every configured level, filtered calls
+    should cost little more than a function call """
+
+    import sys
+    import os
+    from colorlogger import CLogger
+
+    results = []
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        CLogger.setup("bench", "info")
+        levels = sorted(CLogger.DLEVELS, key=lambda k: CLogger.DLEVELS[k][0])
+        for configured in levels:
+            CLogger.set_level(configured)
+            for call in ["info", "warning", "error", "debug"]:
+                state = "pass" if CLogger.enabled(call) else "filtered"
+                samples = timeit(getattr(CLogger, call), "value %d", 42,
+                                 rounds=rounds)
+                results.append(summary("log[%s@%s,%s]" % (call, configured,
+                                                          state), samples))
+
+        # Filtered PiBlinker wrappers should not blink the LED
+        pb = PiBlinker.setup(log_level="info", gpio="fake")
+        samples = timeit(pb.debug, "value %d", 42, rounds=rounds)
+        results.append(summary("piblinker[debug@info,filtered]", samples))
+        pb.gpio.close()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return results
+
+
+def bench_log_rate(duration=0.5):
+    """ CLogger messages per second at every level, printing to a discarded
+    stdout, with and without a file sink """
+
+    import os
+    import sys
+    import shutil
+    import tempfile
+    from colorlogger import CLogger
+
+    results = []
+    tmp = tempfile.mkdtemp()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        for sink in ["stdout", "stdout+file"]:
+            path = os.path.join(tmp, "bench.log") if sink != "stdout" \
+                else None
+            CLogger.setup("bench", "ver_debug", path)
+            for level in ["info", "warning", "error", "debug"]:
+                log = getattr(CLogger, level)
+                count = 0
+                end = time.time() + duration
+                while time.time() < end:
+                    for _ in range(100):
+                        log("value %d", count)
+                    count += 100
+                results.append({"name": "log_rate[%s,%s]" % (level, sink),
+                                "msgs_per_s": round(count / duration)})
+            CLogger.close()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def bench_i2c(rounds=1000, duration=0.5):
+    """ Samples per second and per read latency of i2c_read_as. The slave
+    is the in memory stand-in of the I2C bus, the I2C_RDWR ioctl can not
+    be served by a plain file """
+
+    pb = PiBlinker.setup(log_level="error", gpio="fake", i2c="fake")
+    try:
+        pb.i2c_open_file(0x04, 1)
+        results = [summary("i2c_read_as", timeit(pb.i2c_read_as, 0x04, ">H",
+                                                 2, rounds=rounds))]
+        count = 0
+        end = time.time() + duration
+        while time.time() < end:
+            pb.i2c_read_as(0x04, ">H", 2)
+            count += 1
+        results.append({"name": "i2c_read_as[rate]",
+                        "samples_per_s": round(count / duration)})
+        pb.i2c_close(0x04)
+    finally:
+        pb.gpio.close()
+    return results
+
+
+def bench_registers(rounds=1000):
+    """ Cost of polling the sensor state: the whole register map in one
+    combined transaction against ADC and PIN read separately with the
+    legacy word, and the bus transactions each poll takes. The in memory
+    bus hides the time on the wire, about 90us per byte at 100kHz """
+
+    pb = PiBlinker.setup(log_level="error", gpio="fake", i2c="fake")
+    try:
+        pb.i2c_open_file(0x04, 1)
+        bus = pb.i2c_device(0x04, 1).bus
+        results = []
+        for name, poll in [
+                ("legacy[adc+pin]",
+                 lambda: (pb.i2c_read_adc(0x04), pb.i2c_read_pin(0x04))),
+                ("registers[all]", lambda: pb.i2c_read_registers(0x04)),
+                ("registers[adc,pin]",
+                 lambda: pb.i2c_read_registers(0x04, ["adc", "pin"]))]:
+            before = bus.transfers
+            results.append(summary("i2c_state[%s]" % name,
+                                   timeit(poll, rounds=rounds)))
+            results.append({"name": "i2c_state[%s,bus]" % name,
+                            "transactions_per_poll":
+                            (bus.transfers - before) / rounds})
+
+        # Older firmware answers a block read with the muxed word, it must
+        # be rejected and the slave returned to word reads
+        writes = []
+
+        def legacy(write, read):
+            if write:
+                writes.append(bytearray(write))
+            return ("\x82\x00" * (read // 2 + 1))[:read]
+
+        bus.attach(0x04, legacy)
+        rejected = 0
+        for _ in range(rounds):
+            try:
+                pb.i2c_read_registers(0x04, ["adc", "pin"])
+            except PiBlinkerError:
+                rejected += 1
+        reset = len([w for w in writes if w == bytearray([0, 0])])
+        results.append({"name": "i2c_state[legacy firmware]",
+                        "errors": 2 * rounds - rejected - reset})
+        pb.i2c_close(0x04)
+    finally:
+        pb.gpio.close()
+    return results
+
+
+def bench_uart_rtt(rounds=200):
+    """ Round trip time of uart_read against a pty board that answers
+    without the firmware delay or line rate, the host side cost """
+
+    from piio import PtyBoard
+
+    board = PtyBoard(latency=0)
+    try:
+        PiBlinker.uart_open(board.port, 9600, time_out=1)
+        results = [summary("uart_read[%s]" % target,
+                           timeit(PiBlinker.uart_read, target, rounds=rounds))
+                   for target in ["ADC", "PIN"]]
+        PiBlinker.uart_close()
+    finally:
+        board.close()
+    return results
+
+
+def bench_daemon(rounds=100, debounce=0.005):
+    """ Button to action latency of the daemon path: fake edges, button
+    engine, action dispatcher and a python action. Latencies include the
+    debounce interval """
+
+    import threading
+    from pidaemon import (Button, ButtonEngine, QueueEdgeSource,
+                          ActionDispatcher)
+
+    done = threading.Event()
+    dispatcher = ActionDispatcher()
+    source = QueueEdgeSource()
+    engine = ButtonEngine([Button("button1", 5, {"press": done.set},
+                                  debounce=debounce)],
+                          source, dispatcher.submit).start()
+    try:
+        for _ in range(rounds):
+            done.clear()
+            source.inject(5, 1)
+            done.wait(1)
+            source.inject(5, 0)
+            time.sleep(2 * debounce)
+        # Let the last action be accounted
+        time.sleep(0.05)
+        history = dispatcher.latencies()
+    finally:
+        engine.stop()
+        dispatcher.stop()
+    return [summary("daemon[press_to_start]",
+                    [h["press_to_start"] for h in history]),
+            summary("daemon[press_to_finish]",
+                    [h["press_to_finish"] for h in history])]
+
+
+class _CounterSource(object):
+    """ Stand-in for an I2C read channel returning an incrementing word """
+
+    def __init__(self):
+        self.value = 0
+
+    def readinto(self, buf):
+        self.value = (self.value + 1) & 0x83FF
+        buf[0] = chr(self.value >> 8)
+        buf[1] = chr(self.value & 0xFF)
+        return 2
+
+
+def bench_sampler(rates=(1000, 5000), duration=1.0):
+    """ Achieved rate and scheduling jitter of the streaming ADC sampler """
+
+    import numpy as np
+    from pisampler import ADCSampler
+
+    results = []
+    for rate in rates:
+        sampler = ADCSampler(_CounterSource(), rate=rate).start()
+        time.sleep(duration)
+        sampler.stop()
+        t = sampler.ring.window()["t"]
+        jitter = np.abs(np.diff(t) - 1.0 / rate)
+        result = {"name": "sampler[%dHz]" % rate,
+                  "achieved_hz": round(sampler.achieved_rate(), 1),
+                  "jitter_mean_us": round(1e6 * jitter.mean(), 1),
+                  "jitter_p99_us": round(1e6 * np.percentile(jitter, 99), 1)}
+        result.update(sampler.stats)
+        results.append(result)
+    return results
+
+
+def _python_average(words, factor, table):
+    """ Per sample loop the ADC consumers used before piadc: demux, block
+    average and a table lookup """
+
+    values = []
+    acc = 0
+    for i, word in enumerate(words):
+        acc += PiBlinker.demux(word)[0]
+        if i % factor == factor - 1:
+            values.append(table[acc // factor])
+            acc = 0
+    return values
+
+
+def bench_adc(rounds=100, rates=(1000, 10000)):
+    """ Time to process one second of muxed samples with the piadc pipeline
+    against a pure Python loop """
+
+    import numpy as np
+    from piadc import ADCPipeline, Calibration
+
+    calibration = Calibration.linear()
+    table = list(calibration.table)
+    results = []
+    for rate in rates:
+        rng = np.random.RandomState(0)
+        words = (rng.randint(480, 520, rate) |
+                 (rng.rand(rate) < 0.5) << 15).astype("u2")
+        pipeline = ADCPipeline(oversample=2, median=3, average=4,
+                               calibration=calibration, pin_window=8)
+        results.append(summary("adc[numpy,%dHz]" % rate,
+                               timeit(pipeline.process, words,
+                                      rounds=rounds)))
+        py_words = words.tolist()
+        results.append(summary("adc[python,%dHz]" % rate,
+                               timeit(_python_average, py_words, 16, table,
+                                      rounds=max(rounds // 10, 5))))
+    return results
+
+
+def _publish_samples(path, ready, block):
+    """ Publisher process of bench_sample_bus, samples carry their index in
+    t and adc so readers can spot torn windows """
+
+    import numpy as np
+    from pisampler import SharedSampleRing
+
+    ring = SharedSampleRing.create(path, 4096)
+    ready.set()
+    i = 0
+    while True:
+        idx = np.arange(i, i + block)
+        ring.push(idx.astype("f8"), (idx & 0x3FF).astype("u2"),
+                  (idx & 1).astype("u1"))
+        i += block
+        time.sleep(0.0005)
+
+
+def bench_sample_bus(rounds=1000, block=64, path="/tmp/piblinker_bench.bus"):
+    """ Read latency of the shared sample bus while another process
+    publishes into it, and the windows found torn by the publisher """
+
+    import os
+    import numpy as np
+    from multiprocessing import Process, Event
+    from pisampler import SharedSampleRing, SampleBusError
+
+    ready = Event()
+    publisher = Process(target=_publish_samples, args=(path, ready, block))
+    publisher.daemon = True
+    publisher.start()
+    ready.wait(5)
+    results = []
+    try:
+        bus = PiBlinker.sample_bus(path)
+        while not bus.count:
+            time.sleep(0.001)
+        results.append(summary("sample_bus[latest]",
+                               timeit(bus.latest, rounds=rounds)))
+        results.append(summary("sample_bus[window(1000)]",
+                               timeit(bus.window, 1000, rounds=rounds)))
+        torn = 0
+        for _ in range(rounds):
+            t = bus.window(1000)["t"]
+            consistent = (np.diff(t) == 1).all()
+            if not consistent and bus.intact():
+                torn += 1
+            time.sleep(0.0001)
+        results.append({"name": "sample_bus[consistency]", "torn": torn,
+                        "windows": rounds, "published": bus.count})
+    finally:
+        publisher.terminate()
+        publisher.join()
+        PiBlinker.bus_reader = None
+        if os.path.exists(path):
+            os.unlink(path)
+
+    # A publisher killed inside push leaves the sequence odd, readers must
+    # give up after stall_timeout instead of spinning forever
+    ring = SharedSampleRing.create(path, 64)
+    try:
+        ring.push(np.zeros(1), np.zeros(1, "u2"), np.zeros(1, "u1"))
+        ring.seq[0] += 1
+        reader = SharedSampleRing.open(path)
+        reader.stall_timeout = 0.05
+        errors = 0
+        for read in [lambda: reader.count, reader.latest, reader.window]:
+            start = time.time()
+            try:
+                read()
+                errors += 1
+            except SampleBusError:
+                if time.time() - start > 10 * reader.stall_timeout:
+                    errors += 1
+        results.append({"name": "sample_bus[stalled publisher]",
+                        "errors": errors})
+    finally:
+        ring.close()
+    return results
+
+
+def bench_capture(records=2000000, block=64, path="/tmp/piblinker_bench.cap"):
+    """ Records per second written to a capture in sampler sized blocks,
+    time to open the capture and to slice a second out of it """
+
+    import os
+    import glob
+    import numpy as np
+    from picapture import CaptureWriter, open_capture
+
+    t = np.arange(records) / 1000.0
+    adc = (np.arange(records) & 0x3FF).astype("u2")
+    pin = (np.arange(records) & 1).astype("u1")
+    writer = CaptureWriter(path, 1000, max_bytes=16 * 1024 * 1024)
+    start = time.time()
+    for i in range(0, records, block):
+        writer.write(t[i:i + block], adc[i:i + block], pin[i:i + block])
+    writer.close()
+    elapsed = time.time() - start
+    results = [{"name": "capture[write]",
+                "records_per_s": round(records / elapsed),
+                "mb_per_s": round(writer.stats["bytes"] / elapsed / 1e6, 1),
+                "parts": writer.stats["parts"]}]
+    try:
+        results.append(summary("capture[open]",
+                               timeit(open_capture, path, rounds=20)))
+        capture = open_capture(path)
+        mid = records / 2000.0
+        results.append(summary("capture[between(1s)]",
+                               timeit(lambda: capture.between(mid, mid + 1),
+                                      rounds=200)))
+    finally:
+        for part in glob.glob(os.path.splitext(path)[0] + ".*"):
+            os.unlink(part)
+    return results
+
+
+def bench_io_engine(boards=(1, 2, 4, 8), duration=1.0, latency=0.005):
+    """ Aggregate samples per second of the I/O engine as boards are added,
+    against reading the same boards one after the other """
+
+    from piio import IOEngine, PtyBoard
+
+    results = []
+    for n in boards:
+        fakes = [PtyBoard(latency=latency) for _ in range(n)]
+        engine = IOEngine()
+        for i, board in enumerate(fakes):
+            engine.add_uart("board%d" % i, board.port)
+        engine.start()
+        try:
+            for mode in ["serial", "engine"]:
+                samples = 0
+                end = time.time() + duration
+                while time.time() < end:
+                    if mode == "serial":
+                        for name in engine.channels:
+                            engine.request(name).result()
+                    else:
+                        engine.gather(engine.request_all())
+                    samples += n
+                results.append({"name": "io_engine[%s,%d boards]" % (mode, n),
+                                "samples_per_s": round(samples / duration)})
+        finally:
+            engine.stop()
+            for board in fakes:
+                board.close()
+
+    # An engine sharing the pool of PiBlinker must leave its slaves open
+    pb = PiBlinker.setup(log_level="error", gpio="fake", i2c="fake")
+    try:
+        pb.i2c_open_file(0x04, 1)
+        errors = 0
+        for _ in range(10):
+            engine = IOEngine(pb.i2c_pool)
+            engine.add_i2c("slave", 0x04, 1)
+            engine.start()
+            try:
+                engine.request("slave").result()
+            finally:
+                engine.stop()
+            try:
+                pb.i2c_transfer(0x04, read=2)
+                pb.i2c_read_registers(0x04, ["adc", "pin"])
+            except (IOError, PiBlinkerError):
+                errors += 1
+        results.append({"name": "io_engine[shared i2c pool]",
+                        "errors": errors})
+        pb.i2c_close(0x04)
+    finally:
+        pb.gpio.close()
+    return results
+
+
+def bench_uart_protocols(duration=1.0, baud=9600):
+    """ Samples per second of the ASCII and binary UART protocols against a
+    pty board emulating the firmware delays and the 9600 baud line rate """
+
+    from piio import PtyBoard
+
+    modes = [("ascii", None),
+             ("binary[window=1,burst=1]", (1, 1)),
+             ("binary[window=1,burst=8]", (1, 8)),
+             ("binary[window=4,burst=8]", (4, 8))]
+    results = []
+    board = PtyBoard(baud=baud)
+    try:
+        PiBlinker.uart_open(board.port, baud, time_out=1)
+        for name, params in modes:
+            samples = 0
+            end = time.time() + duration
+            while time.time() < end:
+                if params is None:
+                    PiBlinker.uart_read("ADC")
+                    PiBlinker.uart_read("PIN")
+                    samples += 1
+                else:
+                    samples += len(PiBlinker.uart_stream(32, *params))
+            results.append({"name": "uart[%s]" % name,
+                            "samples_per_s": round(samples / duration, 1)})
+        results[-1]["stats"] = PiBlinker.uart_bin.stats
+        PiBlinker.uart_close()
+    finally:
+        board.close()
+    return results
+
+
+def bench_buttons(rounds=100, pins=(5, 6, 13, 19), debounce=0.005):
+    """ Edge to dispatch latency and edge throughput of the button engine,
+    driven by the injectable fake edge source. The latency includes the
+    debounce interval """
+
+    import threading
+    from pidaemon import Button, ButtonEngine, QueueEdgeSource
+
+    latencies = []
+    dispatched = threading.Event()
+
+    def dispatch(name, action, pressed):
+        latencies.append(monotonic() - pressed)
+        dispatched.set()
+
+    source = QueueEdgeSource()
+    buttons = [Button("b%d" % p, p, {"press": "bench"}, debounce=debounce)
+               for p in pins]
+    engine = ButtonEngine(buttons, source, dispatch).start()
+    try:
+        for i in range(rounds):
+            pin = pins[i % len(pins)]
+            dispatched.clear()
+            source.inject(pin, 1)
+            dispatched.wait(1)
+            source.inject(pin, 0)
+        results = [summary("buttons[edge_to_dispatch]", latencies)]
+
+        # Burst of edges on all pins, how fast the engine drains them
+        edges = 100 * rounds
+        target = engine.stats["edges"] + edges
+        start = time.time()
+        for i in range(edges):
+            source.inject(pins[i % len(pins)], (i // len(pins)) & 1)
+        while engine.stats["edges"] < target and time.time() - start < 10:
+            time.sleep(0.001)
+        results.append({"name": "buttons[throughput]",
+                        "edges_per_s": round(edges / (time.time() - start))})
+    finally:
+        engine.stop()
+    return results
+
+
+def _serve_leds(path, ready):
+    """ LED service process of bench_service """
+
+    import os
+    import sys
+    from piservice import LEDService
+
+    sys.stdout = open(os.devnull, "w")
+    pb = PiBlinker.setup(log_level="info", gpio="fake", notify="async")
+    LEDService(pb, path).start()
+    ready.set()
+    while True:
+        time.sleep(1)
+
+
+def bench_service(rounds=1000, path="/tmp/piblinker_bench.sock"):
+    """ Commands per second a client pipelines to the LED service running in
+    another process, the round trip of a sync, and the cost of a client
+    setup against a setup that configures the GPIO itself """
+
+    import os
+    from multiprocessing import Process, Event
+    from piservice import LEDClient
+
+    ready = Event()
+    server = Process(target=_serve_leds, args=(path, ready))
+    server.daemon = True
+    server.start()
+    ready.wait(5)
+    client = LEDClient(path)
+    results = []
+    try:
+        workloads = [("set_led", lambda i: client.set_led("RED", i & 1)),
+                     ("blink", lambda i: client.blink("GREEN", 1, 0.001)),
+                     ("log", lambda i: client.log("info", "value %d" % i))]
+        for name, workload in workloads:
+            start = time.time()
+            for i in range(rounds):
+                workload(i)
+            client.sync()
+            results.append({"name": "service[%s]" % name,
+                            "commands_per_s": round(rounds /
+                                                    (time.time() - start))})
+        results.append(summary("service[sync]",
+                               timeit(client.sync, rounds=rounds)))
+
+        backends = [("wiringpi", WiringPiGPIO(gpio_cmd="true")),
+                    ("fake", "fake")]
+        for name, backend in backends:
+            samples = timeit(lambda: PiBlinker.setup(log_level="error",
+                                                     gpio=backend),
+                             rounds=max(rounds // 100, 5))
+            results.append(summary("setup[%s]" % name, samples))
+        samples = timeit(lambda: PiBlinker.setup(log_level="error",
+                                                 service=path),
+                         rounds=max(rounds // 100, 5))
+        results.append(summary("setup[client]", samples))
+    finally:
+        if PiBlinker.client:
+            PiBlinker.client.close()
+            PiBlinker.client = None
+        client.close()
+        server.terminate()
+        server.join()
+        if os.path.exists(path):
+            os.unlink(path)
+    return results
+
+
+def _python(code):
+    """ Run code in a fresh interpreter, returns its output or None """
+
+    import os
+    import sys
+    from subprocess import Popen, PIPE
+
+    proc = Popen([sys.executable, "-c", code], stdout=PIPE, stderr=PIPE,
+                 cwd=os.path.dirname(os.path.abspath(__file__)))
+    out, _ = proc.communicate()
+    return out if proc.returncode == 0 else None
+
+
+def bench_startup(rounds=10):
+    """ Start up cost of one shot scripts. Interpreter start, import and
+    setup are timed in fresh interpreters, followed by the import time of
+    every module PiBlinker can pull in and whether a plain import of
+    piblinker loads it. Finally the GPIO subprocesses a wiringpi setup
+    runs on fresh and on already exported pins """
+
+    import os
+    import shutil
+    import tempfile
+    import piblinker
+    from piblinker import FakeGPIO
+
+    workloads = [("python", "pass"),
+                 ("import", "import piblinker"),
+                 ("setup[fake]", "from piblinker import PiBlinker;"
+                  "PiBlinker.setup(log_level='error', gpio='fake')")]
+    results = []
+    for name, code in workloads:
+        samples = timeit(_python, code, rounds=rounds)
+        results.append(summary("startup[%s]" % name, samples))
+
+    modules = ["piclock", "colorlogger", "piblinker", "ctypes", "subprocess",
+               "serial", "socket", "piservice", "daemon", "RPi.GPIO",
+               "pidaemon", "numpy"]
+    loaded = _python("import sys, piblinker; print ' '.join(sys.modules)")
+    loaded = set(loaded.split()) if loaded else set()
+    for module in modules:
+        out = _python("import time; t = time.time(); import %s;"
+                      "print time.time() - t" % module)
+        results.append({"name": "import[%s]" % module,
+                        "ms": round(1e3 * float(out), 2) if out else "missing",
+                        "loaded_by_piblinker": module in loaded})
+
+    # Count the subprocesses instead of running them
+    calls = []
+    run, piblinker.PiBlinker.run = piblinker.PiBlinker.run, calls.append
+    base = tempfile.mkdtemp()
+    try:
+        for name, exported in [("fresh", False), ("exported", True)]:
+            if exported:
+                pins = FakeGPIO(base)
+                map(pins.export, [17, 18, 27])
+                pins.close()
+            del calls[:]
+            backend = piblinker.WiringPiGPIO(base=base)
+            piblinker.PiBlinker.setup(log_level="error", gpio=backend)
+            results.append({"name": "setup[wiringpi,%s]" % name,
+                            "subprocesses": len(calls)})
+    finally:
+        piblinker.PiBlinker.run = staticmethod(run)
+        piblinker.PiBlinker.gpio = None
+        shutil.rmtree(base, ignore_errors=True)
+    return results
+
+
+def bench_bcast(trials=20, data="192.168.1.10"):
+    """ Achieved bits per second and error rate of the led_bcast encodings.
+    Broadcasts are decoded from simulated receivers with frame timing
+    jitter or from a 240 fps camera that misreads 0.1% of the pins, and
+    once from the fake GPIO history of a real dense broadcast """
+
+    from pibcast import bcast_encoding, simulate, history_timeline
+
+    receivers = [("ideal", {}),
+                 ("jitter=2ms", {"jitter": 0.002}),
+                 ("jitter=10ms", {"jitter": 0.01}),
+                 ("camera", {"sample_rate": 240, "flip": 0.001})]
+    encodings = [("legacy", 0), ("dense", 10), ("dense", 20), ("dense", 50)]
+    pb = PiBlinker.setup(log_level="error", gpio="fake")
+    results = []
+    for name, rate in encodings:
+        enc = bcast_encoding(name, pb.LED_MASKS, rate)
+        schedule = enc.encode(data)
+        duration = sum(d for d, _ in schedule)
+        expected = enc.expected(data)
+        for receiver, options in receivers:
+            errors = sum(enc.decode(simulate(schedule, seed=i, **options)) !=
+                         expected for i in range(trials))
+            results.append({"name": "bcast[%s%s,%s]" % (
+                name, "@%dHz" % rate if rate else "", receiver),
+                "seconds": round(duration, 2),
+                "bits_per_s": round(8 * len(expected) / duration, 1),
+                "error_rate": round(errors / float(trials), 3)})
+
+    pb.bcast = bcast_encoding("dense", pb.LED_MASKS, 20)
+    start = time.time()
+    pb.led_bcast(data)
+    duration = time.time() - start
+    decoded = pb.bcast.decode(history_timeline(pb.gpio.history))
+    results.append({"name": "bcast[dense@20Hz,fake gpio]",
+                    "seconds": round(duration, 2),
+                    "bits_per_s": round(8 * len(data) / duration, 1),
+                    "decoded": decoded == data})
+    pb.gpio.close()
+    return results
+
+
+def _duty(history, pin):
+    """ Share of time a pin was high in a FakeGPIO history """
+
+    events = [(t, v) for t, p, v in history if p == pin]
+    if len(events) < 2:
+        return float(events[0][1]) if events else 0.0
+    high = sum(b[0] - a[0] for a, b in zip(events, events[1:]) if a[1])
+    return high / (events[-1][0] - events[0][0])
+
+
+def bench_pwm(frequencies=(50, 100, 200, 500, 1000), spins=(0, 0.0005),
+              duration=1.0):
+    """ Edge jitter, load and duty cycle error of the software PWM at
+    several frequencies, with and without busy waiting before edges """
+
+    from piblinker import FakeGPIO
+
+    duties = {17: 0.25, 18: 0.5, 27: 0.75}
+    results = []
+    for spin in spins:
+        for frequency in frequencies:
+            pb = PiBlinker.setup(log_level="error",
+                                 gpio=FakeGPIO(history_len=None))
+            pwm = pb.pwm_start(frequency, spin)
+            pwm.set_duty(duties)
+            time.sleep(duration)
+            pb.pwm_stop()
+            stats = pwm.report()
+            error = sum(abs(_duty(pb.gpio.history, p) - d)
+                        for p, d in duties.iteritems()) / len(duties)
+            results.append({"name": "pwm[%dHz,spin=%dus]" % (frequency,
+                                                             1e6 * spin),
+                            "jitter_mean_us": round(stats["jitter_mean_us"]),
+                            "jitter_p99_us": round(stats["jitter_p99_us"]),
+                            "cpu": round(stats["cpu"], 3),
+                            "busy": round(stats["busy"], 3),
+                            "overruns": stats["overruns"],
+                            "duty_error": round(error, 4)})
+            pb.gpio.close()
+    return results
+
+
+def bench_metrics(rounds=1000):
+    """ Cost of the instrumentation: counter and histogram updates, an I2C
+    transfer with and without its metrics, and rendering the text format """
+
+    import pimetrics
+
+    registry = pimetrics.Registry()
+    count = registry.counter("bench_total", "Bench counter").labels()
+    hist = registry.histogram("bench_seconds", "Bench histogram").labels()
+    results = [summary("metrics[counter.inc]", timeit(count.inc,
+                                                      rounds=rounds)),
+               summary("metrics[histogram.observe]",
+                       timeit(hist.observe, 0.003, rounds=rounds)),
+               summary("metrics[render]",
+                       timeit(pimetrics.render, rounds=max(rounds // 10,
+                                                           10)))]
+
+    pb = PiBlinker.setup(log_level="error", gpio="fake", i2c="fake")
+    try:
+        dev, _ = pb.i2c_open_file(0x04, 1)
+        results += [summary("i2c_transfer[bus]",
+                            timeit(dev.bus.transfer, 0x04, None, 2,
+                                   rounds=rounds)),
+                    summary("i2c_transfer[instrumented]",
+                            timeit(dev.transfer, None, 2, rounds=rounds))]
+        pb.i2c_close(0x04)
+    finally:
+        pb.gpio.close()
+    return results
+
+
+def _run_threads(count, target, *args):
+    """ Run target(i, *args) on count threads, return the wall time """
+
+    import threading
+
+    threads = [threading.Thread(target=target, args=(i,) + args)
+               for i in range(count)]
+    start = monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return monotonic() - start
+
+
+def bench_threads(rounds=1000, threads=(1, 2, 4, 8), duration=0.5,
+                  transfer=0.0002):
+    """ Thread safety stress and lock contention. LEDs are toggled, the
+    UART is read and messages are logged from several threads at once,
+    checking no update, reply or line is lost or mixed up. I2C throughput
+    is measured with threads spread over separate buses and with all of
+    them on one bus, on a fake bus that takes transfer seconds per
+    transfer and releases the GIL meanwhile like the ioctl does """
+
+    import os
+    import sys
+    import tempfile
+    from piio import PtyBoard
+    from colorlogger import CLogger
+
+    results = []
+    workers = max(threads)
+    pb = PiBlinker.setup(log_level="error", gpio="fake", i2c="fake")
+    try:
+        # Every thread toggles one LED an even number of times
+        colors = ["RED", "GREEN", "BLUE"]
+        errors = []
+
+        def toggle(i):
+            for _ in range(2 * rounds):
+                pb.set_led(colors[i % 3], "Toggle")
+
+        elapsed = _run_threads(workers, toggle)
+        if pb.pin_state or pb.pin_writes["written"] != 2 * rounds * workers \
+                or any(pb.gpio.read(p) for p in pb.PINS):
+            errors.append("led")
+        results.append({"name": "threads[set_led,%d]" % workers,
+                        "ops_per_s": round(2 * rounds * workers / elapsed),
+                        "errors": len(errors)})
+
+        def reader(i, bus, counts, end):
+            dev = pb.i2c_device(0x04, bus)
+            while time.time() < end:
+                dev.read(2)
+                counts[i] += 1
+
+        def slow(write, read):
+            time.sleep(transfer)
+            return "\x02\x00"[:read]
+
+        for bus in range(1, workers + 1):
+            pb.i2c_open_file(0x04, bus)
+            pb.i2c_device(0x04, bus).bus.attach(0x04, slow)
+        for n in threads:
+            for layout in ["separate", "shared"]:
+                counts = [0] * n
+                end = time.time() + duration
+                elapsed = _run_threads(
+                    n, lambda i: reader(i, i + 1 if layout == "separate"
+                                        else 1, counts, end))
+                results.append({"name": "threads[i2c,%s,%d]" % (layout, n),
+                                "ops_per_s": round(sum(counts) / elapsed)})
+        for bus in range(1, workers + 1):
+            pb.i2c_close(0x04, bus)
+    finally:
+        pb.gpio.close()
+
+    # Each reply must answer the command of the thread that sent it
+    board = PtyBoard(adc=512, pin=1, latency=0)
+    try:
+        PiBlinker.uart_open(board.port, 9600, time_out=1)
+        mixed = []
+
+        def query(i):
+            target, expected = [("ADC", "512"), ("PIN", "1")][i % 2]
+            for _ in range(max(rounds // 10, 10)):
+                reply = PiBlinker.uart_read(target).strip()
+                if reply != expected:
+                    mixed.append(reply)
+
+        elapsed = _run_threads(workers, query)
+        PiBlinker.uart_close()
+        results.append({"name": "threads[uart_read,%d]" % workers,
+                        "ops_per_s": round(max(rounds // 10, 10) * workers /
+                                           elapsed),
+                        "errors": len(mixed)})
+    finally:
+        board.close()
+
+    # No log line may be lost or interleaved with another
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        CLogger.setup("bench", "info", path)
+
+        def logger(i):
+            for j in range(rounds):
+                CLogger.info("thread %d line %d", i, j)
+
+        elapsed = _run_threads(workers, logger)
+        CLogger.close()
+        with open(path) as F:
+            lines = F.read().splitlines()
+        logged = [l.split(" bench ", 1)[-1] for l in lines]
+        expected = set("thread %d line %d" % (i, j)
+                       for i in range(workers) for j in range(rounds))
+        results.append({"name": "threads[log,%d]" % workers,
+                        "msgs_per_s": round(rounds * workers / elapsed),
+                        "errors": len(expected.symmetric_difference(logged)) +
+                        len(logged) - len(set(logged))})
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.unlink(path)
+    return results
+
+
+def _python_events(samples, state):
+    """ Pin edge, threshold and rate checks of an application polling loop,
+    one sample at a time """
+
+    events = 0
+    for t, adc, pin in samples:
+        if pin != state["pin"]:
+            events += 1
+        if adc >= 600 and not state["above"] or \
+                adc <= 400 and state["above"]:
+            state["above"] = not state["above"]
+            events += 1
+        if abs(adc - state["adc"]) / (t - state["t"]) > 20000:
+            events += 1
+        state.update(pin=pin, adc=adc, t=t)
+    return events
+
+
+def bench_events(rounds=1000, blocks=(8, 64), rate=1000, latency_rounds=50):
+    """ Cost of evaluating a pin edge, a threshold and a rate subscription
+    per block of samples, against the same checks in a Python loop, and
+    the latency from a change on the slave to the callback """
+
+    import threading
+    import numpy as np
+    from pievents import EventMonitor
+
+    results = []
+    monitor = EventMonitor()
+    noop = lambda event: None
+    monitor.on_pin(noop)
+    monitor.on_threshold(noop, 400, 600)
+    monitor.on_rate(noop, 20000, 0.01)
+    for block in blocks:
+        ts = np.arange(block) / float(rate)
+        adc = (512 + np.arange(block) % 3).astype("u2")
+        pin = np.zeros(block, dtype="u1")
+        samples = zip(ts.tolist(), adc.tolist(), pin.tolist())
+        state = {"pin": 0, "above": False, "adc": 512, "t": -1.0}
+        results.append(summary("events[numpy,block=%d]" % block,
+                               timeit(monitor, ts, adc, pin, rounds=rounds)))
+        results.append(summary("events[python,block=%d]" % block,
+                               timeit(_python_events, samples, state,
+                                      rounds=rounds)))
+    monitor.stop()
+
+    pb = PiBlinker.setup(log_level="error", gpio="fake", i2c="fake")
+    try:
+        pb.i2c_open_file(0x04, 1)
+        bus = pb.i2c_device(0x04, 1).bus
+        fired = threading.Event()
+        latencies = []
+        changed = [0]
+
+        # Timed in the callback, a python 2 Event.wait polls with sleeps
+        def callback(event):
+            latencies.append(time.time() - changed[0])
+            fired.set()
+
+        monitor = pb.event_monitor(0x04, rate=rate, block=8)
+        monitor.on_pin(callback)
+        for i in range(latency_rounds):
+            fired.clear()
+            changed[0] = time.time()
+            bus.fake_state[0x04] = (512, (i + 1) & 1)
+            fired.wait(1)
+        monitor.stop()
+        pb.i2c_close(0x04)
+        results.append(summary("events[latency,%dHz,block=8]" % rate,
+                               latencies))
+    finally:
+        pb.gpio.close()
+    return results
+
+
+def save(results, path, rounds):
+    """ Write the results and a description of the machine as JSON, path -
+    writes to stdout """
+
+    import sys
+    import json
+    import platform
+
+    doc = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "host": platform.node(),
+                    "machine": platform.machine(),
+                    "python": platform.python_version(),
+                    "rounds": rounds},
+           "results": results}
+    if path == "-":
+        json.dump(doc, sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        with open(path, "w") as F:
+            json.dump(doc, F, indent=1, sort_keys=True)
+
+
+def _better(key):
+    """ 1 if a larger value of a metric is better, -1 if smaller is better
+    and 0 for metrics that only describe the run """
+
+    if key.endswith("_per_s") or key in ["achieved_hz", "saved"]:
+        return 1
+    if key.endswith(("_us", "_ms")) or key in ["seconds", "error_rate",
+                                                 "duty_error", "cpu", "busy",
+                                                 "overruns", "subprocesses",
+                                                 "errors"]:
+        return -1
+    return 0
+
+
+def compare(results, path, threshold=0.2):
+    """ Print the metrics that changed by more than threshold against the
+    results saved in path. Returns the number of regressions """
+
+    import json
+
+    with open(path) as F:
+        baseline = {r["name"]: r for r in json.load(F)["results"]}
+    regressions = 0
+    for r in results:
+        old = baseline.get(r["name"], {})
+        for key, value in sorted(r.items()):
+            better = _better(key)
+            if not better or not isinstance(old.get(key), (int, float)) or \
+                    not isinstance(value, (int, float)):
+                continue
+            if old[key]:
+                change = (value - old[key]) / float(abs(old[key]))
+            else:
+                # Anything appearing where there was none, i.e errors
+                change = float("inf") * cmp(value, 0) if value else 0
+            if abs(change) < threshold:
+                continue
+            verdict = "improved" if change * better > 0 else "REGRESSED"
+            regressions += verdict == "REGRESSED"
+            print "%-28s %-16s %12.1f -> %12.1f %+7.0f%% %s" % (
+                r["name"], key, old[key], value, 100 * change, verdict)
+    return regressions
+
+
+BENCHMARKS = {"gpio": lambda n: bench_gpio_write(("subprocess", "fake"), n),
+              "set_led": bench_set_led,
+              "blink": lambda n: bench_blink_timing(),
+              "log_rate": lambda n: bench_log_rate(),
+              "i2c": bench_i2c,
+              "registers": bench_registers,
+              "uart_rtt": lambda n: bench_uart_rtt(max(n // 5, 10)),
+              "daemon": lambda n: bench_daemon(max(n // 10, 10)),
+              "notify": lambda n: bench_notify(n // 10),
+              "led": lambda n: bench_led_writes(max(n // 100, 1)),
+              "log": bench_log_levels,
+              "sampler": lambda n: bench_sampler(),
+              "adc": lambda n: bench_adc(max(n // 10, 10)),
+              "sample_bus": bench_sample_bus,
+              "capture": lambda n: bench_capture(),
+              "io": lambda n: bench_io_engine(),
+              "uart": lambda n: bench_uart_protocols(),
+              "buttons": lambda n: bench_buttons(n // 10),
+              "service": bench_service,
+              "startup": lambda n: bench_startup(max(n // 100, 5)),
+              "bcast": lambda n: bench_bcast(max(n // 50, 10)),
+              "pwm": lambda n: bench_pwm(),
+              "metrics": bench_metrics,
+              "threads": bench_threads,
+              "events": lambda n: bench_events(n, latency_rounds=max(n // 20,
+                                                                      10))}
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--bench", help="Comma separated benchmarks "
+                        "from [all, %s]" % ", ".join(sorted(BENCHMARKS)),
+                        default="all")
+    parser.add_argument("-n", "--rounds", help="Number of rounds per "
+                        "benchmark", type=int, default=1000)
+    parser.add_argument("-j", "--json", help="Save the results as JSON to a "
+                        "file, - for stdout")
+    parser.add_argument("-c", "--compare", help="Compare against the JSON "
+                        "results of an earlier run, exit with an error on "
+                        "regressions")
+    parser.add_argument("-t", "--threshold", help="Relative change reported "
+                        "by --compare", type=float, default=0.2)
+    args = parser.parse_args()
+
+    selected = sorted(BENCHMARKS) if args.bench == "all" else \
+        args.bench.split(",")
+    results = []
+    for b in selected:
+        results += BENCHMARKS[b](args.rounds)
+    if args.json != "-":
+        report(results)
+    if args.json:
+        save(results, args.json, args.rounds)
+    if args.compare and compare(results, args.compare, args.threshold):
+        raise SystemExit(1)
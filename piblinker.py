@@ -10,26 +10,68 @@ __email__ = "Minos Galanakis"
 __project__ = "smartpi"
 __date__ = "01-06-2015"
 
-import io
+import os
+import atexit
 import time
-import fcntl
-import serial
+import ctypes
 import struct
-from subprocess import Popen, PIPE
-from colorlogger import CLogger
+import threading
+from collections import deque, OrderedDict
+from colorlogger import CLogger, log_internal
 from functools import wraps
-from pidaemon import start_daemon, kill_daemon, normal_start
-
-
-def blinker(color, period=0.2, times=3):
-    """ Decorator that allows modular output formating for PiLogger """
+import pimetrics
+
+# serial, fcntl, subprocess, piservice and pidaemon (daemon, RPi.GPIO) are
+# imported where they are used, so that logging only scripts and one shot
+# commands do not pay for them at startup
+
+# Instrumentation, see pimetrics. Label values are resolved once here so an
+# update costs a lock and an addition
+SUBPROCESSES = pimetrics.counter("smartpi_subprocesses_total",
+                                 "Shell commands spawned", ["source"])
+COMMAND_SECONDS = pimetrics.histogram("smartpi_command_seconds",
+                                      "Shell command run time", ["source"])
+GPIO_WRITES = pimetrics.counter("smartpi_gpio_writes_total",
+                                "GPIO pin levels written").labels()
+I2C_BYTES = pimetrics.counter("smartpi_i2c_bytes_total",
+                              "Bytes moved over I2C", ["direction"])
+I2C_ERRORS = pimetrics.counter("smartpi_i2c_errors_total",
+                               "Failed I2C transfers").labels()
+I2C_SECONDS = pimetrics.histogram("smartpi_i2c_seconds",
+                                  "I2C transfer latency").labels()
+UART_BYTES = pimetrics.counter("smartpi_uart_bytes_total",
+                               "Bytes moved over the UART", ["direction"])
+UART_ERRORS = pimetrics.counter("smartpi_uart_errors_total",
+                                "UART replies lost, corrupt or timed out"
+                                ).labels()
+UART_SECONDS = pimetrics.histogram("smartpi_uart_seconds",
+                                   "UART read latency").labels()
+QUEUE_DEPTH = pimetrics.gauge("smartpi_queue_depth",
+                              "Jobs waiting in a queue", ["queue"])
+_RUN_COUNT = SUBPROCESSES.labels("run")
+_RUN_SECONDS = COMMAND_SECONDS.labels("run")
+_I2C_TX, _I2C_RX = I2C_BYTES.labels("tx"), I2C_BYTES.labels("rx")
+_UART_TX, _UART_RX = UART_BYTES.labels("tx"), UART_BYTES.labels("rx")
+
+
+def blinker(color, period=0.2, times=3, level=None):
+    """ Decorator that allows modular output formating for PiLogger. When a
+    log level is set, messages filtered by CLogger will not blink the LED """
 
     def blinker_decorator(func):
         @wraps(func)
-        def func_wrapper(class_obj, message):
+        @log_internal
+        def func_wrapper(class_obj, message, *args):
+            if level and level not in CLogger.ENABLED:
+                return
+            # The LED service logs and blinks on behalf of its clients
+            if level and class_obj.client:
+                return class_obj.client.log(level, message % args if args
+                                            else message)
             # Blinke the LED before printing sdout
-            class_obj.blink(color, times, period)
-            return func(class_obj, color, message)
+            class_obj.notify(color, times, period)
+            return func(class_obj, color, message, *args)
+        log_internal(func)
         return func_wrapper
     return blinker_decorator
 
@@ -38,17 +80,838 @@ class PiBlinkerError(Exception):
     __module__ = 'exceptions'
 
 
+class GPIOBackend(object):
+    """ Base class for the drivers that PiBlinker uses to toggle GPIO pins.
+
+    A backend needs to be able to configure a BCM pin as an output and
+    write a logic level to it. Subclasses are free to keep any state they
+    need (open descriptors, line handles) between calls."""
+
+    name = None
+
+    def export(self, pin):
+        """ Configure a BCM pin as an output """
+        raise NotImplementedError
+
+    def write(self, pin, value):
+        """ Drive an exported pin to logic level value (0 or 1) """
+        raise NotImplementedError
+
+    def write_many(self, values):
+        """ Drive several pins in one operation, values maps pin to level.
+        Backends that can not batch fall back to one write per pin """
+        for pin, value in values.iteritems():
+            self.write(pin, value)
+
+    def close(self):
+        """ Release any resources held by the backend """
+        pass
+
+
+class WiringPiGPIO(GPIOBackend):
+    """ Legacy backend that shells out to the wiringPi gpio utility. Every
+    operation forks a shell and a gpio process. """
+
+    name = "wiringpi"
+
+    def __init__(self, gpio_cmd="gpio", base="/sys/class/gpio"):
+        self.gpio_cmd = gpio_cmd
+        self.base = base
+        self.exported = set()
+
+    def _configured(self, pin):
+        """ Check through sysfs if a pin is already an exported output and
+        drive it low, as a fresh export would """
+
+        path = os.path.join(self.base, "gpio%d" % pin)
+        try:
+            with open(os.path.join(path, "direction")) as F:
+                if F.read().strip() != "out":
+                    return False
+            with open(os.path.join(path, "value"), "w") as F:
+                F.write("0")
+        except IOError:
+            return False
+        return True
+
+    def export(self, pin):
+        if pin in self.exported:
+            return
+        if not self._configured(pin):
+            PiBlinker.run("%s export %d out" % (self.gpio_cmd, pin))
+            PiBlinker.run("%s -g mode %d out" % (self.gpio_cmd, pin))
+        self.exported.add(pin)
+
+    def write(self, pin, value):
+        PiBlinker.run("%s -g write %d %d" % (self.gpio_cmd, pin, value))
+
+
+class SysfsGPIO(GPIOBackend):
+    """ Native backend using the /sys/class/gpio interface. The value file of
+    each exported pin is kept open, so a write costs a single syscall. """
+
+    name = "sysfs"
+
+    def __init__(self, base="/sys/class/gpio"):
+        self.base = base
+        self.fds = {}
+
+    def _pin_path(self, pin, attr=None):
+        path = os.path.join(self.base, "gpio%d" % pin)
+        return os.path.join(path, attr) if attr else path
+
+    def _sysfs_write(self, path, data):
+        with open(path, "w") as F:
+            F.write(data)
+
+    def export(self, pin):
+        if pin in self.fds:
+            return
+        if not os.path.isdir(self._pin_path(pin)):
+            self._sysfs_write(os.path.join(self.base, "export"), str(pin))
+
+        # udev may need a few milliseconds to fix the attribute permissions
+        for _ in range(20):
+            try:
+                self._sysfs_write(self._pin_path(pin, "direction"), "out")
+                break
+            except IOError:
+                time.sleep(0.01)
+        else:
+            raise PiBlinkerError("Failed to configure GPIO %d" % pin)
+        self.fds[pin] = os.open(self._pin_path(pin, "value"), os.O_WRONLY)
+
+    def write(self, pin, value):
+        try:
+            fd = self.fds[pin]
+        except KeyError:
+            raise PiBlinkerError("GPIO %d has not been exported" % pin)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, "1" if value else "0")
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+class CharDevGPIO(GPIOBackend):
+    """ Native backend using the gpiochip character device (GPIO v1 ABI).
+
+    All exported pins are held by a single line handle, so the current
+    state of every pin is pushed to the kernel with one ioctl. """
+
+    name = "chardev"
+
+    # _IOWR(0xB4, 0x03, struct gpiohandle_request)
+    GPIO_GET_LINEHANDLE_IOCTL = 0xC16CB403
+    # _IOWR(0xB4, 0x09, struct gpiohandle_data)
+    GPIOHANDLE_SET_LINE_VALUES_IOCTL = 0xC040B409
+    GPIOHANDLE_REQUEST_OUTPUT = (1 << 1)
+    GPIOHANDLES_MAX = 64
+    HANDLE_REQUEST = struct.Struct("64I I 64B 32s I i")
+
+    def __init__(self, chip="/dev/gpiochip0", label="piblinker"):
+        import fcntl
+
+        self.ioctl = fcntl.ioctl
+        self.chip = chip
+        self.label = label
+        self.pins = []
+        self.values = []
+        self.handle = None
+
+    def _request_lines(self):
+        """ (Re)request a line handle covering every exported pin """
+
+        pad = self.GPIOHANDLES_MAX - len(self.pins)
+        req = bytearray(self.HANDLE_REQUEST.pack(*(
+            self.pins + [0] * pad +
+            [self.GPIOHANDLE_REQUEST_OUTPUT] +
+            self.values + [0] * pad +
+            [self.label, len(self.pins), 0])))
+
+        # The kernel refuses lines that are still held (EBUSY), release the
+        # previous handle before requesting the larger set
+        self.close()
+        chip_fd = os.open(self.chip, os.O_RDONLY)
+        try:
+            self.ioctl(chip_fd, self.GPIO_GET_LINEHANDLE_IOCTL, req)
+        except IOError as e:
+            raise PiBlinkerError("Failed to request GPIO lines: %s" % e)
+        finally:
+            os.close(chip_fd)
+        self.handle = self.HANDLE_REQUEST.unpack(bytes(req))[-1]
+
+    def _set_values(self):
+        data = struct.pack("64B", *(self.values +
+                           [0] * (self.GPIOHANDLES_MAX - len(self.values))))
+        self.ioctl(self.handle, self.GPIOHANDLE_SET_LINE_VALUES_IOCTL, data)
+
+    def export(self, pin):
+        if pin in self.pins:
+            return
+        if len(self.pins) == self.GPIOHANDLES_MAX:
+            raise PiBlinkerError("Too many GPIO lines requested")
+        self.pins.append(pin)
+        self.values.append(0)
+        try:
+            self._request_lines()
+        except PiBlinkerError:
+            # Get the lines exported so far back
+            self.pins.pop()
+            self.values.pop()
+            if self.pins:
+                self._request_lines()
+            raise
+
+    def _stage(self, pin, value):
+        try:
+            self.values[self.pins.index(pin)] = 1 if value else 0
+        except ValueError:
+            raise PiBlinkerError("GPIO %d has not been exported" % pin)
+
+    def write(self, pin, value):
+        self._stage(pin, value)
+        self._set_values()
+
+    def write_many(self, values):
+        for pin, value in values.iteritems():
+            self._stage(pin, value)
+        self._set_values()
+
+    def close(self):
+        if self.handle is not None:
+            os.close(self.handle)
+            self.handle = None
+
+
+class FakeGPIO(SysfsGPIO):
+    """ File backed stand-in for the sysfs backend, used for testing and
+    benchmarking without hardware. Each pin is a gpioN/value file in a
+    scratch directory and every write is recorded in history. """
+
+    name = "fake"
+
+    def __init__(self, base=None, history_len=4096):
+        import tempfile
+        from collections import deque
+
+        self.owns_base = base is None
+        super(FakeGPIO, self).__init__(base or tempfile.mkdtemp(
+                                       prefix="fakegpio"))
+        self.history = deque(maxlen=history_len)
+        self.writes = 0
+        self.batches = 0
+
+    def export(self, pin):
+        if pin in self.fds:
+            return
+        if not os.path.isdir(self._pin_path(pin)):
+            os.makedirs(self._pin_path(pin))
+        self._sysfs_write(self._pin_path(pin, "direction"), "out")
+        self._sysfs_write(self._pin_path(pin, "value"), "0")
+        self.fds[pin] = os.open(self._pin_path(pin, "value"), os.O_WRONLY)
+
+    def write(self, pin, value):
+        super(FakeGPIO, self).write(pin, value)
+        self.writes += 1
+        self.history.append((time.time(), pin, 1 if value else 0))
+
+    def write_many(self, values):
+        super(FakeGPIO, self).write_many(values)
+        self.batches += 1
+
+    def read(self, pin):
+        """ Read back the level stored for a pin """
+        with open(self._pin_path(pin, "value")) as F:
+            return int(F.read(1))
+
+    def close(self):
+        import shutil
+
+        super(FakeGPIO, self).close()
+        if self.owns_base:
+            shutil.rmtree(self.base, ignore_errors=True)
+
+
+GPIO_BACKENDS = {b.name: b for b in [WiringPiGPIO,
+                                      SysfsGPIO,
+                                      CharDevGPIO,
+                                      FakeGPIO]}
+
+
+def gpio_backend(backend="auto"):
+    """ Resolve a backend name (or instance) to a GPIOBackend object. Auto
+    prefers the character device, then sysfs and falls back to wiringPi """
+
+    if isinstance(backend, GPIOBackend):
+        return backend
+    if backend == "auto":
+        if os.path.exists("/dev/gpiochip0"):
+            backend = "chardev"
+        elif os.path.isdir("/sys/class/gpio"):
+            backend = "sysfs"
+        else:
+            backend = "wiringpi"
+    try:
+        return GPIO_BACKENDS[backend]()
+    except KeyError:
+        raise PiBlinkerError("GPIO backend %s is not supported, select from "
+                             "%s" % (backend, ", ".join(GPIO_BACKENDS)))
+
+
+class BlinkQueue(object):
+    """ Bounded queue of blink jobs drained by a background worker thread.
+
+    When the queue is full the overflow policy decides what happens:
+    drop_oldest: discard the oldest pending job
+    coalesce: merge the job into a pending job of the same color, or drop
+              the oldest pending job if there is none. Below maxsize every
+              job is queued
+    block: wait until the worker makes room """
+
+    POLICIES = ["drop_oldest", "coalesce", "block"]
+
+    def __init__(self, blink, maxsize=8, policy="coalesce"):
+        if policy not in self.POLICIES:
+            raise PiBlinkerError("Overflow policy %s is not supported, select"
+                                 " from %s" % (policy,
+                                               ", ".join(self.POLICIES)))
+        self.blink = blink
+        self.maxsize = maxsize
+        self.policy = policy
+        self.jobs = deque()
+        self.busy = False
+        self.running = True
+        self.cond = threading.Condition()
+        self.stats = {"queued": 0, "dropped": 0, "coalesced": 0, "done": 0}
+        QUEUE_DEPTH.labels("blink").set_function(self.pending)
+
+        self.worker = threading.Thread(target=self._drain,
+                                       name="BlinkQueue")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def put(self, color, times, period):
+        """ Schedule a blink job, never blocks unless the policy is block """
+
+        with self.cond:
+            if self.policy == "coalesce" and \
+                    len(self.jobs) >= self.maxsize and \
+                    [j for j in self.jobs if j[0] == color]:
+                self.stats["coalesced"] += 1
+                return False
+
+            while len(self.jobs) >= self.maxsize:
+                if self.policy == "block":
+                    self.cond.wait()
+                else:
+                    self.jobs.popleft()
+                    self.stats["dropped"] += 1
+
+            self.jobs.append((color, times, period))
+            self.stats["queued"] += 1
+            self.cond.notify_all()
+            return True
+
+    def _drain(self):
+        """ Worker loop """
+
+        while True:
+            with self.cond:
+                while not self.jobs and self.running:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                job = self.jobs.popleft()
+                self.busy = True
+                self.cond.notify_all()
+            try:
+                self.blink(*job)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.stats["done"] += 1
+                    self.cond.notify_all()
+
+    def pending(self):
+        """ Number of jobs waiting to be executed """
+
+        return len(self.jobs)
+
+    def join(self, timeout=None):
+        """ Wait until all pending jobs have been executed. Returns False if
+        the timeout expired first """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.jobs or self.busy:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def stop(self, drain=True):
+        """ Stop the worker, optionally executing the pending jobs first """
+
+        with self.cond:
+            if not drain:
+                self.stats["dropped"] += len(self.jobs)
+                self.jobs.clear()
+            self.running = False
+            self.cond.notify_all()
+        self.worker.join()
+
+
+# Register map of the dual mode firmware, name -> (address, struct format).
+# Values are big endian, see attiny85/attiny85_dual_mode.ino
+I2C_REGISTERS = OrderedDict([("word", (0x00, "H")),
+                             ("adc", (0x02, "H")),
+                             ("pin", (0x04, "B")),
+                             ("samples", (0x05, "I")),
+                             ("timestamp", (0x09, "I")),
+                             ("adc_ovs", (0x0D, "H")),
+                             ("version", (0x0F, "B"))])
+I2C_REG_SIZE = 0x10
+I2C_REG_VERSION = 1
+
+
+def read_registers(device, names=None):
+    """ Read registers of the firmware register map from an I2CDevice with
+    a single combined transaction: the address and length of the block
+    spanning them are written and the block read back without releasing
+    the bus. Returns a dictionary of name -> value, every register by
+    default.
+
+    The version register is always part of the block. Firmware without the
+    register map, or a TinyWireS that does not serve the block within the
+    combined transaction, answers with the muxed word instead. The version
+    then does not match, the block selection is cleared so later word
+    reads are not served stale register bytes, and PiBlinkerError is
+    raised """
+
+    names = names or I2C_REGISTERS.keys()
+    try:
+        regs = [(n,) + I2C_REGISTERS[n] for n in names]
+    except KeyError as e:
+        raise PiBlinkerError("Unknown register %s" % e)
+    version = I2C_REGISTERS["version"][0]
+    start = min(a for _, a, _ in regs)
+    size = version + 1 - start
+    data = device.transfer(struct.pack("BB", start, size), size)
+    if len(data) != size or ord(data[version - start]) != I2C_REG_VERSION:
+        try:
+            # A zero length block returns the slave to word reads
+            device.write(struct.pack("BB", 0, 0))
+        except (IOError, OSError):
+            pass
+        raise PiBlinkerError("Slave %d does not serve register map version "
+                             "%d, update its firmware" % (device.addr,
+                                                          I2C_REG_VERSION))
+    return {n: struct.unpack_from(">" + f, data, a - start)[0]
+            for n, a, f in regs}
+
+
+class I2CMsg(ctypes.Structure):
+    """ struct i2c_msg from linux/i2c.h """
+
+    _fields_ = [("addr", ctypes.c_uint16),
+                ("flags", ctypes.c_uint16),
+                ("len", ctypes.c_uint16),
+                ("buf", ctypes.POINTER(ctypes.c_uint8))]
+
+
+class I2CRdwrData(ctypes.Structure):
+    """ struct i2c_rdwr_ioctl_data from linux/i2c-dev.h """
+
+    _fields_ = [("msgs", ctypes.POINTER(I2CMsg)),
+                ("nmsgs", ctypes.c_uint32)]
+
+
+class I2CBus(object):
+    """ A single /dev/i2c-N descriptor shared by every slave on the bus.
+
+    Transfers use the I2C_RDWR ioctl, the slave address travels with every
+    message so there is no per slave address switch, and a write followed
+    by a read is executed as one combined (repeated start) transaction. """
+
+    I2C_RDWR = 0x0707
+    I2C_M_RD = 0x0001
+
+    def __init__(self, bus):
+        import fcntl
+
+        self.ioctl = fcntl.ioctl
+        self.bus = bus
+        self.fd = os.open("/dev/i2c-%d" % bus, os.O_RDWR)
+
+    def transfer(self, addr, write=None, read=0):
+        """ Write the bytes in write and then read read bytes from addr in a
+        single kernel call. Returns the bytes read """
+
+        msgs = []
+        if write:
+            wbuf = (ctypes.c_uint8 * len(write)).from_buffer_copy(write)
+            msgs.append(I2CMsg(addr, 0, len(write), wbuf))
+        if read:
+            rbuf = (ctypes.c_uint8 * read)()
+            msgs.append(I2CMsg(addr, self.I2C_M_RD, read, rbuf))
+        if not msgs:
+            return ""
+
+        data = I2CRdwrData((I2CMsg * len(msgs))(*msgs), len(msgs))
+        self.ioctl(self.fd, self.I2C_RDWR, data)
+        return bytes(bytearray(rbuf)) if read else ""
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FakeI2CBus(object):
+    """ In memory stand-in for I2CBus.
+
+    Slaves are registered with attach(addr, handler), where handler(write,
+    read) returns the read bytes of a transfer. Unregistered addresses get an
+    ATTINY85 emulation that returns the muxed adc/pin word of the slave
+    state in fake_state. Every transfer is counted in transfers. """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.handlers = {}
+        self.fake_state = {}
+        self.samples = {}
+        self.transfers = 0
+        self.closed = False
+
+    def attach(self, addr, handler):
+        self.handlers[addr] = handler
+
+    def _attiny(self, addr, write, read):
+        adc, pin = self.fake_state.get(addr, (512, 0))
+        adc &= 0x3FF
+        word = struct.pack(">H", adc | (0x8000 if pin else 0))
+        if not write:
+            return word[:read]
+        # A register block, then the muxed word as the firmware does
+        samples = self.samples[addr] = self.samples.get(addr, 0) + 1
+        regs = word + struct.pack(">HBIIHB", adc, 1 if pin else 0, samples,
+                                  int(time.time() * 1e6) & 0xFFFFFFFF,
+                                  adc << 2, I2C_REG_VERSION)
+        write = bytearray(write)
+        start = write[0] % I2C_REG_SIZE
+        size = write[1] if len(write) > 1 else I2C_REG_SIZE - start
+        block = (regs * (2 + size // I2C_REG_SIZE))[start:start + size]
+        return (block + word * read)[:read]
+
+    def transfer(self, addr, write=None, read=0):
+        if self.closed:
+            raise IOError("Bus %d is closed" % self.bus)
+        self.transfers += 1
+        handler = self.handlers.get(addr)
+        if handler is None:
+            return self._attiny(addr, write, read)
+        return handler(write, read)
+
+    def close(self):
+        self.closed = True
+
+
+class I2CDevice(object):
+    """ File like handle of one slave on a pooled bus. Transfers hold the
+    lock of the bus, slaves on other buses are not held up """
+
+    def __init__(self, pool, bus, addr, lock=None):
+        self.pool = pool
+        self.bus = bus
+        self.addr = addr
+        self.lock = lock or threading.Lock()
+
+    def transfer(self, write=None, read=0):
+        # time.time is an order of magnitude cheaper than piclock.monotonic
+        # and good enough for a histogram of microsecond transfers
+        start = time.time()
+        try:
+            with self.lock:
+                data = self.bus.transfer(self.addr, write, read)
+        except (IOError, OSError):
+            I2C_ERRORS.inc()
+            raise
+        I2C_SECONDS.observe(time.time() - start)
+        if write:
+            _I2C_TX.inc(len(write))
+        if read:
+            _I2C_RX.inc(len(data))
+        return data
+
+    def read(self, n):
+        return self.transfer(read=n)
+
+    def readinto(self, buf):
+        data = self.transfer(read=len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        self.transfer(write=data)
+        return len(data)
+
+    def close(self):
+        self.pool.release(self.bus.bus, self.addr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class I2CPool(object):
+    """ Opens one bus object per I2C bus and hands out slave handles keyed by
+    (bus, address). Every open of a slave takes a reference that close or
+    release gives back, the handle is dropped when its last reference is
+    released and a bus is closed when none of its slaves is held """
+
+    def __init__(self, bus_factory=I2CBus):
+        self.bus_factory = bus_factory
+        self.buses = {}
+        self.bus_locks = {}
+        self.devices = {}
+        self.refs = {}
+        self.lock = threading.Lock()
+
+    def open(self, bus, addr):
+        """ Return the handle of a slave, opening the bus if required """
+
+        with self.lock:
+            key = (bus, addr)
+            if key not in self.devices:
+                if bus not in self.buses:
+                    self.buses[bus] = self.bus_factory(bus)
+                    self.bus_locks[bus] = threading.Lock()
+                self.devices[key] = I2CDevice(self, self.buses[bus], addr,
+                                              self.bus_locks[bus])
+            self.refs[key] = self.refs.get(key, 0) + 1
+            return self.devices[key]
+
+    def release(self, bus, addr):
+        """ Give back a reference to a slave handle. Returns True when it was
+        the last one and the handle was dropped, closing the bus if none of
+        its slaves is held """
+
+        with self.lock:
+            key = (bus, addr)
+            if key not in self.refs:
+                return False
+            self.refs[key] -= 1
+            if self.refs[key]:
+                return False
+            del self.refs[key]
+            del self.devices[key]
+            if not [k for k in self.devices if k[0] == bus]:
+                with self.bus_locks.pop(bus):
+                    self.buses.pop(bus).close()
+            return True
+
+    def close(self):
+        """ Release every slave and close all buses """
+
+        with self.lock:
+            for bus, handle in self.buses.items():
+                with self.bus_locks[bus]:
+                    handle.close()
+            self.buses.clear()
+            self.bus_locks.clear()
+            self.devices.clear()
+            self.refs.clear()
+
+
+I2C_BUSES = {"dev": I2CBus, "fake": FakeI2CBus}
+
+
+class BinaryUART(object):
+    """ Host side of the framed binary UART protocol of the dual mode firmware.
+
+    A request is three bytes: 0xA5, the sequence number of the first frame
+    and the number of frames wanted. The board answers with a burst of 5
+    byte frames: 0x5A, sequence number, muxed word (pin state in the MSB,
+    10bit ADC) and the xor of the previous three bytes. Up to window
+    requests are kept in flight and frames are matched to them by sequence
+    number, so lost or stale frames are counted instead of misattributed.
+
+    SoftwareSerial on the ATTINY85 is half duplex and drops bytes that
+    arrive while it transmits. Keep window at 1 and use burst to amortize the
+    round trip, unless the board sits on a full duplex UART. """
+
+    CMD = 0xA5
+    SYNC = 0x5A
+    FRAME_LEN = 5
+    MAX_BURST = 32
+
+    def __init__(self, ser, window=1, burst=8, timeout=0.5):
+        if not 0 < burst <= self.MAX_BURST or window * burst > 255:
+            raise PiBlinkerError("Burst must be 1-%d and window * burst must "
+                                 "fit the 8bit sequence" % self.MAX_BURST)
+        self.ser = ser
+        self.timeout = timeout
+        self.window = window
+        self.burst = burst
+        self.seq = 0
+        self.rxbuf = bytearray()
+        self.stats = {"frames": 0, "lost": 0, "stale": 0, "corrupt": 0}
+
+    def _request(self, count):
+        """ Send a request, returns the sequence numbers it will produce """
+
+        seq = self.seq
+        self.seq = (self.seq + count) & 0xFF
+        self.ser.write(bytearray([self.CMD, seq, count]))
+        _UART_TX.inc(3)
+        return [(seq + i) & 0xFF for i in range(count)]
+
+    def _frames(self):
+        """ Parse the complete frames in the receive buffer """
+
+        buf = self.rxbuf
+        while len(buf) >= self.FRAME_LEN:
+            if buf[0] != self.SYNC:
+                del buf[0]
+                continue
+            seq, hbyte, lbyte, chk = buf[1:self.FRAME_LEN]
+            if seq ^ hbyte ^ lbyte != chk:
+                self.stats["corrupt"] += 1
+                UART_ERRORS.inc()
+                del buf[0]
+                continue
+            del buf[:self.FRAME_LEN]
+            yield seq, ((hbyte << 8) | lbyte) & 0x3FF, hbyte >> 7
+
+    def read(self, n):
+        """ Read n (adc, pin) samples. Frames that do not arrive within the
+        serial timeout are counted as lost and the samples collected so far
+        are returned """
+
+        # A port opened without timeout would block forever on a lost frame
+        saved = self.ser.timeout
+        if saved is None:
+            self.ser.timeout = self.timeout
+        start = time.time()
+        try:
+            return self._read(n)
+        finally:
+            UART_SECONDS.observe(time.time() - start)
+            if saved is None:
+                self.ser.timeout = saved
+
+    def _read(self, n):
+        samples = []
+        expected = deque()
+        req_ends = deque()
+        requested = 0
+        while len(samples) < n:
+            while len(req_ends) < self.window and requested < n:
+                seqs = self._request(min(self.burst, n - requested))
+                expected.extend(seqs)
+                req_ends.append(seqs[-1])
+                requested += len(seqs)
+
+            data = self.ser.read(max(self.ser.inWaiting(), 1))
+            if not data:
+                self.stats["lost"] += len(expected)
+                UART_ERRORS.inc(len(expected))
+                break
+            self.rxbuf.extend(data)
+            _UART_RX.inc(len(data))
+
+            for seq, adc, pin in self._frames():
+                if seq not in expected:
+                    self.stats["stale"] += 1
+                    continue
+                # Frames queued ahead of this one were lost
+                while True:
+                    head = expected.popleft()
+                    if req_ends and head == req_ends[0]:
+                        req_ends.popleft()
+                    if head == seq:
+                        break
+                    self.stats["lost"] += 1
+                    UART_ERRORS.inc()
+                samples.append((adc, pin))
+                self.stats["frames"] += 1
+        return samples
+
+
+class UARTSource(object):
+    """ Sample source reading the board over the binary UART protocol, so
+    ADCSampler can stream from a UART board like from an I2C channel """
+
+    def __init__(self, read_frame):
+        self.read_frame = read_frame
+
+    def readinto(self, buf):
+        try:
+            adc, pin = self.read_frame()
+        except PiBlinkerError as e:
+            raise IOError(str(e))
+        word = adc | (0x8000 if pin else 0)
+        buf[0] = chr(word >> 8)
+        buf[1] = chr(word & 0xFF)
+        return 2
+
+
 class PiBlinker():
 
+    # Connection to the LED service when running in client mode
+    client = None
+
+    # Concurrency: the LED pins are one channel set guarded by led_lock,
+    # every I2C bus (see I2CPool) and UART port has a lock of its own, so
+    # threads using different devices never wait on each other. Log level
+    # checks read an immutable set and take no lock, see CLogger. setup
+    # must not race with other calls
+    led_lock = threading.RLock()
+    uart_locks = {}
+
+    # The exit handler is registered by the first setup and releases what
+    # the latest setup and started services hold
+    exit_registered = False
+
     def __init__(self):
         raise ValueError('PiBlinker is not meant to be instantiated')
 
+    @classmethod
+    def _at_exit(self):
+        """ Stop the background threads and release the I2C handles """
+
+        if getattr(self, "exporter", None):
+            self.exporter.stop()
+        if getattr(self, "pwm", None):
+            self.pwm.stop()
+        # Let pending notifications play out before the interpreter exits
+        if getattr(self, "blink_queue", None):
+            self.blink_queue.stop()
+        if getattr(self, "i2c_pool", None):
+            self.i2c_pool.close()
+
     @classmethod
     def setup(self,
               log_level="ver_debug",
               log_label="PiBlinker",
               log_path=None,
-              log_colors=None):
+              log_colors=None,
+              log_file_opts=None,
+              gpio="auto",
+              i2c="dev",
+              notify="sync",
+              queue_size=8,
+              overflow="coalesce",
+              service=None,
+              bcast="legacy",
+              bcast_rate=10):
 
         """ Module Init."""
         # Map a color to GPIO.BCM PIN
@@ -60,14 +923,70 @@ class PiBlinker():
                      "CYAN": [18, 27],
                      "WHITE": [17, 18, 27]}
 
-        self.last_mode = 0
-        # Configure the GPIO ports in hardware
-        map(self.run, [(x % v) for n in self.LEDS.values()
-                       for v in n
-                       for x in ["gpio export %d out",
-                                 "gpio -g mode %d out"]])
+        # Framebuffer of the LED pins, bit N holds the state of BCM pin N.
+        # Pins are configured as outputs driven low, so start with all off
+        self.pin_state = 0
+        self.PINS = sorted(set([v for n in self.LEDS.values() for v in n]))
+        self.LED_MASKS = {k: sum([1 << v for v in n])
+                          for k, n in self.LEDS.iteritems()}
+        self.pin_writes = {"requested": 0, "written": 0, "batches": 0}
+
+        # Stop the PWM scheduler of a previous setup before its backend goes
+        if getattr(self, "pwm", None):
+            self.pwm.stop()
+        self.pwm = None
+
+        # In client mode the LED service owns the pins, GPIO is not touched
+        if self.client:
+            self.client.close()
+            self.client = None
+        if service:
+            from piservice import LEDClient, ServiceError
+            try:
+                self.client = LEDClient(service)
+            except ServiceError as e:
+                raise PiBlinkerError(str(e))
+
+        # Configure every GPIO port once, backends skip pins that are
+        # already configured. Release the backend of a previous setup
+        previous = getattr(self, "gpio", None)
+        if previous and previous is not gpio:
+            previous.close()
+        self.gpio = None if self.client else gpio_backend(gpio)
+        if self.gpio:
+            map(self.gpio.export, self.PINS)
+
+        if not self.exit_registered:
+            atexit.register(self._at_exit)
+            self.exit_registered = True
+
+        # Slaves are keyed by (bus, address) and share one handle per bus
+        if getattr(self, "i2c_pool", None):
+            self.i2c_pool.close()
+        try:
+            self.i2c_pool = I2CPool(I2C_BUSES[i2c])
+        except KeyError:
+            raise PiBlinkerError("I2C mode %s is not supported, select from "
+                                 "%s" % (i2c, ", ".join(I2C_BUSES)))
+        self.i2c_devices = self.i2c_pool.devices
+
+        # In async mode log calls return immediately and blink in background
+        if getattr(self, "blink_queue", None):
+            self.blink_queue.stop(drain=False)
+        if notify == "async" and not self.client:
+            self.blink_queue = BlinkQueue(self.blink, queue_size, overflow)
+        elif notify in ["sync", "async"]:
+            self.blink_queue = None
+        else:
+            raise PiBlinkerError("Notification mode %s is not supported"
+                                 % notify)
 
-        self.i2c_devices = {}
+        # Encoding used by led_bcast
+        from pibcast import bcast_encoding
+        try:
+            self.bcast = bcast_encoding(bcast, self.LED_MASKS, bcast_rate)
+        except ValueError as e:
+            raise PiBlinkerError(str(e))
 
         # Assosiate log levels with colors
         if not log_colors:
@@ -79,14 +998,20 @@ class PiBlinker():
                           "ver_debug": "GREEN"}
 
         # Initalise the logging module
-        CLogger.setup(log_label, log_level, log_path, log_colors)
+        CLogger.setup(log_label, log_level, log_path, log_colors,
+                      file_opts=log_file_opts)
         return self
 
     @staticmethod
     def run(cmd):
         """ Execute shell command in detached mdoe."""
+        from subprocess import Popen, PIPE
+
+        start = time.time()
+        _RUN_COUNT.inc()
         proc = Popen([cmd], stdout=PIPE, stderr=PIPE, shell=True)
         ret, err = proc.communicate()
+        _RUN_SECONDS.observe(time.time() - start)
         if err:
             # ignore warnings in error stream
             if "Warning" in err:
@@ -100,6 +1025,8 @@ class PiBlinker():
     def set_led(self, led, mode):
         """ Set an LED to one of the supported states."""
 
+        if self.client:
+            return self.client.set_led(led, mode)
         if led not in self.LEDS.keys():
             return
         mlist = {"ON": 1, "OFF": 0, "Toggle": -1}
@@ -110,17 +1037,110 @@ class PiBlinker():
         except KeyError:
             raise PiBlinkerError("Mode %s is not reognised" % mode)
 
-        # Toggle the led if required
-        led_state = md if md >= 0 else (self.last_mode + 1) % 2
+        # Toggle the led if required, a led is on when all its pins are set
+        mask = self.LED_MASKS[led]
+        with self.led_lock:
+            if md < 0:
+                led_state = 0 if self.led_state(led) else 1
+            else:
+                led_state = md
+
+            target = (self.pin_state | mask) if led_state else \
+                (self.pin_state & ~mask)
+            self.pin_writes["requested"] += len(self.LEDS[led])
+            self.apply_pins(target)
+
+    @classmethod
+    def led_state(self, led):
+        """ Return 1 if all the pins of an LED are currently on."""
+
+        mask = self.LED_MASKS[led]
+        return 1 if (self.pin_state & mask) == mask else 0
 
-        # Toggle the GPIO
-        map(self.run, ["gpio -g write %d %d" % (led_no, led_state) for
-                       led_no in self.LEDS[led]])
-        self.last_mode = led_state
+    @classmethod
+    def apply_pins(self, target):
+        """ Bring the pins to the state described by the target bitmask.
+        Only pins that differ from the cached state are written, and all of
+        them are handed to the backend in a single batch."""
+
+        with self.led_lock:
+            changed = self.pin_state ^ target
+            values = {p: (target >> p) & 1 for p in self.PINS
+                      if (changed >> p) & 1}
+            if not values:
+                return
+            # While PWM runs the scheduler owns the pins, on/off is full duty
+            if self.pwm:
+                self.pwm.set_duty(values)
+                self.pin_state = target
+                return
+            self.gpio.write_many(values)
+            self.pin_state = target
+            self.pin_writes["written"] += len(values)
+            self.pin_writes["batches"] += 1
+        GPIO_WRITES.inc(len(values))
+
+    @classmethod
+    def pwm_start(self, frequency=100, spin=0.0):
+        """ Drive the LED pins with software PWM, see pipwm.SoftPWM. LEDs
+        that are on keep full brightness """
+        from pipwm import SoftPWM
+
+        if self.client:
+            raise PiBlinkerError("PWM is not available in client mode")
+        with self.led_lock:
+            self.pwm_stop()
+            pwm = SoftPWM(self.gpio.write_many, self.PINS, frequency, spin)
+            pwm.set_duty({p: (self.pin_state >> p) & 1 for p in self.PINS})
+            self.pwm = pwm.start()
+        return pwm
+
+    @classmethod
+    def pwm_stop(self):
+        """ Stop the PWM scheduler and return the pins to on/off control """
+
+        with self.led_lock:
+            if not self.pwm:
+                return
+            self.pwm.stop()
+            self.pwm = None
+            self.gpio.write_many({p: (self.pin_state >> p) & 1
+                                  for p in self.PINS})
+        GPIO_WRITES.inc(len(self.PINS))
+
+    @classmethod
+    def pwm_stats(self):
+        """ Return the jitter and load statistics of the PWM scheduler """
+
+        return self.pwm.report() if self.pwm else {}
+
+    @classmethod
+    def set_color(self, red, green, blue, fade=0, gamma=2.2):
+        """ Show an arbitrary color, channels range from 0 to 255. The color
+        is reached linearly over fade seconds. Duty cycles are gamma
+        corrected so that brightness steps look even. Starts the PWM
+        scheduler if it is not running """
+
+        with self.led_lock:
+            if not self.pwm:
+                self.pwm_start()
+            duties = {}
+            for color, value in zip(["RED", "GREEN", "BLUE"],
+                                    [red, green, blue]):
+                level = (min(max(value, 0), 255) / 255.0) ** gamma
+                for pin in self.LEDS[color]:
+                    duties[pin] = level
+                    self.pin_state = self.pin_state | (1 << pin) if value \
+                        else self.pin_state & ~(1 << pin)
+            self.pwm.set_duty(duties, fade)
 
     @classmethod
     def blink(self, led, times, delay=1):
-        """ Blink an LED n number of times."""
+        """ Blink an LED n number of times. In client mode the service
+        plays the pattern and the call returns immediately."""
+
+        if self.client:
+            return self.client.blink(led, times, delay)
 
         # Make sure led is uppercase
         led = led.upper()
@@ -136,6 +1156,55 @@ class PiBlinker():
             count += 1
         self.set_led(led, mode)
 
+    @classmethod
+    def notify(self, led, times, delay=1):
+        """ Blink an LED to notify the user. Blocks the caller in sync mode
+        and queues the job to the background worker in async mode."""
+
+        if self.client:
+            self.client.blink(led, times, delay)
+        elif self.blink_queue:
+            self.blink_queue.put(led, times, delay)
+        else:
+            self.blink(led, times, delay)
+
+    @classmethod
+    def notify_stats(self):
+        """ Return the counters of the notification queue """
+
+        if not self.blink_queue:
+            return {}
+        stats = dict(self.blink_queue.stats)
+        stats["pending"] = self.blink_queue.pending()
+        return stats
+
+    @classmethod
+    def flush(self, timeout=None):
+        """ Wait until all queued notifications have been displayed. In
+        client mode wait until the service has received all requests """
+
+        if self.client:
+            return self.client.sync(timeout) is not None
+        if self.blink_queue:
+            return self.blink_queue.join(timeout)
+        return True
+
+    @classmethod
+    def metrics(self):
+        """ Return a snapshot of the process metrics, see pimetrics """
+
+        return pimetrics.snapshot()
+
+    @classmethod
+    def metrics_export(self, path, interval=15):
+        """ Keep a Prometheus text file of the process metrics updated every
+        interval seconds. Returns the running pimetrics.MetricsExporter """
+
+        if getattr(self, "exporter", None):
+            self.exporter.stop()
+        self.exporter = pimetrics.MetricsExporter(path, interval).start()
+        return self.exporter
+
     @classmethod
     def led_print(self, color, text):
         """ Print a debug message and notify the user with the LED."""
@@ -144,25 +1213,28 @@ class PiBlinker():
 
     @classmethod
     def led_bcast(self, data):
-        """ Broadcast a number through led brings """
-        import re
+        """ Broadcast a text, such as an IP address, through the LEDs using
+        the encoding selected at setup, see pibcast """
 
-        # separate the numbers in the string ie 192.168.3.1 will become array
-        data = map(int, filter(lambda x: x, re.split(r'\D', data)))
+        if self.client:
+            return self.client.bcast(data)
+        self.play(self.bcast.encode(data.strip()))
 
-        # Separate the digits to a three color tuple
-        data = map(lambda x: (x/100, (x % 100)/10, (x % 10)), data)
-
-        for red_cnt, green_cnt, blue_cnt in data:
-            self.blink("GREEN", 1, 1)
-            time.sleep(0.5)
-            self.blink("RED", red_cnt, 0.2)
-            time.sleep(0.5)
-            self.blink("GREEN", green_cnt, 0.2)
-            time.sleep(0.5)
-            self.blink("BLUE", blue_cnt, 0.2)
-            time.sleep(0.5)
-            self.blink("RED", 1, 1)
+    @classmethod
+    def play(self, schedule):
+        """ Show a schedule of (duration, pin mask) frames. Frames start on
+        an absolute time grid so sleep overshoot does not accumulate."""
+        from piclock import monotonic
+
+        deadline = monotonic()
+        for duration, mask in schedule:
+            with self.led_lock:
+                self.pin_writes["requested"] += len(self.PINS)
+                self.apply_pins(mask)
+            deadline += duration
+            delay = deadline - monotonic()
+            if delay > 0:
+                time.sleep(delay)
 
     @classmethod
     @blinker("RED")
@@ -189,36 +1261,37 @@ class PiBlinker():
         print"|%s|> %s" % (color, message)
 
     @classmethod
-    @blinker("RED")
+    @blinker("RED", level="error")
     def error(self, *args):
         """ Print a debug message and notify the user with the LED."""
 
-        CLogger.error(args[-1])
+        CLogger.error(*args[1:])
 
     @classmethod
-    @blinker("BLUE")
+    @blinker("BLUE", level="info")
     def info(self, *args):
         """ Print a debug message and notify the user with the LED."""
 
-        CLogger.info(args[-1])
+        CLogger.info(*args[1:])
 
     @classmethod
-    @blinker("RED")
+    @blinker("RED", level="warning")
     def warning(self, *args):
         """ Print a debug message and notify the user with the LED."""
 
-        CLogger.warning(args[-1])
+        CLogger.warning(*args[1:])
 
     @classmethod
-    @blinker("GREEN")
+    @blinker("GREEN", level="debug")
     def debug(self, *args):
         """ Print a debug message and notify the user with the LED."""
 
-        CLogger.debug(args[-1])
+        CLogger.debug(*args[1:])
 
     @classmethod
     def uart_open(self, port="/dev/ttyAMA0", baud=9600, time_out=None):
         """Open the Serial Channel"""
+        import serial
 
         try:
             self.uart = serial.Serial(port, baud, timeout=time_out)
@@ -226,6 +1299,13 @@ class PiBlinker():
             print "** Failed to initialize serial, check your port.** "
             raise ValueError
 
+    @classmethod
+    def uart_lock(self):
+        """ Lock of the open port, held for a whole request and its reply so
+        that threads sharing the port never read each other's answers """
+
+        return self.uart_locks.setdefault(self.uart.port, threading.RLock())
+
     @classmethod
     def uart_activate(self):
         """ Spam UART port untill it receives an ACK """
@@ -235,9 +1315,10 @@ class PiBlinker():
         # Test with a not supported command
         t_char = "O"
         while True:
-            self.uart.write(t_char)
-            if self.uart.inWaiting():
-                repl = self.uart.read(2)
+            with self.uart_lock():
+                self.uart.write(t_char)
+                repl = self.uart.read(2) if self.uart.inWaiting() else None
+            if repl is not None:
                 if repl == "OK":
                     print "UART Activated"
                 else:
@@ -259,67 +1340,131 @@ class PiBlinker():
         cmd = {"ADC": "2", "PIN": "1"}
 
         if target in cmd.keys():
-            self.uart.write(cmd[target])
-            return self.uart.readline()[:-1]
+            start = time.time()
+            with self.uart_lock():
+                self.uart.write(cmd[target])
+                reply = self.uart.readline()
+            _UART_TX.inc()
+            UART_SECONDS.observe(time.time() - start)
+            _UART_RX.inc(len(reply))
+            # readline returns what it got so far when the timeout expires
+            if not reply.endswith("\n"):
+                UART_ERRORS.inc()
+            return reply[:-1]
+
+    @classmethod
+    def uart_read_frame(self):
+        """Read ADC and PIN with a single binary exchange"""
+
+        samples = self.uart_stream(1, burst=1)
+        if not samples:
+            raise PiBlinkerError("No reply from the UART board")
+        return samples[0]
+
+    @classmethod
+    def uart_stream(self, count, window=1, burst=8):
+        """Read count (adc, pin) samples using the binary protocol, keeping up
+        to window requests of burst samples in flight"""
+
+        with self.uart_lock():
+            if getattr(self, "uart_bin", None) is None or \
+                    self.uart_bin.ser is not self.uart or \
+                    (self.uart_bin.window, self.uart_bin.burst) != \
+                    (window, burst):
+                self.uart_bin = BinaryUART(self.uart, window, burst)
+            return self.uart_bin.read(count)
 
     @classmethod
     def uart_close(self):
         """Close the serial channel"""
-        self.uart.close()
+        with self.uart_lock():
+            self.uart.close()
 
     @classmethod
     def i2c_open_file(self, slave_id, bus=1):
         """Open the I2C channel for raw byte comms"""
 
-        if slave_id in self.i2c_devices.keys():
+        if (bus, slave_id) in self.i2c_devices:
             print "Device %d already open" % slave_id
             return
 
-        # Open the file descriptors
-        read_ch = io.open("/dev/i2c-"+str(bus), "rb", buffering=0)
-        write_ch = io.open("/dev/i2c-"+str(bus), "wb", buffering=0)
+        dev = self.i2c_pool.open(bus, slave_id)
+        # return the handles if the user wants to manually drive them, the
+        # same file like object serves both directions
+        return (dev, dev)
 
-        # Set the register
-        fcntl.ioctl(read_ch, 0x0703, slave_id)
-        fcntl.ioctl(write_ch, 0x0703, slave_id)
-
-        # store it to an internal dict
-        self.i2c_devices[slave_id] = (read_ch, write_ch)
-        # return the file descriptors if the user wants to manually drive them
-        return (read_ch, write_ch)
+    @classmethod
+    def i2c_device(self, slave_id, bus=None):
+        """Return the handle of an open slave. Bus can be omitted when the
+        address is only open on one bus"""
+
+        if bus is not None:
+            return self.i2c_devices[(bus, slave_id)]
+        matches = [d for (b, a), d in self.i2c_devices.items()
+                   if a == slave_id]
+        if len(matches) != 1:
+            if matches:
+                raise PiBlinkerError("Device %d is open on several buses, "
+                                     "select one" % slave_id)
+            raise KeyError(slave_id)
+        return matches[0]
 
     @classmethod
-    def i2c_write_as(self, slave_id, format, data):
+    def i2c_write_as(self, slave_id, format, data, bus=None):
         """Write the data formatted using struct pack,
         Format needs to be specified"""
 
         try:
-            wb_file = self.i2c_devices[slave_id][1]
-            wb_file.write(struct.pack(format, data))
+            self.i2c_device(slave_id, bus).write(struct.pack(format, data))
         except KeyError:
             print "Device %d does not exist" % slave_id
         except struct.error:
             print "Pack Error make sure the data fits the format structure"
+        except PiBlinkerError:
+            raise
         except:
             raise IOError
 
     @classmethod
-    def i2c_read_as(self, slave_id, format, byte_no):
+    def i2c_read_as(self, slave_id, format, byte_no, bus=None):
         try:
-            rb_file = self.i2c_devices[slave_id][0]
-            return struct.unpack(format, rb_file.read(byte_no))
+            return struct.unpack(format,
+                                 self.i2c_device(slave_id, bus).read(byte_no))
         except KeyError:
             print "Device %d does not exit" % slave_id
         except struct.error:
             print "Pack Error make sure the data fits the format structure"
+        except PiBlinkerError:
+            raise
         except:
             raise IOError
 
     @classmethod
-    def i2c_close(self, slave_id):
+    def i2c_transfer(self, slave_id, write=None, read=0, bus=None):
+        """Write then read in a single combined transaction, i.e select a
+        register and read its contents without releasing the bus"""
+
+        try:
+            return self.i2c_device(slave_id, bus).transfer(write, read)
+        except KeyError:
+            raise PiBlinkerError("Device %d does not exist" % slave_id)
+
+    @classmethod
+    def i2c_read_registers(self, slave_id, names=None, bus=None):
+        """Read registers of the firmware register map in one transaction,
+        i.e the whole sensor state. Returns a dictionary of name -> value,
+        see I2C_REGISTERS"""
+
+        try:
+            return read_registers(self.i2c_device(slave_id, bus), names)
+        except KeyError:
+            raise PiBlinkerError("Device %d does not exist" % slave_id)
+
+    @classmethod
+    def i2c_close(self, slave_id, bus=None):
         """Close the file descriptors associated to the slave channel"""
         try:
-            self.i2c_devices.pop(slave_id)
+            self.i2c_device(slave_id, bus).close()
         except KeyError:
             print "Device %d does not exit" % slave_id
 
@@ -332,16 +1477,100 @@ class PiBlinker():
         return (adc_val, pin_val)
 
     @classmethod
-    def i2c_read_adc(self, slave_id):
+    def i2c_read_adc(self, slave_id, bus=None):
         """Reads data as returned from a 10Bit ADC sampling operation"""
 
-        return self.demux(self.i2c_read_as(slave_id, '>H', 2)[0])[0]
+        return self.demux(self.i2c_read_as(slave_id, '>H', 2, bus)[0])[0]
 
     @classmethod
-    def i2c_read_pin(self, slave_id):
+    def i2c_read_pin(self, slave_id, bus=None):
         """Reads data as returned from a 10Bit ADC sampling operation"""
 
-        return self.demux(self.i2c_read_as(slave_id, '>H', 2)[0])[1]
+        return self.demux(self.i2c_read_as(slave_id, '>H', 2, bus)[0])[1]
+
+    @classmethod
+    def i2c_sampler(self, slave_id, rate=1000, capacity=65536, block=64,
+                    bus=None, sink=None):
+        """Start streaming ADC/PIN samples from an open slave channel into a
+        ring buffer, and to sink if given (i.e CaptureWriter.write).
+        Returns the running pisampler.ADCSampler"""
+
+        from pisampler import ADCSampler
+
+        try:
+            dev = self.i2c_device(slave_id, bus)
+        except KeyError:
+            raise PiBlinkerError("Device %d does not exist" % slave_id)
+        return ADCSampler(dev, rate, capacity, block, sink=sink).start()
+
+    @classmethod
+    def uart_sampler(self, rate=100, capacity=4096, block=8, sink=None):
+        """Start streaming ADC/PIN samples from the open UART port, as
+        i2c_sampler. Every sample is a binary protocol exchange, a 9600 baud
+        link sustains around 120Hz"""
+
+        from pisampler import ADCSampler
+
+        return ADCSampler(UARTSource(self.uart_read_frame), rate, capacity,
+                          block, sink=sink).start()
+
+    @classmethod
+    def event_monitor(self, slave_id=0x04, bus=None, uart=False, rate=100,
+                      block=8, workers=1):
+        """Sample a slave channel (or the UART port when uart is set) and
+        return a pievents.EventMonitor evaluating its samples. Subscribe
+        with on_pin, on_threshold and on_rate instead of polling the board,
+        callbacks run on the monitor threads and receive a pievents.Event.
+        Events are evaluated once per block of samples, so they arrive
+        within block / rate seconds. stop() ends the sampling"""
+
+        from pievents import EventMonitor
+
+        monitor = EventMonitor(workers)
+        if uart:
+            sampler = self.uart_sampler(rate, block=block)
+        else:
+            sampler = self.i2c_sampler(slave_id, rate, 4096, block, bus)
+        return monitor.attach(sampler)
+
+    @classmethod
+    def sample_bus(self, path=None):
+        """ Map the samples the daemon publishes read only, see
+        pisampler.SharedSampleRing. No I2C access is needed to read them """
+
+        from pisampler import SharedSampleRing, SAMPLE_BUS_PATH
+
+        path = path or SAMPLE_BUS_PATH
+        bus = getattr(self, "bus_reader", None)
+        if bus is None or bus.path != path:
+            try:
+                self.bus_reader = SharedSampleRing.open(path)
+            except (IOError, OSError, ValueError) as e:
+                raise PiBlinkerError("Sample bus %s is not available: %s"
+                                     % (path, e))
+        return self.bus_reader
+
+    @classmethod
+    def bus_read(self, path=None):
+        """ Latest published (timestamp, adc, pin) sample, or None """
+
+        from pisampler import SampleBusError
+
+        try:
+            return self.sample_bus(path).latest()
+        except SampleBusError as e:
+            raise PiBlinkerError(str(e))
+
+    @classmethod
+    def bus_window(self, n=None, path=None):
+        """ View of the latest n published samples, oldest first """
+
+        from pisampler import SampleBusError
+
+        try:
+            return self.sample_bus(path).window(n)
+        except SampleBusError as e:
+            raise PiBlinkerError(str(e))
 
     @classmethod
     def test_hardware(self):
@@ -370,7 +1599,8 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--test", help="Test Hardware, select from [all,\
-                    i2c, led, log, poll, uart]", dest='test')
+                    i2c, led, log, poll, events, stream, uart]",
+                        dest='test')
     parser.add_argument("-a", "--activate", help="Activate UART mode\
                         after a reset", action="store_true")
     parser.add_argument("-d", "--daemon", help="Start a button monitor daemon",
@@ -382,6 +1612,8 @@ if __name__ == "__main__":
                         dest='button1')
     parser.add_argument("-b2", "--button2", help="Bind script to button2",
                         dest='button2')
+    parser.add_argument("-c", "--config", help="Read button bindings for\
+                        the daemon from an INI file", dest='config')
     parser.add_argument("-u", "--user", help="Select different user\
                         to run script as")
     parser.add_argument("-s", "--sudopass", help="Set optional sudo password\
@@ -390,22 +1622,82 @@ if __name__ == "__main__":
                         action="store_true")
     parser.add_argument("-i", "--blinkip", help="increase output verbosity",
                         action="store_true")
+    parser.add_argument("-S", "--service", help="Socket of the LED service.\
+                        The daemon serves it, other commands run as its\
+                        client", nargs="?", const=True)
+    parser.add_argument("-e", "--encoding", help="Select the LED broadcast\
+                        encoding from [legacy, dense]", default="legacy")
+    parser.add_argument("-g", "--gpio", help="Select GPIO backend from [auto,\
+                        chardev, sysfs, wiringpi, fake]", default="auto")
+    parser.add_argument("-P", "--publish", help="Sample the ADC in the\
+                        daemon and publish it to a shared memory bus",
+                        nargs="?", const=True)
+    parser.add_argument("-C", "--capture", help="Record ADC and PIN samples\
+                        to binary capture files, see picapture",
+                        dest='capture')
+    parser.add_argument("-r", "--rate", help="Sample rate of --capture in Hz",
+                        type=float, default=1000)
+    parser.add_argument("--capture-size", help="Size in MB at which capture\
+                        files rotate", type=int, default=256)
+    parser.add_argument("-m", "--metrics", help="Keep a Prometheus text\
+                        file of the metrics at this path", dest='metrics')
 
     args = parser.parse_args()
     mode = 0
-    pb = PiBlinker.setup()
-    if args.daemon or args.nodaemon:
+    if args.service is True:
+        from piservice import SERVICE_PATH
+        args.service = SERVICE_PATH
+    if args.publish is True:
+        from pisampler import SAMPLE_BUS_PATH
+        args.publish = SAMPLE_BUS_PATH
+    daemon_mode = args.daemon or args.nodaemon
+    # The daemon owns the LEDs, do not set them up here as well
+    pb = None if daemon_mode else PiBlinker.setup(gpio=args.gpio,
+                                                  service=args.service,
+                                                  bcast=args.encoding)
+    if pb and args.metrics:
+        pb.metrics_export(args.metrics)
+    if daemon_mode:
+        from pidaemon import start_daemon, normal_start
+
         arguments = [args.button1, args.button2, args.user, args.sudopass]
+        options = {"config": args.config, "gpio": args.gpio,
+                   "metrics": args.metrics}
+        if args.service:
+            options["service"] = args.service
+        if args.publish:
+            options["publish"] = args.publish
         if args.nodaemon:
-            normal_start(*arguments)
+            normal_start(*arguments, **options)
         else:
-            start_daemon(*arguments)
+            start_daemon(*arguments, **options)
     elif args.kill:
+        from pidaemon import kill_daemon
+
         kill_daemon()
     elif args.activate:
         pb.uart_activate()
     elif args.blinkip:
         pb.led_bcast(pb.run("hostname -I"))
+    elif args.capture:
+        from picapture import CaptureWriter
+
+        writer = CaptureWriter(args.capture, args.rate,
+                               args.capture_size * 1024 * 1024,
+                               meta={"slave": 0x04, "bus": 1})
+        pb.i2c_open_file(0x04, 1)
+        sampler = pb.i2c_sampler(0x04, rate=args.rate, sink=writer.write)
+        try:
+            while True:
+                time.sleep(1)
+                print "| Records: %d | File: %s | Rate: %.1f Hz |" % (
+                    writer.stats["records"], writer.filename,
+                    sampler.achieved_rate()), sampler.stats
+        except KeyboardInterrupt:
+            pass
+        sampler.stop()
+        writer.close()
+        pb.i2c_close(0x04)
     elif args.test:
         if args.test == "all":
             pb.red("This is important")
@@ -433,6 +1725,9 @@ if __name__ == "__main__":
 
             # read a 2byte uint8_t variable
             print "|DEC ADC|>", pb.i2c_read_as(04, ">H", 2)[0]
+
+            # read the register map in one transaction
+            print "|REGISTERS|>", pb.i2c_read_registers(0x04)
             pb.i2c_close(0x04)
 
         elif args.test == "poll":
@@ -449,6 +1744,42 @@ if __name__ == "__main__":
                 pass
             pb.i2c_close(0x04)
 
+        elif args.test == "events":
+
+            def show(event):
+                print "| %-7s | ADC: %4d | PIN: %d | %s |" % (
+                    event.kind, event.adc, event.pin,
+                    "%.0f counts/s" % event.value if event.kind == "rate"
+                    else "t=%.3f" % event.t)
+
+            pb.i2c_open_file(0x04, 1)
+            monitor = pb.event_monitor(0x04, rate=200)
+            monitor.on_pin(show, debounce=4)
+            monitor.on_threshold(show, 480, 544)
+            monitor.on_rate(show, 2000)
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            monitor.stop()
+            pb.i2c_close(0x04)
+
+        elif args.test == "stream":
+
+            pb.i2c_open_file(0x04, 1)
+            sampler = pb.i2c_sampler(0x04, rate=1000)
+            try:
+                while True:
+                    time.sleep(1)
+                    t, adc, pin = sampler.ring.latest()
+                    print "| ADC:", adc, "| PIN: ", pin, "| Rate: %.1f Hz |"\
+                        % sampler.achieved_rate(), sampler.stats
+            except KeyboardInterrupt:
+                pass
+            sampler.stop()
+            pb.i2c_close(0x04)
+
         elif args.test == "uart":
             pb.uart_open()
             print "ADC:", pb.uart_read("ADC")
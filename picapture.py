@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""picapture.py: Binary recordings of ADC/PIN samples. Fixed width records
+   are written in large blocks to size rotated files and read back as
+   NumPy memory maps, sliced by time through a sparse timestamp index"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import os
+import re
+import json
+import time
+import glob
+import numpy as np
+from piclock import monotonic
+
+CAPTURE_MAGIC = "PICAP001"
+# Records are packed and little endian whatever the machine writing them
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("adc", "<u2"), ("pin", "u1")])
+# Headers are padded to a multiple of this many bytes
+HEADER_ALIGN = 64
+# Records per entry of the sparse timestamp index
+INDEX_STRIDE = 4096
+
+
+def part_path(path, part):
+    """ Name of part number part of a capture, capture.cap becomes
+    capture.0000.cap, capture.0001.cap ... """
+
+    root, ext = os.path.splitext(path)
+    return "%s.%04d%s" % (root, part, ext)
+
+
+def _header(meta):
+    """ Magic, the header length as 8 hex digits and the metadata as JSON,
+    padded with spaces """
+
+    text = json.dumps(meta, sort_keys=True)
+    size = len(CAPTURE_MAGIC) + 8 + len(text) + 1
+    size += -size % HEADER_ALIGN
+    return ("%s%08x%s\n" % (CAPTURE_MAGIC, size, text)).ljust(size)
+
+
+def read_header(fp):
+    """ Return (metadata, header length) of an open capture file """
+
+    head = fp.read(len(CAPTURE_MAGIC) + 8)
+    if not head.startswith(CAPTURE_MAGIC):
+        raise ValueError("%s is not a capture file" % fp.name)
+    size = int(head[len(CAPTURE_MAGIC):], 16)
+    meta = json.loads(fp.read(size - len(head)))
+    return meta, size
+
+
+class CaptureWriter(object):
+    """ Writes (timestamp, adc, pin) samples to a capture.
+
+    Samples are copied into a preallocated block of block records, which
+    is written with a single call when full or when flush_interval seconds
+    passed since the last write. A part is closed and the next one started
+    when it would grow over max_bytes (0 disables rotation). Each part is a
+    standalone file: its header records the record layout, the sample rate,
+    the part number and the wall clock and monotonic time it was started.
+    The sparse timestamp index of a part is saved next to it when it is
+    closed. """
+
+    def __init__(self, path, rate=0, max_bytes=256 * 1024 * 1024,
+                 block=65536, flush_interval=5.0, meta=None):
+        self.path = path
+        self.rate = rate
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.meta = meta or {}
+        self.buf = np.zeros(block, dtype=RECORD_DTYPE)
+        self.fill = 0
+        self.part = -1
+        self.fp = None
+        self.stats = {"records": 0, "bytes": 0, "blocks": 0, "parts": 0}
+        self._open()
+
+    def _open(self):
+        self.part += 1
+        self.filename = part_path(self.path, self.part)
+        meta = dict(self.meta)
+        meta.update({"dtype": RECORD_DTYPE.descr,
+                     "rate": self.rate,
+                     "part": self.part,
+                     "started": time.time(),
+                     "monotonic": monotonic(),
+                     "index_stride": INDEX_STRIDE})
+        if os.path.exists(self.filename + ".idx.npy"):
+            os.unlink(self.filename + ".idx.npy")
+        self.fp = open(self.filename, "wb")
+        self.fp.write(_header(meta))
+        self.size = self.fp.tell()
+        self.records = 0
+        self.index = []
+        self.flushed = monotonic()
+        self.stats["parts"] += 1
+
+    def _close_part(self):
+        self.fp.close()
+        np.save(self.filename + ".idx.npy",
+                np.array(self.index, dtype="<f8"))
+
+    def write(self, ts, adc, pin):
+        """ Append arrays of samples """
+
+        n = len(ts)
+        done = 0
+        while done < n:
+            take = min(n - done, len(self.buf) - self.fill)
+            dst = self.buf[self.fill:self.fill + take]
+            dst["t"] = ts[done:done + take]
+            dst["adc"] = adc[done:done + take]
+            dst["pin"] = pin[done:done + take]
+            self.fill += take
+            done += take
+            if self.fill == len(self.buf):
+                self.flush()
+        if self.fill and monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered records """
+
+        records = self.buf[:self.fill]
+        self.fill = 0
+        self.flushed = monotonic()
+        while len(records):
+            room = len(records)
+            if self.max_bytes:
+                room = (self.max_bytes - self.size) // RECORD_DTYPE.itemsize
+                if room <= 0 and self.records:
+                    self._close_part()
+                    self._open()
+                    continue
+                room = max(room, 1)
+            chunk = records[:room]
+            # Every INDEX_STRIDE'th record of the part is indexed
+            first = -self.records % INDEX_STRIDE
+            self.index.extend(chunk["t"][first::INDEX_STRIDE].tolist())
+            self.fp.write(chunk.tostring())
+            nbytes = len(chunk) * RECORD_DTYPE.itemsize
+            self.size += nbytes
+            self.records += len(chunk)
+            self.stats["records"] += len(chunk)
+            self.stats["bytes"] += nbytes
+            records = records[room:]
+        self.fp.flush()
+        self.stats["blocks"] += 1
+
+    def close(self):
+        """ Write the pending records and close the current part """
+
+        if self.fp:
+            self.flush()
+            self._close_part()
+            self.fp = None
+
+
+class Capture(object):
+    """ Read only view of one capture file. records is a numpy.memmap of
+    the file, nothing is read until it is sliced, so opening a file of any
+    size is instant. A record cut short by an interrupted write is
+    ignored. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as F:
+            self.meta, offset = read_header(F)
+        self.dtype = np.dtype([(str(n), str(t)) for n, t in
+                               self.meta["dtype"]])
+        count = (os.path.getsize(path) - offset) // self.dtype.itemsize
+        if count:
+            self.records = np.memmap(path, self.dtype, "r", offset, (count,))
+        else:
+            self.records = np.zeros(0, self.dtype)
+        self.stride = self.meta.get("index_stride", INDEX_STRIDE)
+        self._index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def index(self):
+        """ Timestamp of every stride'th record. Loaded from the file saved
+        by the writer, or read from the records of parts still being
+        written, touching a page per entry """
+
+        if self._index is None:
+            expected = (len(self.records) + self.stride - 1) // self.stride
+            try:
+                index = np.load(self.path + ".idx.npy")
+            except (IOError, ValueError):
+                index = None
+            if index is None or len(index) != expected:
+                index = np.array(self.records["t"][::self.stride])
+            self._index = index
+        return self._index
+
+    def _position(self, t, side):
+        """ Record number of timestamp t, as numpy.searchsorted """
+
+        block = max(np.searchsorted(self.index, t, side) - 1, 0)
+        lo = block * self.stride
+        hi = min(lo + 2 * self.stride, len(self.records))
+        return lo + np.searchsorted(self.records["t"][lo:hi], t, side)
+
+    def between(self, t0=None, t1=None):
+        """ Records with t0 <= t < t1 as a view of the file """
+
+        lo = 0 if t0 is None else self._position(t0, "left")
+        hi = len(self.records) if t1 is None else \
+            self._position(t1, "left")
+        return self.records[lo:hi]
+
+    def span(self):
+        """ (first, last) timestamp of the file, None if it is empty """
+
+        if not len(self.records):
+            return None
+        return float(self.records["t"][0]), float(self.records["t"][-1])
+
+
+class CaptureSet(object):
+    """ The parts of a rotated capture read as one recording. Slices within
+    a part are views of its file, slices spanning parts are copied """
+
+    def __init__(self, paths):
+        self.parts = [Capture(p) for p in paths]
+
+    def __len__(self):
+        return sum(len(p) for p in self.parts)
+
+    def between(self, t0=None, t1=None):
+        """ Records with t0 <= t < t1 """
+
+        chunks = []
+        for part in self.parts:
+            span = part.span()
+            if span is None or (t1 is not None and span[0] >= t1) or \
+                    (t0 is not None and span[1] < t0):
+                continue
+            chunks.append(part.between(t0, t1))
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return np.zeros(0, RECORD_DTYPE)
+        return np.concatenate(chunks)
+
+    def span(self):
+        spans = [s for s in (p.span() for p in self.parts) if s]
+        if not spans:
+            return None
+        return spans[0][0], spans[-1][1]
+
+
+def open_capture(path):
+    """ Open a capture by the path given to CaptureWriter, reading all its
+    parts, or a single part file """
+
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(root) + r"\.\d{4}" + re.escape(ext) + "$")
+    parts = sorted(p for p in glob.glob("%s.*%s" % (root, ext))
+                   if pattern.match(p))
+    if parts:
+        return CaptureSet(parts)
+    return Capture(path)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""piclock.py: Monotonic clock shared by the PiBlinker modules. Python 2
+   lacks time.monotonic so clock_gettime is called through ctypes"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import time
+import ctypes
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _clock_gettime():
+    """ Build a monotonic() function out of librt's clock_gettime """
+
+    try:
+        librt = ctypes.CDLL("librt.so.1", use_errno=True)
+    except OSError:
+        # find_library runs helper processes, only use it as a fallback
+        from ctypes.util import find_library
+        librt = ctypes.CDLL(find_library("rt"), use_errno=True)
+    gettime = librt.clock_gettime
+    gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        """ Seconds since an arbitrary point, never jumps backwards """
+        ts = _timespec()
+        gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    try:
+        monotonic = _clock_gettime()
+    except (OSError, AttributeError):
+        # Non Linux systems, accept wall clock jumps
+        monotonic = time.time
@@ -12,38 +12,84 @@ __date__ = "20-06-2015"
 
 import os
 import time
-import daemon
-from signal import SIGTERM
-from daemon.pidfile import PIDLockFile
-from collections import namedtuple
-from subprocess import Popen, PIPE
-import RPi.GPIO as GPIO
+import fcntl
+import select
+import struct
+import threading
+import traceback
+from ConfigParser import ConfigParser
+from Queue import Queue, Full
+from signal import SIGTERM, SIGKILL
+from collections import namedtuple, deque
+from subprocess import Popen
+from piclock import monotonic
+from piservice import LEDService, SERVICE_PATH
+from colorlogger import CLogger
+import pimetrics
+
+ACTIONS = pimetrics.counter("smartpi_actions_total",
+                            "Button actions by outcome", ["outcome"])
+ACTION_SECONDS = pimetrics.histogram("smartpi_action_seconds",
+                                     "Button press to action end latency"
+                                     ).labels()
+ACTIONS_KILLED = pimetrics.counter("smartpi_actions_killed_total",
+                                   "Action commands killed at their "
+                                   "deadline").labels()
+SUBPROCESSES = pimetrics.counter("smartpi_subprocesses_total",
+                                 "Shell commands spawned", ["source"])
+COMMAND_SECONDS = pimetrics.histogram("smartpi_command_seconds",
+                                      "Shell command run time", ["source"])
+QUEUE_DEPTH = pimetrics.gauge("smartpi_queue_depth",
+                              "Jobs waiting in a queue", ["queue"])
+_ACTION_COUNT = SUBPROCESSES.labels("action")
+_ACTION_RUN_SECONDS = COMMAND_SECONDS.labels("action")
+
+# daemon and RPi.GPIO are imported where they are used, so that the button
+# engine and the action dispatcher can be used and benchmarked without them
 
 def normal_start(f1=None,
                  f2=None,
                  user=None,
                  sudopass=None,
-                 pid_file="/tmp/piblinker_daemon.pid"):
+                 pid_file="/tmp/piblinker_daemon.pid",
+                 config=None,
+                 gpio="auto",
+                 service=SERVICE_PATH,
+                 metrics=None,
+                 publish=None):
     """ Wrapper utility function to call Daemon Class"""
 
     pid_file_path = pid_file
     if os.path.isfile(pid_file_path):
         print "PiDaemon Already Running, Restarting"
-    PiDaemon(f1, f2, user, sudopass)
+    PiDaemon(f1, f2, user, sudopass, config=config, gpio=gpio,
+             service=service, metrics=metrics, publish=publish)
 
 def start_daemon(f1=None,
                  f2=None,
                  user=None,
                  sudopass=None,
-                 pid_file="/tmp/piblinker_daemon.pid"):
+                 pid_file="/tmp/piblinker_daemon.pid",
+                 config=None,
+                 gpio="auto",
+                 service=SERVICE_PATH,
+                 metrics=None,
+                 publish=None):
     """ Wrapper utility function to call Daemon Class"""
 
     pid_file_path = pid_file
     if os.path.isfile(pid_file_path):
         print "PiDaemon Already Running, Restarting"
 
+    import daemon
+    from daemon.pidfile import PIDLockFile
+
+    # The daemon changes its working directory, resolve the path first
+    config = os.path.abspath(config) if config else None
+    metrics = os.path.abspath(metrics) if metrics else None
     with daemon.DaemonContext(pidfile=PIDLockFile(pid_file_path)):
-        PiDaemon(f1, f2, user, sudopass)
+        PiDaemon(f1, f2, user, sudopass, config=config, gpio=gpio,
+                 service=service, metrics=metrics, publish=publish)
 
 
 def kill_daemon(pid_file="/tmp/piblinker_daemon.pid"):
@@ -59,18 +105,505 @@ def kill_daemon(pid_file="/tmp/piblinker_daemon.pid"):
         pass
 
 
+class ActionDispatcher(object):
+    """ Runs button actions on a bounded pool of worker threads.
+
+    A press is rejected when its button already has limit actions queued or
+    running (single flight by default) or when the queue is full. Every
+    action gets an execution deadline, shell commands started by the action
+    are killed when it expires. Python code can not be preempted, actions
+    that overrun are reported as timed out once they return. The latency
+    from the press to the start and to the end of every action is
+    recorded. """
+
+    def __init__(self, workers=2, queue_size=8, timeout=60, limits=None,
+                 history=100):
+        self.queue = Queue(queue_size)
+        self.timeout = timeout
+        self.limits = limits or {}
+        self.active = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.history = deque(maxlen=history)
+        self.stats = {"submitted": 0, "busy": 0, "rejected": 0,
+                      "completed": 0, "failed": 0, "timed_out": 0}
+        QUEUE_DEPTH.labels("actions").set_function(self.queue.qsize)
+        self.workers = [threading.Thread(target=self._work,
+                                         name="ActionWorker%d" % i)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, button, action, pressed=None):
+        """ Queue an action for a button press, returns False if dropped """
+
+        pressed = monotonic() if pressed is None else pressed
+        with self.lock:
+            if self.active.get(button, 0) >= self.limits.get(button, 1):
+                self.stats["busy"] += 1
+                ACTIONS.labels("busy").inc()
+                return False
+            try:
+                self.queue.put_nowait((button, action, pressed))
+            except Full:
+                self.stats["rejected"] += 1
+                ACTIONS.labels("rejected").inc()
+                return False
+            self.active[button] = self.active.get(button, 0) + 1
+            self.stats["submitted"] += 1
+        return True
+
+    def deadline(self):
+        """ Deadline of the action running on the calling thread, if any """
+
+        return getattr(self.local, "deadline", None)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            button, action, pressed = job
+            started = monotonic()
+            self.local.deadline = started + self.timeout \
+                if self.timeout else None
+            outcome = "completed"
+            try:
+                action()
+            except Exception as e:
+                CLogger.error("Action of button %s failed: %r\n%s", button,
+                              e, traceback.format_exc().rstrip())
+                outcome = "failed"
+            finished = monotonic()
+            if outcome == "completed" and self.local.deadline and \
+                    finished > self.local.deadline:
+                outcome = "timed_out"
+            self.local.deadline = None
+
+            with self.lock:
+                self.active[button] -= 1
+                self.stats[outcome] += 1
+                ACTIONS.labels(outcome).inc()
+                ACTION_SECONDS.observe(finished - pressed)
+                self.history.append({"button": button,
+                                     "outcome": outcome,
+                                     "press_to_start": started - pressed,
+                                     "press_to_finish": finished - pressed})
+
+    def latencies(self):
+        """ Return the recorded per action latencies, oldest first """
+
+        with self.lock:
+            return list(self.history)
+
+    def stop(self):
+        """ Let the workers finish the queued actions and exit """
+
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class QueueEdgeSource(object):
+    """ Edge source fed from other threads through inject(). Used as the
+    fake source in tests and benchmarks """
+
+    def __init__(self, pins=()):
+        self.events = deque()
+        self.cond = threading.Condition()
+
+    def inject(self, pin, level, t=None):
+        """ Queue an edge of pin to level, timestamped now unless t is set """
+
+        with self.cond:
+            self.events.append((pin, level, monotonic() if t is None else t))
+            self.cond.notify()
+
+    def read_events(self, timeout=None):
+        """ Wait up to timeout seconds for edges, returns [(pin, level, t)] """
+
+        with self.cond:
+            if not self.events:
+                self.cond.wait(timeout)
+            events, self.events = list(self.events), deque()
+        return events
+
+    def close(self):
+        pass
+
+
+class RPiGPIOEdgeSource(QueueEdgeSource):
+    """ Edge source driven by RPi.GPIO callbacks, without bouncetime """
+
+    def __init__(self, pins=()):
+        import RPi.GPIO as GPIO
+
+        super(RPiGPIOEdgeSource, self).__init__(pins)
+        self.GPIO = GPIO
+        self.pins = list(pins)
+        for pin in self.pins:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self._edge)
+
+    def _edge(self, pin):
+        self.inject(pin, self.GPIO.input(pin))
+
+    def close(self):
+        for pin in self.pins:
+            self.GPIO.remove_event_detect(pin)
+
+
+class SysfsEdgeSource(object):
+    """ Edge source watching /sys/class/gpio value files with epoll """
+
+    def __init__(self, pins=(), base="/sys/class/gpio"):
+        self.base = base
+        self.epoll = select.epoll()
+        self.fds = {}
+        for pin in pins:
+            path = os.path.join(base, "gpio%d" % pin)
+            if not os.path.isdir(path):
+                self._write(os.path.join(base, "export"), str(pin))
+            self._write(os.path.join(path, "direction"), "in")
+            self._write(os.path.join(path, "edge"), "both")
+            fd = os.open(os.path.join(path, "value"),
+                         os.O_RDONLY | os.O_NONBLOCK)
+            # Consume the initial state so only new edges are reported
+            os.read(fd, 8)
+            self.epoll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+            self.fds[fd] = pin
+
+    @staticmethod
+    def _write(path, data):
+        with open(path, "w") as F:
+            F.write(data)
+
+    def read_events(self, timeout=None):
+        events = []
+        for fd, _ in self.epoll.poll(-1 if timeout is None else timeout):
+            t = monotonic()
+            os.lseek(fd, 0, os.SEEK_SET)
+            events.append((self.fds[fd], int(os.read(fd, 8)[:1]), t))
+        return events
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = {}
+        self.epoll.close()
+
+
+class CharDevEdgeSource(object):
+    """ Edge source using line events of the gpiochip character device """
+
+    # _IOWR(0xB4, 0x04, struct gpioevent_request)
+    GPIO_GET_LINEEVENT_IOCTL = 0xC030B404
+    GPIOHANDLE_REQUEST_INPUT = (1 << 0)
+    GPIOEVENT_REQUEST_BOTH_EDGES = 0x3
+    GPIOEVENT_EVENT_RISING_EDGE = 0x1
+    EVENT_REQUEST = struct.Struct("I I I 32s i")
+    EVENT_DATA = struct.Struct("Q I 4x")
+
+    def __init__(self, pins=(), chip="/dev/gpiochip0", label="pidaemon"):
+        self.epoll = select.epoll()
+        self.fds = {}
+        chip_fd = os.open(chip, os.O_RDONLY)
+        try:
+            for pin in pins:
+                req = bytearray(self.EVENT_REQUEST.pack(
+                    pin, self.GPIOHANDLE_REQUEST_INPUT,
+                    self.GPIOEVENT_REQUEST_BOTH_EDGES, label, 0))
+                fcntl.ioctl(chip_fd, self.GPIO_GET_LINEEVENT_IOCTL, req)
+                fd = self.EVENT_REQUEST.unpack(bytes(req))[-1]
+                self.epoll.register(fd, select.EPOLLIN)
+                self.fds[fd] = pin
+        finally:
+            os.close(chip_fd)
+
+    def read_events(self, timeout=None):
+        events = []
+        size = self.EVENT_DATA.size
+        for fd, _ in self.epoll.poll(-1 if timeout is None else timeout):
+            t = monotonic()
+            data = os.read(fd, 16 * size)
+            for off in range(0, len(data) - size + 1, size):
+                _, edge = self.EVENT_DATA.unpack_from(data, off)
+                events.append((self.fds[fd],
+                               1 if edge == self.GPIOEVENT_EVENT_RISING_EDGE
+                               else 0, t))
+        return events
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = {}
+        self.epoll.close()
+
+
+EDGE_SOURCES = {"chardev": CharDevEdgeSource,
+                "sysfs": SysfsEdgeSource,
+                "rpigpio": RPiGPIOEdgeSource,
+                "fake": QueueEdgeSource}
+
+
+def edge_source(kind, pins):
+    """ Create an edge source for pins. Auto prefers the character device,
+    then sysfs and falls back to RPi.GPIO callbacks """
+
+    if kind == "auto":
+        if os.path.exists("/dev/gpiochip0"):
+            kind = "chardev"
+        elif os.path.isdir("/sys/class/gpio"):
+            kind = "sysfs"
+        else:
+            kind = "rpigpio"
+    try:
+        return EDGE_SOURCES[kind](pins)
+    except KeyError:
+        raise ValueError("Edge source %s is not supported, select from %s"
+                         % (kind, ", ".join(EDGE_SOURCES)))
+
+
+class Button(object):
+    """ Debounce and gesture state machine of a single button.
+
+    An edge is accepted once the level has been stable for debounce
+    seconds. Gestures are press, long_press and double_press. A press is
+    reported as soon as it can not turn into another bound gesture: on the
+    press itself when only press is bound, on release when long_press is
+    bound, and double_press seconds after release when double_press is
+    bound. """
+
+    GESTURES = ["press", "long_press", "double_press"]
+
+    def __init__(self, name, pin, actions, active_high=True, debounce=0.02,
+                 long_press=0.8, double_press=0.3):
+        self.name = name
+        self.pin = pin
+        self.actions = actions
+        self.active = 1 if active_high else 0
+        self.debounce = debounce
+        self.long_press = long_press
+        self.double_press = double_press
+
+        self.raw = self.stable = 1 - self.active
+        self.raw_t = 0
+        self.press_t = None
+        self.release_t = None
+        self.long_fired = False
+        self.waiting_double = False
+        self.consumed = False
+
+    def edge(self, level, t):
+        """ Record a raw edge """
+
+        self.raw = level
+        self.raw_t = t
+
+    def poll(self, now):
+        """ Advance the state machine, returns [(gesture, time of press)] """
+
+        gestures = []
+        if self.raw != self.stable and now - self.raw_t >= self.debounce:
+            self.stable = self.raw
+            if self.stable == self.active:
+                self._pressed(self.raw_t, gestures)
+            else:
+                self._released(self.raw_t, gestures)
+
+        if self.stable == self.active and "long_press" in self.actions and \
+                not self.long_fired and not self.consumed and \
+                now - self.press_t >= self.long_press:
+            self.long_fired = True
+            gestures.append(("long_press", self.press_t))
+
+        if self.waiting_double and now - self.release_t >= self.double_press:
+            self.waiting_double = False
+            gestures.append(("press", self.press_t))
+        return gestures
+
+    def _pressed(self, t, gestures):
+        self.long_fired = False
+        self.consumed = False
+        if self.waiting_double and t - self.release_t < self.double_press:
+            self.waiting_double = False
+            self.consumed = True
+            gestures.append(("double_press", t))
+        elif "long_press" not in self.actions and \
+                "double_press" not in self.actions:
+            self.consumed = True
+            gestures.append(("press", t))
+        self.press_t = t
+
+    def _released(self, t, gestures):
+        if self.long_fired or self.consumed:
+            return
+        self.release_t = t
+        if "double_press" in self.actions:
+            self.waiting_double = True
+        else:
+            gestures.append(("press", self.press_t))
+
+    def deadline(self):
+        """ Next time poll() needs to run without a new edge, or None """
+
+        deadlines = []
+        if self.raw != self.stable:
+            deadlines.append(self.raw_t + self.debounce)
+        if self.stable == self.active and "long_press" in self.actions and \
+                not self.long_fired and not self.consumed:
+            deadlines.append(self.press_t + self.long_press)
+        if self.waiting_double:
+            deadlines.append(self.release_t + self.double_press)
+        return min(deadlines) if deadlines else None
+
+
+class ButtonEngine(object):
+    """ Reads edges from an edge source, runs the button state machines and
+    dispatches the resulting gestures through a table precomputed from the
+    button bindings. dispatch(name, action, press_time) is called for every
+    bound gesture, such as ActionDispatcher.submit """
+
+    def __init__(self, buttons, source, dispatch):
+        self.buttons = {b.pin: b for b in buttons}
+        self.source = source
+        self.dispatch = dispatch
+        self.table = {(b.pin, g): (b.name, a)
+                      for b in buttons for g, a in b.actions.iteritems()}
+        self.stats = {"edges": 0, "gestures": 0}
+        self.running = False
+        self.thread = None
+
+    def step(self, timeout=None):
+        """ Process one batch of edges and the expired timers """
+
+        deadlines = [d for d in [b.deadline() for b in
+                                 self.buttons.itervalues()] if d is not None]
+        if deadlines:
+            wait = max(0, min(deadlines) - monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        for pin, level, t in self.source.read_events(timeout):
+            if pin in self.buttons:
+                self.buttons[pin].edge(level, t)
+                self.stats["edges"] += 1
+
+        now = monotonic()
+        for pin, button in self.buttons.iteritems():
+            for gesture, t in button.poll(now):
+                name, action = self.table.get((pin, gesture), (None, None))
+                if action:
+                    self.stats["gestures"] += 1
+                    self.dispatch(name, action, t)
+
+    def run(self):
+        """ Process events until stop() is called """
+
+        self.running = True
+        while self.running:
+            # Wake up periodically to notice stop requests
+            self.step(0.5)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="ButtonEngine")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.source.close()
+
+
+def load_buttons(path, resolve):
+    """ Read button bindings from an INI file. Every [button:<name>] section
+    needs a pin and binds press, long_press and/or double_press to an
+    action. resolve(value) turns a binding into a callable. Engine wide
+    timings live in an optional [buttons] section, in milliseconds:
+
+    [buttons]
+    debounce_ms = 20
+    long_press_ms = 800
+    double_press_ms = 300
+
+    [button:power]
+    pin = 6
+    press = reboot
+    long_press = shutdown
+    active = high
+    """
+
+    config = ConfigParser()
+    if not config.read(path):
+        raise ValueError("Button configuration %s can not be read" % path)
+
+    def timing(option, default):
+        if config.has_option("buttons", option):
+            return config.getfloat("buttons", option) / 1000.0
+        return default
+
+    debounce = timing("debounce_ms", 0.02)
+    long_press = timing("long_press_ms", 0.8)
+    double_press = timing("double_press_ms", 0.3)
+
+    buttons = []
+    for section in config.sections():
+        if not section.startswith("button:"):
+            continue
+        actions = {g: resolve(config.get(section, g))
+                   for g in Button.GESTURES if config.has_option(section, g)}
+        active = config.get(section, "active") \
+            if config.has_option(section, "active") else "high"
+        buttons.append(Button(section.split(":", 1)[1],
+                              config.getint(section, "pin"), actions,
+                              active != "low", debounce, long_press,
+                              double_press))
+    return buttons
+
+
 class PiDaemon(object):
 
-    def __init__(self, method1=None, method2=None, user=None, sudopass=None):
+    def __init__(self, method1=None, method2=None, user=None, sudopass=None,
+                 workers=2, queue_size=8, timeout=60, limits=None,
+                 config=None, source="auto", gpio="auto",
+                 service=SERVICE_PATH, metrics=None, metrics_interval=15,
+                 publish=None, publish_rate=1000, slave=0x04, bus=1):
         """ Initialize the a bakcground running daemon class that maps python
         methods or native binaries to callbacks. When a non callable method
-        is detected it will wrap it around the script calling function """
-
-        # Configure the GPIO
-        self.button_map = {5: "button1", 6: "button2"}
-        map(self._setup_button, self.button_map)
-        self.colors = namedtuple('Colors', 'red green blue')(17, 18, 27)
-        self._setup_led()
+        is detected it will wrap it around the script calling function.
+        Actions run on a pool of workers threads, see ActionDispatcher.
+        Buttons are read from the config file if given, otherwise pins 5 and
+        6 are bound to method1 and method2, see load_buttons. The daemon
+        is the only owner of the LEDs and serves them to other processes on
+        the service socket, see piservice. When metrics is set a Prometheus
+        text file is kept up to date there, see pimetrics. When publish is
+        set the daemon samples the ADC slave at publish_rate and shares the
+        samples with other processes through a memory mapped ring at that
+        path, see pisampler.SharedSampleRing """
+
+        # piblinker imports this module, import it when it is complete
+        from piblinker import PiBlinker
+        import RPi.GPIO as GPIO
+
+        self.dispatcher = ActionDispatcher(workers, queue_size, timeout,
+                                           limits)
+
+        # Configure the GPIO, feedback patterns play in the background
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        self.leds = PiBlinker.setup(log_level="info", log_label="PiDaemon",
+                                    gpio=gpio, notify="async")
+        self.colors = namedtuple('Colors', 'red green blue')("RED", "GREEN",
+                                                             "BLUE")
+        self.service = LEDService(self.leds, service) if service else None
+        self.exporter = pimetrics.MetricsExporter(metrics, metrics_interval) \
+            if metrics else None
+        self.sampler = self._publisher(publish, publish_rate, slave, bus) \
+            if publish else None
 
         # Class assumes that you have associated the user with a NOPASSWD
         # directive.You can run srcipt as another user if you has sudo rights.
@@ -110,25 +643,47 @@ class PiDaemon(object):
                                       'button1 button2')(self.reboot,
                                                          self.shutdown)
 
+        if config:
+            self.buttons = load_buttons(config, self._resolve_action)
+        else:
+            self.buttons = [Button("button1", 5,
+                                   {"press": self.actions.button1}),
+                            Button("button2", 6,
+                                   {"press": self.actions.button2})]
+        map(self._setup_button, self.buttons)
+        self.engine = ButtonEngine(self.buttons,
+                                   edge_source(source,
+                                               [b.pin for b in self.buttons]),
+                                   self.dispatcher.submit)
         self._run()
 
-    def _setup_button(self, button_no):
+    def _publisher(self, path, rate, slave, bus):
+        """ Sampler of the ADC slave writing to the shared sample bus """
+
+        from pisampler import ADCSampler, SharedSampleRing
+
+        dev, _ = self.leds.i2c_open_file(slave, bus)
+        # A minute of history, 1.3MB of shared memory at 1kHz
+        return ADCSampler(dev, rate,
+                          ring=SharedSampleRing.create(path, int(60 * rate),
+                                                       rate))
+
+    def _resolve_action(self, value):
+        """ Map a configured binding to a callable. Supported bindings are
+        reboot, shutdown or the path of an executable script """
+
+        if value in ["reboot", "shutdown"]:
+            return getattr(self, value)
+        if os.path.isfile(value):
+            return lambda: self.run_script(value)
+        raise ValueError("Action %s is neither a builtin nor a script" %
+                         value)
+
+    def _setup_button(self, button):
         """ Handle the GPIO configuration """
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(button_no, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.add_event_detect(button_no,
-                              GPIO.RISING,
-                              callback=self._button_cb,
-                              bouncetime=300)
-
-    def _setup_led(self):
-        # TODO move GPIO LED setup to external lib or make it skip
-        # setup if pins are already in USE
-        GPIO.setwarnings(False)
-        GPIO.setup(self.colors.red, GPIO.OUT)
-        GPIO.setup(self.colors.green, GPIO.OUT)
-        GPIO.setup(self.colors.blue, GPIO.OUT)
-        GPIO.setwarnings(True)
+        self.GPIO.setup(button.pin, self.GPIO.IN,
+                        pull_up_down=self.GPIO.PUD_DOWN if button.active
+                        else self.GPIO.PUD_UP)
 
     def run_script(self, script_path):
         """ Run an executable script """
@@ -148,44 +703,66 @@ class PiDaemon(object):
         self._blink(self.colors.red)
         self._shell_run("/sbin/shutdown -h 0")
 
-    def _button_cb(self, pin):
-        """ Universal button callback. When triggered it will run the mapped
-        method for event"""
-        # Debounce
-        if GPIO.input(pin):
-            button = self.button_map[pin]
-            action = eval("self.actions.%s" % button)
-            action()
-
     def _run(self):
         """ keep the daemon running"""
 
+        self.engine.start()
+        if self.service:
+            self.service.start()
+        if self.exporter:
+            self.exporter.start()
+        if self.sampler:
+            self.sampler.start()
         try:
             while(True):
                 time.sleep(1)
         except KeyboardInterrupt:
             pass
         finally:
-            GPIO.cleanup()
-
-    def _blink(self, pin):
-        """Blink an LED using PRI.GPIO"""
-
-        for _ in range(3):
-            GPIO.output(pin, GPIO.HIGH)
-            time.sleep(0.4)
-            GPIO.output(pin, GPIO.LOW)
-            time.sleep(0.4)
+            self.engine.stop()
+            if self.service:
+                self.service.stop()
+            self.dispatcher.stop()
+            if self.sampler:
+                self.sampler.stop()
+                self.sampler.ring.close()
+            self.leds.flush()
+            if self.exporter:
+                self.exporter.stop()
+            self.GPIO.cleanup()
+
+    def _blink(self, color):
+        """Blink an LED without blocking the caller"""
+
+        self.leds.notify(color, 3, 0.4)
 
     def _shell_run(self, cmd):
-        """ Execute shell command in detached mdoe."""
+        """ Execute shell command in detached mdoe. The command is killed if
+        it is still running at the deadline of the calling action """
 
         # There is no need to monitor output
         cmd = "%s %s" % (self.base_cmd, cmd)
-        ret, err = Popen([cmd],
-                         stdout=PIPE,
-                         stderr=PIPE,
-                         shell=True).communicate()
+        deadline = self.dispatcher.deadline()
+        start = monotonic()
+        _ACTION_COUNT.inc()
+        with open(os.devnull, "w") as null:
+            proc = Popen([cmd],
+                         stdout=null,
+                         stderr=null,
+                         shell=True,
+                         preexec_fn=os.setsid)
+
+            # Python 2 has no wait timeout, poll for the exit instead
+            while deadline is not None and proc.poll() is None:
+                if monotonic() >= deadline:
+                    # Kill the process group, sudo and the script included
+                    os.killpg(proc.pid, SIGKILL)
+                    ACTIONS_KILLED.inc()
+                    break
+                time.sleep(0.05)
+            ret = proc.wait()
+        _ACTION_RUN_SECONDS.observe(monotonic() - start)
+        return ret
 
 if __name__ == "__main__":
     pass
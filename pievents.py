@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""pievents.py: Event subscriptions on the ADC/PIN sample stream. PIN
+   edges, ADC threshold crossings and rate of change alarms are detected
+   over each block of samples inside the sampling loop and the callbacks
+   run on dispatcher threads"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import threading
+from Queue import Queue, Full
+from collections import namedtuple
+import numpy as np
+import pimetrics
+from piadc import hysteresis, debounce_pin
+
+EVENTS = pimetrics.counter("smartpi_events_total",
+                           "Stream events dispatched", ["kind"])
+EVENTS_DROPPED = pimetrics.counter("smartpi_events_dropped_total",
+                                   "Stream events dropped on a full "
+                                   "queue").labels()
+QUEUE_DEPTH = pimetrics.gauge("smartpi_queue_depth",
+                              "Jobs waiting in a queue", ["queue"])
+
+# kind is rising/falling for pin edges, above/below for thresholds and rate
+# for rate alarms. value is the ADC count, or the rate in counts per second
+Event = namedtuple("Event", ["kind", "t", "adc", "pin", "value"])
+
+
+class Subscription(object):
+    """ Detector of one kind of event. evaluate(ts, adc, pin) is called with
+    every block of samples in order and returns the indices of the samples
+    that raise an event, with their kinds. State is carried between blocks
+    so events are the same however the stream is split. Detectors check
+    with a reduction or two whether the block can raise an event at all
+    first, most blocks of a steady signal cost a few microseconds """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def reset(self):
+        pass
+
+    def evaluate(self, ts, adc, pin):
+        raise NotImplementedError
+
+    def events(self, ts, adc, pin):
+        """ Event tuples of a block """
+
+        idx, kinds = self.evaluate(ts, adc, pin)
+        if not len(idx):
+            return []
+        return [Event(k, t, a, p, a) for k, t, a, p in
+                zip(kinds, ts[idx].tolist(), adc[idx].tolist(),
+                    pin[idx].tolist())]
+
+
+def _changes(state, previous, kinds):
+    """ Indices where a 0/1 state differs from the sample before, the first
+    compared to previous, and the kinds[state] of each """
+
+    before = np.concatenate(([state[0] if previous is None else previous],
+                             state[:-1]))
+    idx = np.flatnonzero(state != before)
+    return idx, [kinds[s] for s in state[idx].tolist()]
+
+
+class PinEdge(Subscription):
+    """ Edges of the PIN bit, rising, falling or both. With debounce > 1
+    the bit is debounced with hysteresis over that many samples first, an
+    edge is then reported on the sample that completes the window """
+
+    KINDS = ("falling", "rising")
+
+    def __init__(self, callback, edge="both", debounce=1):
+        if edge not in ("rising", "falling", "both"):
+            raise ValueError("Edge %s is not supported, select from rising, "
+                             "falling, both" % edge)
+        super(PinEdge, self).__init__(callback)
+        self.edge = edge
+        self.debounce = debounce
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.tail = np.zeros(0, dtype="u1")
+
+    def evaluate(self, ts, adc, pin):
+        x = np.concatenate((self.tail, pin)) if self.debounce > 1 else pin
+        # No edge while every sample in the window agrees with the state
+        if self.state is not None and (x.all() if self.state
+                                       else not x.any()):
+            self.tail = x[max(len(x) - self.debounce + 1, 0):]
+            return [], []
+        if self.debounce > 1:
+            self.tail = x[max(len(x) - self.debounce + 1, 0):]
+            states = debounce_pin(x, self.debounce,
+                                  initial=self.state or 0)
+            # State k belongs to sample k + debounce - 1 of x
+            offset = len(pin) - len(states)
+        else:
+            states = np.asarray(pin, dtype="u1")
+            offset = 0
+        if not len(states):
+            return [], []
+        idx, kinds = _changes(states, self.state, self.KINDS)
+        self.state = int(states[-1])
+        if self.edge != "both":
+            keep = [i for i, k in enumerate(kinds) if k == self.edge]
+            idx, kinds = idx[keep], [kinds[i] for i in keep]
+        return idx + offset, kinds
+
+
+class Threshold(Subscription):
+    """ ADC crossings of a threshold with hysteresis. The state turns above
+    when the count reaches high and below when it falls to low, so noise
+    around a single level does not raise a stream of events. Without an
+    initial state the first sample sets it silently """
+
+    KINDS = ("below", "above")
+
+    def __init__(self, callback, low, high=None, direction="both",
+                 initial=None):
+        if direction not in ("above", "below", "both"):
+            raise ValueError("Direction %s is not supported, select from "
+                             "above, below, both" % direction)
+        super(Threshold, self).__init__(callback)
+        self.low = low
+        self.high = low if high is None else high
+        self.direction = direction
+        self.initial = initial
+        self.reset()
+
+    def reset(self):
+        self.state = self.initial
+
+    def evaluate(self, ts, adc, pin):
+        if not len(adc):
+            return [], []
+        if self.state is not None and (adc.min() > self.low if self.state
+                                       else adc.max() < self.high):
+            return [], []
+        initial = self.state
+        if initial is None:
+            initial = 1 if adc[0] >= self.high else 0
+        states = hysteresis(adc, self.low, self.high, initial)
+        idx, kinds = _changes(states, initial, self.KINDS)
+        self.state = int(states[-1])
+        if self.direction != "both":
+            keep = [i for i, k in enumerate(kinds) if k == self.direction]
+            idx, kinds = idx[keep], [kinds[i] for i in keep]
+        return idx, kinds
+
+
+class RateAlarm(Subscription):
+    """ Alarm on the ADC changing faster than limit counts per second,
+    measured against the sample window seconds earlier. The alarm raises a
+    single event and re-arms once the rate falls under rearm * limit. The
+    event value is the signed rate """
+
+    def __init__(self, callback, limit, window=0.1, rearm=0.5):
+        super(RateAlarm, self).__init__(callback)
+        self.limit = float(limit)
+        self.window = window
+        self.rearm = rearm
+        self.reset()
+
+    def reset(self):
+        self.state = 0
+        self.tail_t = np.zeros(0, dtype="f8")
+        self.tail_adc = np.zeros(0, dtype="f8")
+        self.rates = None
+
+    def evaluate(self, ts, adc, pin):
+        if not len(ts):
+            return [], []
+        tx = np.concatenate((self.tail_t, ts))
+        x = np.concatenate((self.tail_adc, adc))
+        keep = max(np.searchsorted(tx, tx[-1] - self.window, "right") - 1, 0)
+        new = slice(len(self.tail_t), None)
+        self.tail_t, self.tail_adc = tx[keep:], x[keep:]
+        # References are at least window apart, the ADC range over the
+        # window bounds the rate
+        if not self.state and x.max() - x.min() < self.limit * self.window:
+            return [], []
+
+        # Latest sample at least window before each new sample
+        ref = np.searchsorted(tx, tx[new] - self.window, "right") - 1
+        valid = ref >= 0
+        ref = np.maximum(ref, 0)
+        dt = tx[new] - tx[ref]
+        valid &= dt > 0
+        rates = np.zeros(len(ts))
+        rates[valid] = (x[new][valid] - x[ref][valid]) / dt[valid]
+        self.rates = rates
+
+        states = hysteresis(np.abs(rates), self.rearm * self.limit,
+                            self.limit, self.state)
+        previous, self.state = self.state, int(states[-1])
+        idx, kinds = _changes(states, previous, (None, "rate"))
+        rising = [i for i, k in enumerate(kinds) if k]
+        return idx[rising], ["rate"] * len(rising)
+
+    def events(self, ts, adc, pin):
+        idx, kinds = self.evaluate(ts, adc, pin)
+        if not len(idx):
+            return []
+        return [Event("rate", t, a, p, r) for t, a, p, r in
+                zip(ts[idx].tolist(), adc[idx].tolist(), pin[idx].tolist(),
+                    self.rates[idx].tolist())]
+
+
+class EventMonitor(object):
+    """ Evaluates subscriptions over the sample stream and dispatches their
+    callbacks.
+
+    The monitor is a sink for ADCSampler: it is called on the sampling
+    thread with every block of samples, runs each subscription over the
+    whole block as array operations and queues callback(event) for each
+    event raised. Callbacks run on workers dispatcher threads, in order when
+    there is a single worker, so a slow callback never delays sampling.
+    When queue_size events are waiting new events are dropped and counted.
+    Subscriptions can be added and removed while the sampler runs. """
+
+    def __init__(self, workers=1, queue_size=1024):
+        self.subscriptions = ()
+        self.lock = threading.Lock()
+        self.queue = Queue(queue_size)
+        self.sampler = None
+        self.stats = {"batches": 0, "samples": 0, "events": 0,
+                      "dropped": 0, "errors": 0}
+        QUEUE_DEPTH.labels("events").set_function(self.queue.qsize)
+        self.workers = [threading.Thread(target=self._work,
+                                         name="EventWorker%d" % i)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def subscribe(self, subscription):
+        """ Add a Subscription, returns it for unsubscribe """
+
+        # The sampling thread reads the tuple without locking, replace it
+        with self.lock:
+            self.subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions = tuple(s for s in self.subscriptions
+                                       if s is not subscription)
+
+    def on_pin(self, callback, edge="both", debounce=1):
+        """ Call callback(event) on PIN edges, see PinEdge """
+
+        return self.subscribe(PinEdge(callback, edge, debounce))
+
+    def on_threshold(self, callback, low, high=None, direction="both",
+                     initial=None):
+        """ Call callback(event) on ADC threshold crossings, see Threshold """
+
+        return self.subscribe(Threshold(callback, low, high, direction,
+                                        initial))
+
+    def on_rate(self, callback, limit, window=0.1, rearm=0.5):
+        """ Call callback(event) when the ADC changes faster than limit
+        counts per second, see RateAlarm """
+
+        return self.subscribe(RateAlarm(callback, limit, window, rearm))
+
+    def __call__(self, ts, adc, pin):
+        """ Evaluate a block of samples, the ADCSampler sink """
+
+        self.stats["batches"] += 1
+        self.stats["samples"] += len(ts)
+        for sub in self.subscriptions:
+            for event in sub.events(ts, adc, pin):
+                try:
+                    self.queue.put_nowait((sub.callback, event))
+                except Full:
+                    self.stats["dropped"] += 1
+                    EVENTS_DROPPED.inc()
+                    continue
+                self.stats["events"] += 1
+                EVENTS.labels(event.kind).inc()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            callback, event = job
+            try:
+                callback(event)
+            except Exception:
+                self.stats["errors"] += 1
+
+    def attach(self, sampler):
+        """ Evaluate the blocks of a running ADCSampler """
+
+        self.sampler = sampler
+        sampler.add_sink(self)
+        return self
+
+    def stop(self):
+        """ Stop the attached sampler, dispatch the queued events and stop
+        the workers """
+
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler.remove_sink(self)
+            self.sampler = None
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
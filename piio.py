@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""piio.py: Multiplexed I/O engine that drives several ATTINY85 boards,
+   over UART ports and I2C buses, concurrently from a single event loop"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import os
+import pty
+import tty
+import time
+import fcntl
+import heapq
+import select
+import struct
+import threading
+from Queue import Queue
+from itertools import count
+from collections import deque
+from piclock import monotonic
+
+
+class IOTimeout(Exception):
+    __module__ = 'exceptions'
+
+
+class IOFuture(object):
+    """ Result of an asynchronous request, completed by the engine """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc = None
+
+    def _complete(self, result=None, exc=None):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result, self._exc = result, exc
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            cb(self)
+        return True
+
+    def set_result(self, result):
+        """ Complete the future, returns False if it was already done """
+        return self._complete(result=result)
+
+    def set_exception(self, exc):
+        """ Fail the future, returns False if it was already done """
+        return self._complete(exc=exc)
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the result, re-raising the exception of a failed
+        request """
+
+        if not self._event.wait(timeout):
+            raise IOTimeout("Result not available after %ss" % timeout)
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+    def add_done_callback(self, func):
+        """ Call func(future) once the future completes """
+
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+
+class UARTChannel(object):
+    """ ATTINY85 board in UART mode, driven by the event loop.
+
+    Commands are written without waiting for the previous reply, replies
+    are matched to requests in FIFO order. A request that times out keeps
+    its place in the queue for LATE_GRACE seconds, a reply that arrives
+    meanwhile is discarded instead of being handed to the next request.
+    After that its reply is considered lost, so a lost reply does not shift
+    the replies of the requests that follow it. """
+
+    CMDS = {"ADC": "2", "PIN": "1"}
+    LATE_GRACE = 1.0
+
+    def __init__(self, name, port, baud=9600):
+        import serial
+
+        self.name = name
+        self.serial = serial.Serial(port, baud, timeout=0)
+        self.fd = self.serial.fileno()
+        self.pending = deque()
+        # Expired in flight requests -> time their reply is given up on
+        self.expired = {}
+        self.rxbuf = ""
+
+    def submit(self, target, future):
+        try:
+            cmd = self.CMDS[target]
+        except KeyError:
+            future.set_exception(ValueError("UART target %s is not supported"
+                                            % target))
+            return
+        os.write(self.fd, cmd)
+        self.pending.append(future)
+
+    def on_readable(self):
+        """ Parse the available reply lines """
+
+        self.rxbuf += os.read(self.fd, 4096)
+        while "\n" in self.rxbuf:
+            line, self.rxbuf = self.rxbuf.split("\n", 1)
+            future = self._next_pending()
+            if future is None:
+                continue
+            if future in self.expired:
+                # Late reply of a request that timed out
+                del self.expired[future]
+                continue
+            try:
+                future.set_result(int(line.strip()))
+            except ValueError:
+                future.set_exception(IOError("Malformed reply %r from %s"
+                                             % (line, self.name)))
+
+    def _next_pending(self):
+        """ Oldest request still waiting for its reply, expired requests
+        past their grace period are dropped """
+
+        now = monotonic()
+        while self.pending:
+            future = self.pending[0]
+            if future not in self.expired or self.expired[future] > now:
+                return self.pending.popleft()
+            del self.expired[self.pending.popleft()]
+        return None
+
+    def expire(self, future):
+        """ Mark a request that timed out, its reply may still arrive """
+
+        if future in self.pending:
+            self.expired[future] = monotonic() + self.LATE_GRACE
+
+    def fail(self, exc):
+        """ Fail all outstanding requests """
+
+        while self.pending:
+            self.pending.popleft().set_exception(exc)
+        self.expired.clear()
+
+    def close(self):
+        self.fail(IOError("Channel %s closed" % self.name))
+        self.serial.close()
+
+
+class I2CChannel(object):
+    """ ATTINY85 board in I2C mode. i2c-dev transactions can not be polled,
+    they are executed by the worker thread of the bus the slave is on. """
+
+    def __init__(self, name, device):
+        self.name = name
+        self.device = device
+        self.bus = device.bus.bus
+
+    def transact(self, target):
+        if target == "STATE":
+            # Every register of the firmware map in one transaction
+            from piblinker import read_registers
+            return read_registers(self.device)
+        word = struct.unpack(">H", self.device.read(2))[0]
+        if target == "ADC":
+            return word & 0x3FF
+        elif target == "PIN":
+            return word >> 15
+        elif target == "RAW":
+            return word
+        raise ValueError("I2C target %s is not supported" % target)
+
+    def expire(self, future):
+        """ Nothing to clean up, the bus worker skips completed requests """
+        pass
+
+    def close(self):
+        self.device.close()
+
+
+class _BusWorker(object):
+    """ Executes the transactions of one I2C bus in order. Slaves on the same
+    bus share the wire, different buses run in parallel """
+
+    def __init__(self, bus):
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name="I2CBus%d" % bus)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            channel, target, future = job
+            # Skip requests that expired while queued
+            if future.done():
+                continue
+            try:
+                future.set_result(channel.transact(target))
+            except (IOError, OSError, ValueError) as e:
+                future.set_exception(e)
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class IOEngine(object):
+    """ Event loop multiplexing requests to many UART and I2C boards.
+
+    UART ports are polled from the loop thread, I2C transactions are handed
+    to one worker per bus. I2C slaves share one descriptor per bus through
+    an I2CPool, pass PiBlinker.i2c_pool to share it with PiBlinker. The
+    engine only gives back the slave references it took, stopping it leaves
+    the slaves PiBlinker opened in use. Every request returns an IOFuture
+    and fails with IOTimeout if it is not served within its timeout.
+    Methods can be called from any thread. """
+
+    def __init__(self, i2c_pool=None):
+        self.channels = {}
+        self.buses = {}
+        self.i2c_pool = i2c_pool
+        self.fd_map = {}
+        self.poller = select.poll()
+        self.inbox = deque()
+        self.timers = []
+        self.seq = count()
+        self.running = False
+        self.thread = None
+
+        # Self pipe used to wake up the loop when work is posted
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in [self.wake_r, self.wake_w]:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wake_r, select.POLLIN)
+
+    def _call_soon(self, func, *args):
+        """ Run func(*args) on the loop thread """
+
+        self.inbox.append((func, args))
+        try:
+            os.write(self.wake_w, "x")
+        except OSError:
+            # Pipe full, the loop is already due to wake up
+            pass
+
+    def add_uart(self, name, port, baud=9600):
+        """ Register a board connected to a serial port """
+
+        channel = UARTChannel(name, port, baud)
+        self.channels[name] = channel
+        self._call_soon(self._register, channel)
+        return channel
+
+    def add_i2c(self, name, slave, bus=1):
+        """ Register a slave on an I2C bus """
+
+        if self.i2c_pool is None:
+            from piblinker import I2CPool
+            self.i2c_pool = I2CPool()
+        channel = I2CChannel(name, self.i2c_pool.open(bus, slave))
+        if bus not in self.buses:
+            self.buses[bus] = _BusWorker(bus)
+        self.channels[name] = channel
+        return channel
+
+    def _register(self, channel):
+        self.fd_map[channel.fd] = channel
+        self.poller.register(channel.fd, select.POLLIN)
+
+    def request(self, name, target="ADC", timeout=1.0):
+        """ Request a reading from a board, returns an IOFuture """
+
+        future = IOFuture()
+        try:
+            channel = self.channels[name]
+        except KeyError:
+            future.set_exception(KeyError("Device %s does not exist" % name))
+            return future
+        deadline = monotonic() + timeout if timeout else None
+        self._call_soon(self._submit, channel, target, future, deadline)
+        return future
+
+    def request_all(self, target="ADC", timeout=1.0):
+        """ Request a reading from every board, returns {name: IOFuture} """
+
+        return {name: self.request(name, target, timeout)
+                for name in self.channels}
+
+    @staticmethod
+    def gather(futures, timeout=None):
+        """ Wait for a dict of futures, failed requests map to their
+        exception """
+
+        results = {}
+        for name, future in futures.iteritems():
+            try:
+                results[name] = future.result(timeout)
+            except Exception as e:
+                results[name] = e
+        return results
+
+    def _submit(self, channel, target, future, deadline):
+        if deadline is not None:
+            heapq.heappush(self.timers, (deadline, next(self.seq), future,
+                                         channel))
+        if isinstance(channel, I2CChannel):
+            self.buses[channel.bus].queue.put((channel, target, future))
+            return
+        try:
+            channel.submit(target, future)
+        except (IOError, OSError) as e:
+            future.set_exception(e)
+
+    def _expire(self):
+        """ Fail the requests whose deadline has passed, returns the poll
+        timeout in ms until the next deadline """
+
+        now = monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, future, channel = heapq.heappop(self.timers)
+            if future.set_exception(IOTimeout("Request timed out")):
+                channel.expire(future)
+        if not self.timers:
+            return None
+        return max(1, int(1000 * (self.timers[0][0] - now)))
+
+    def _run(self):
+        """ Event loop """
+
+        while self.running:
+            for fd, event in self.poller.poll(self._expire()):
+                if fd == self.wake_r:
+                    try:
+                        while os.read(self.wake_r, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                channel = self.fd_map[fd]
+                try:
+                    if event & (select.POLLERR | select.POLLHUP):
+                        raise IOError("Channel %s hung up" % channel.name)
+                    channel.on_readable()
+                except (IOError, OSError) as e:
+                    self.poller.unregister(fd)
+                    del self.fd_map[fd]
+                    channel.fail(e)
+
+            while self.inbox:
+                func, args = self.inbox.popleft()
+                func(*args)
+
+    def start(self):
+        """ Start the loop thread """
+
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name="IOEngine")
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the loop, close the UART channels and release the I2C
+        slaves the engine opened """
+
+        self.running = False
+        self._call_soon(lambda: None)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        for worker in self.buses.values():
+            worker.stop()
+        for channel in self.channels.values():
+            channel.close()
+        self.channels, self.buses, self.fd_map = {}, {}, {}
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+
+class PtyBoard(object):
+    """ Stand-in for an ATTINY85 in UART mode served on a pseudo terminal.
+
+    The host opens board.port like a serial port. Both the ASCII commands
+    and the binary framed requests of the dual mode firmware are answered.
+    ASCII replies are delayed by latency seconds like the firmware safety
+    delay, and when baud is set every reply is additionally delayed by the
+    time its command and the reply itself spend on the wire. """
+
+    BIN_CMD = 0xA5
+    BIN_SYNC = 0x5A
+
+    def __init__(self, adc=512, pin=0, latency=0.002, baud=None):
+        self.adc = adc
+        self.pin = pin
+        self.latency = latency
+        self.baud = baud
+        self.requests = 0
+        self.command = None
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="PtyBoard")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def respond(self, cmd):
+        """ Reply to a single ASCII command byte, None for no reply """
+
+        if cmd == "1":
+            return "%d\r\n" % self.pin
+        elif cmd == "2":
+            return "%d\r\n" % self.adc
+        return None
+
+    def frames(self, seq, count):
+        """ Reply to a binary request with a burst of frames """
+
+        word = (self.adc & 0x3FF) | (0x8000 if self.pin else 0)
+        reply = bytearray()
+        for i in range(min(count, 32)):
+            body = [(seq + i) & 0xFF, word >> 8, word & 0xFF]
+            reply += bytearray([self.BIN_SYNC] + body +
+                               [body[0] ^ body[1] ^ body[2]])
+        return str(reply)
+
+    def _reply(self, byte):
+        """ Feed one received byte, returns (delay, reply) or None """
+
+        if self.command is not None:
+            self.command.append(ord(byte))
+            if len(self.command) < 2:
+                return None
+            seq, count = self.command
+            self.command = None
+            return 0, self.frames(seq, count)
+        if ord(byte) == self.BIN_CMD:
+            self.command = []
+            return None
+        reply = self.respond(byte)
+        return None if reply is None else (self.latency, reply)
+
+    def _run(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            # Time on the wire of the command bytes still being received
+            wire = 0
+            for byte in data:
+                if self.baud:
+                    wire += 10.0 / self.baud
+                reply = self._reply(byte)
+                if reply is None:
+                    continue
+                delay, reply = reply
+                if self.baud:
+                    delay += wire + 10.0 * len(reply) / self.baud
+                    wire = 0
+                if delay:
+                    time.sleep(delay)
+                self.requests += 1
+                os.write(self.master, reply)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
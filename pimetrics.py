@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""pimetrics.py: Counters, gauges and histograms for PiBlinker, CLogger and
+   PiDaemon, exported as a Prometheus text file or as an in process
+   snapshot"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import os
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Latency buckets in seconds, from I2C transfers to shell commands
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _number(value):
+    if value != value:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace("\"", "\\\"")
+
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+class _Value(object):
+    """ One counter or gauge time series. A gauge can be bound to a function
+    that is called when the value is read, i.e the length of a queue """
+
+    def __init__(self):
+        self.value = 0
+        self.fn = None
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def get(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class _HistogramValue(object):
+    """ One histogram time series, observations are counted in the first
+    bucket whose upper bound they do not exceed """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def get(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        acc = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            acc += count
+            cumulative.append((bound, acc))
+        return {"buckets": cumulative, "count": acc, "sum": total}
+
+
+class Metric(object):
+    """ A named metric with a time series per combination of label values.
+    Metrics without labels forward inc, set, observe etc to their only
+    series. Instrumented code resolves labels once and keeps the series, so
+    the hot path is a lock and an addition """
+
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self.series = OrderedDict()
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new(self):
+        return _Value()
+
+    def labels(self, *values):
+        """ Return the series of the given label values """
+
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s takes the labels %s" %
+                             (self.name, ", ".join(self.labelnames)))
+        key = tuple(str(v) for v in values)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = self._new()
+            return series
+
+    def __getattr__(self, attr):
+        # Unlabelled metrics act as their single series
+        if attr.startswith("_") or "_default" not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self._default, attr)
+
+    def items(self):
+        with self.lock:
+            return self.series.items()
+
+    def samples(self):
+        """ (name, label text, value) of every exported sample """
+
+        for key, series in self.items():
+            yield self.name, _labels(self.labelnames, key), series.get()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, doc, labels)
+
+    def _new(self):
+        return _HistogramValue(self.buckets)
+
+    def samples(self):
+        for key, series in self.items():
+            data = series.get()
+            for bound, count in data["buckets"]:
+                yield (self.name + "_bucket",
+                       _labels(self.labelnames, key,
+                               [("le", _number(bound))]), count)
+            yield self.name + "_sum", _labels(self.labelnames, key), \
+                data["sum"]
+            yield self.name + "_count", _labels(self.labelnames, key), \
+                data["count"]
+
+
+class Registry(object):
+    """ Collection of the metrics of the process. Defining a metric that
+    already exists returns the existing one, so modules can be reloaded """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError("Metric %s is already a %s" %
+                                     (metric.name, existing.kind))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format """
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.doc))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, _number(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """ Write the text format to path. The file is replaced atomically
+        so collectors never read a partial file """
+
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as F:
+            F.write(self.render())
+        os.rename(tmp, path)
+
+    def snapshot(self):
+        """ Current values keyed by metric name. Labelled metrics map the
+        comma joined label values to the value, histograms report their
+        count, sum and cumulative buckets """
+
+        snap = {}
+        for metric in self.metrics.values():
+            values = {",".join(key): series.get()
+                      for key, series in metric.items()}
+            snap[metric.name] = values if metric.labelnames \
+                else values.get("")
+        return snap
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+snapshot = REGISTRY.snapshot
+write = REGISTRY.write
+
+
+class MetricsExporter(object):
+    """ Writes the registry to a text file every interval seconds, and once
+    more when stopped. Point the node_exporter textfile collector at a file
+    ending in .prom to have Prometheus scrape it """
+
+    def __init__(self, path, interval=15, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = None
+        self.errors = 0
+
+    def _write(self):
+        try:
+            self.registry.write(self.path)
+        except (IOError, OSError):
+            # Metrics should never take down the application
+            self.errors += 1
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._write()
+
+    def start(self):
+        """ Write the file now and keep it updated on a background thread """
+
+        self._write()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run,
+                                       name="MetricsExporter")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the thread and write the final values """
+
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            self._write()
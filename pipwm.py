@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""pipwm.py: Software PWM for the LED pins. A single scheduler thread
+   drives every channel at a common frequency with its own duty cycle"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import os
+import time
+import threading
+from collections import deque
+from piclock import monotonic
+import pimetrics
+
+GPIO_WRITES = pimetrics.counter("smartpi_gpio_writes_total",
+                                "GPIO pin levels written").labels()
+
+
+class SoftPWM(object):
+    """ Software PWM over a GPIO backend write_many function.
+
+    Every period starts by raising the channels with a non zero duty, and each
+    channel is lowered duty * period after the rising edge. Channels that share
+    an edge time are written in one batch and levels that do not change are not
+    written. Edges are scheduled on an absolute time grid, the lateness of
+    every edge is recorded as jitter. When the thread falls more than a period
+    behind the missed periods are skipped and counted as overruns. Sleeping
+    stops spin seconds before each edge and the rest is busy waited, trading
+    CPU time for lower jitter. Duty changes can fade linearly over a number of
+    seconds. """
+
+    def __init__(self, write_many, pins, frequency=100, spin=0.0,
+                 history=4096):
+        self.write_many = write_many
+        self.pins = list(pins)
+        self.frequency = float(frequency)
+        self.spin = spin
+        self.duty = {p: 0.0 for p in self.pins}
+        self.fades = {}
+        self.levels = {}
+        self.lock = threading.Lock()
+        self.jitter = deque(maxlen=history)
+        self.stats = {"periods": 0, "edges": 0, "writes": 0, "overruns": 0}
+        self.running = False
+        self.thread = None
+        self.started = None
+        self.ended = None
+        self.slept = 0.0
+        self.cpu = self.cpu_used = 0.0
+
+    def set_duty(self, duties, fade=0):
+        """ Set the duty cycle (0 to 1) of the pins in duties, reaching the
+        new value linearly over fade seconds """
+
+        now = monotonic()
+        with self.lock:
+            for pin, duty in duties.iteritems():
+                duty = min(max(float(duty), 0.0), 1.0)
+                if fade > 0:
+                    self.fades[pin] = (now, fade, self.duty[pin], duty)
+                else:
+                    self.fades.pop(pin, None)
+                    self.duty[pin] = duty
+
+    def _advance(self, now):
+        """ Move the fading channels to their value at time now """
+
+        for pin, (t0, length, start, end) in self.fades.items():
+            progress = min((now - t0) / length, 1.0)
+            self.duty[pin] = start + (end - start) * progress
+            if progress >= 1.0:
+                del self.fades[pin]
+        return dict(self.duty)
+
+    def _events(self, duty, period):
+        """ Edges of one period as a sorted list of (offset, {pin: level}) """
+
+        edges = {0.0: {p: 1 if d > 0 else 0 for p, d in duty.iteritems()}}
+        for pin, d in duty.iteritems():
+            if 0 < d < 1:
+                edges.setdefault(d * period, {})[pin] = 0
+        return sorted(edges.iteritems())
+
+    def _wait(self, t):
+        """ Sleep, then spin, until monotonic time t """
+
+        now = monotonic()
+        delay = t - now - self.spin
+        if delay > 0:
+            time.sleep(delay)
+            self.slept += monotonic() - now
+        while monotonic() < t:
+            pass
+
+    def _run(self):
+        period = 1 / self.frequency
+        start = self.started = monotonic()
+        self.ended = None
+        self.cpu = sum(os.times()[:2])
+        while self.running:
+            with self.lock:
+                duty = self._advance(start)
+            base = start
+            for offset, values in self._events(duty, period):
+                t = base + offset
+                self._wait(t)
+                now = monotonic()
+                self.jitter.append(now - t)
+                # Pulse widths count from the actual rising edge
+                if not offset:
+                    base = now
+                changed = {p: v for p, v in values.iteritems()
+                           if self.levels.get(p) != v}
+                self.stats["edges"] += 1
+                if changed:
+                    self.write_many(changed)
+                    GPIO_WRITES.inc(len(changed))
+                    self.levels.update(changed)
+                    self.stats["writes"] += 1
+            self.stats["periods"] += 1
+            start += period
+            behind = monotonic() - start
+            if behind > period:
+                missed = int(behind / period)
+                self.stats["overruns"] += missed
+                start += missed * period
+
+    def start(self):
+        """ Start the scheduler thread """
+
+        if self.running:
+            return self
+        self.running = True
+        self.slept = 0.0
+        self.thread = threading.Thread(target=self._run, name="SoftPWM")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the scheduler thread, the pins keep their last level """
+
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+            self.ended = monotonic()
+            self.cpu_used = sum(os.times()[:2]) - self.cpu
+
+    def report(self):
+        """ Jitter in microseconds and the load of the scheduler. cpu is the
+        share of one core the whole process used while the scheduler ran,
+        busy the share of time the scheduler thread was not sleeping """
+
+        stats = dict(self.stats)
+        if not self.started:
+            return stats
+        elapsed = (self.ended or monotonic()) - self.started
+        jitter = sorted(self.jitter)
+        if jitter:
+            stats.update({"jitter_mean_us": 1e6 * sum(jitter) / len(jitter),
+                          "jitter_p99_us":
+                          1e6 * jitter[int(len(jitter) * 0.99)],
+                          "jitter_max_us": 1e6 * jitter[-1]})
+        cpu = self.cpu_used if self.ended else sum(os.times()[:2]) - self.cpu
+        stats["cpu"] = cpu / elapsed
+        stats["busy"] = max(elapsed - self.slept, 0.0) / elapsed
+        return stats
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""pisampler.py: Streaming sampler for the ATTINY85 ADC slave. Readings are
+   taken at a fixed rate and stored in a preallocated NumPy ring buffer,
+   which can live in shared memory to serve other processes"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import os
+import time
+import mmap
+import errno
+import threading
+import numpy as np
+from piclock import monotonic
+
+# Layout of a stored sample
+SAMPLE_DTYPE = np.dtype([("t", "f8"), ("adc", "u2"), ("pin", "u1")])
+
+# Shared sample ring published by the daemon
+SAMPLE_BUS_PATH = "/dev/shm/piblinker_adc"
+BUS_MAGIC = "PIBUS001"
+# seq is odd while the publisher is writing, count as in SampleRing
+BUS_HEADER = np.dtype([("magic", "S8"), ("seq", "<u8"), ("count", "<u8"),
+                       ("capacity", "<u8"), ("rate", "<f8"), ("pid", "<u4"),
+                       ("reserved", "V20")])
+
+
+class SampleBusError(Exception):
+    __module__ = 'exceptions'
+
+
+def demux(words, adc=None, pin=None):
+    """ Vectorized version of PiBlinker.demux, splits an array of muxed
+    words to the 10bit ADC values and the pin state. Results are written
+    to the adc/pin arrays if provided """
+
+    adc = np.bitwise_and(words, 0x3FF, out=adc)
+    pin = np.right_shift(words, 15, out=pin)
+    return adc, pin
+
+
+class SampleRing(object):
+    """ Fixed size ring buffer of (timestamp, adc, pin) samples.
+
+    Every sample is stored twice, capacity slots apart, so the most recent
+    n samples always occupy a contiguous region and can be returned as a
+    view without copying. Views are live, a consumer that needs a stable
+    copy while the sampler is running should copy the window or compare
+    count before and after reading it. """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=SAMPLE_DTYPE)
+        # Total number of samples pushed since creation
+        self.count = 0
+
+    def _store(self, start, ts, adc, pin):
+        end = start + len(ts)
+        self.data["t"][start:end] = ts
+        self.data["adc"][start:end] = adc
+        self.data["pin"][start:end] = pin
+
+    def push(self, ts, adc, pin):
+        """ Append a block of samples """
+
+        n = len(ts)
+        if n > self.capacity:
+            ts, adc, pin = ts[-self.capacity:], adc[-self.capacity:],\
+                pin[-self.capacity:]
+            self.count += n - self.capacity
+            n = self.capacity
+
+        idx = self.count % self.capacity
+        first = min(n, self.capacity - idx)
+        self._store(idx, ts, adc, pin)
+        # Mirror copy, wrapping around the end of the storage
+        self._store(idx + self.capacity, ts[:first], adc[:first], pin[:first])
+        self._store(0, ts[first:], adc[first:], pin[first:])
+        self.count += n
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def window(self, n=None):
+        """ Return a view of the latest n samples, oldest first """
+
+        n = len(self) if n is None else min(n, len(self))
+        end = self.count % self.capacity + self.capacity
+        return self.data[end - n:end]
+
+    def window_since(self, t0):
+        """ Return a view of the samples taken at or after monotonic time
+        t0 """
+
+        win = self.window()
+        return win[np.searchsorted(win["t"], t0):]
+
+    def latest(self):
+        """ Return the latest (timestamp, adc, pin) sample or None """
+
+        if not self.count:
+            return None
+        return self.window(1)[0]
+
+
+class SharedSampleRing(SampleRing):
+    """ SampleRing in a memory mapped file, written by one publisher process
+    and read by any number of processes without system calls.
+
+    The file holds a header followed by the mirrored sample storage of
+    SampleRing. The publisher makes the header sequence number odd before
+    it stores a block and even again after updating count, readers retry
+    when the sequence is odd or changed while they read count or a sample.
+    Windows are views of the mapping: the samples of a window of n taken at
+    count c are intact until the publisher reaches c + capacity - n, which
+    intact() checks. Readers map the file read only.
+
+    Python has no memory barriers, the ordering relies on the publisher
+    storing the sequence, the samples and count in separate NumPy calls.
+
+    A reader spins SPINS times on an update in progress, then backs off
+    with short sleeps and raises SampleBusError once stall_timeout seconds
+    pass, so a publisher killed in the middle of an update does not hang
+    its readers. """
+
+    SPINS = 100
+    stall_timeout = 0.5
+
+    def __init__(self, path, mm, writable):
+        self.path = path
+        self.mm = mm
+        self.writable = writable
+        self.header = np.frombuffer(mm, BUS_HEADER, 1)
+        if self.header["magic"][0] != BUS_MAGIC:
+            raise ValueError("%s is not a sample bus" % path)
+        self.seq = self.header["seq"]
+        self.counter = self.header["count"]
+        self.capacity = int(self.header["capacity"][0])
+        self.data = np.frombuffer(mm, SAMPLE_DTYPE, 2 * self.capacity,
+                                  BUS_HEADER.itemsize)
+
+    @classmethod
+    def create(cls, path=SAMPLE_BUS_PATH, capacity=65536, rate=0.0):
+        """ Create the bus as its publisher. The file is built under a
+        temporary name and renamed, readers never see it half written """
+
+        size = BUS_HEADER.itemsize + 2 * capacity * SAMPLE_DTYPE.itemsize
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        header = np.frombuffer(mm, BUS_HEADER, 1)
+        header["capacity"] = capacity
+        header["rate"] = rate
+        header["pid"] = os.getpid()
+        header["magic"] = BUS_MAGIC
+        os.rename(tmp, path)
+        return cls(path, mm, True)
+
+    @classmethod
+    def open(cls, path=SAMPLE_BUS_PATH):
+        """ Map an existing bus read only """
+
+        with open(path, "rb") as F:
+            mm = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(path, mm, False)
+
+    def _consistent(self, read):
+        """ Return read() taken while no update was in progress """
+
+        spins, delay, deadline = 0, 0.00001, None
+        while True:
+            seq = int(self.seq[0])
+            if not seq & 1:
+                value = read()
+                if int(self.seq[0]) == seq:
+                    return value
+            spins += 1
+            if spins < self.SPINS:
+                continue
+            now = monotonic()
+            if deadline is None:
+                deadline = now + self.stall_timeout
+            elif now >= deadline:
+                raise SampleBusError(
+                    "Sample bus %s is stuck in an update, publisher %d is %s"
+                    % (self.path, self.publisher(),
+                       "running" if self.publisher_alive() else "gone"))
+            time.sleep(delay)
+            delay = min(2 * delay, 0.001)
+
+    def publisher(self):
+        """ Process id of the publisher """
+
+        return int(self.header["pid"][0])
+
+    def publisher_alive(self):
+        try:
+            os.kill(self.publisher(), 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def _read_count(self):
+        return int(self.counter[0])
+
+    @property
+    def count(self):
+        if self.writable:
+            return int(self.counter[0])
+        return self._consistent(self._read_count)
+
+    @count.setter
+    def count(self, value):
+        self.counter[0] = value
+
+    def push(self, ts, adc, pin):
+        """ Publish a block of samples """
+
+        self.seq[0] += 1
+        try:
+            SampleRing.push(self, ts, adc, pin)
+        finally:
+            self.seq[0] += 1
+
+    def window(self, n=None):
+        count = self.count
+        n = min(count, self.capacity) if n is None else \
+            min(n, count, self.capacity)
+        self.taken = (count, n)
+        end = count % self.capacity + self.capacity
+        return self.data[end - n:end]
+
+    def intact(self):
+        """ True if the samples of the last window are not overwritten yet """
+
+        count, n = self.taken
+        return self.count - count <= self.capacity - n
+
+    def latest(self):
+        """ Return a copy of the latest (timestamp, adc, pin) sample, or None
+        before the first sample """
+
+        return self._consistent(self._read_latest)
+
+    def _read_latest(self):
+        count = int(self.counter[0])
+        if count:
+            return tuple(self.data[count % self.capacity + self.capacity - 1])
+
+    def rate(self):
+        """ Sample rate the publisher was configured with """
+
+        return float(self.header["rate"][0])
+
+    def close(self):
+        """ Release the bus, the publisher also removes the file """
+
+        # Windows handed out keep the mapping alive until they are dropped
+        self.header = self.seq = self.counter = self.data = self.mm = None
+        if self.writable and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ADCSampler(object):
+    """ Samples a muxed ADC/PIN source at a fixed rate on a background thread.
+
+    The source is any object with a readinto method that fills a 2 byte
+    buffer with one big endian muxed word, such as the read channel
+    returned by PiBlinker.i2c_open_file. Sample times are scheduled on an
+    absolute grid so sleep jitter does not accumulate into drift. When the
+    sampler falls behind by more than max_lag periods the missed slots are
+    skipped and counted as overruns. Samples are collected in a
+    preallocated block and demuxed per block into the ring buffer, pass a
+    SharedSampleRing as ring to publish them to other processes. Every
+    block is also handed to sink(ts, adc, pin) if given and to the sinks
+    added with add_sink, the arrays are reused for the next block. """
+
+    def __init__(self, source, rate=1000, capacity=65536, block=64,
+                 max_lag=8, ring=None, sink=None):
+        self.source = source
+        self.sinks = (sink,) if sink else ()
+        self.rate = float(rate)
+        self.block = block
+        self.max_lag = max_lag
+        self.ring = SampleRing(capacity) if ring is None else ring
+
+        # Preallocated block buffers, the raw bytes are read in place
+        self.raw = bytearray(2 * block)
+        self.slots = [memoryview(self.raw)[2 * i:2 * i + 2]
+                      for i in range(block)]
+        self.words = np.frombuffer(self.raw, dtype=">u2")
+        self.ts = np.zeros(block, dtype="f8")
+        self.adc = np.zeros(block, dtype="u2")
+        self.pin = np.zeros(block, dtype="u1")
+
+        self.stats = {"samples": 0, "overruns": 0, "errors": 0}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """ Start the sampling thread """
+
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="ADCSampler")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the sampling thread, the ring buffer remains readable """
+
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def add_sink(self, sink):
+        """ Hand every following block to sink(ts, adc, pin) as well """
+
+        # Replaced rather than modified, the sampling thread reads it as is
+        self.sinks += (sink,)
+
+    def remove_sink(self, sink):
+        self.sinks = tuple(s for s in self.sinks if s is not sink)
+
+    def _flush(self, n):
+        if not n:
+            return
+        words = self.words[:n]
+        demux(words, self.adc[:n], self.pin[:n])
+        self.ring.push(self.ts[:n], self.adc[:n], self.pin[:n])
+        for sink in self.sinks:
+            sink(self.ts[:n], self.adc[:n], self.pin[:n])
+        self.stats["samples"] += n
+
+    def _run(self):
+        """ Sampling loop """
+
+        period = 1.0 / self.rate
+        next_t = monotonic()
+        i = 0
+        try:
+            while self.running:
+                delay = next_t - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > period * self.max_lag:
+                    missed = int(-delay / period)
+                    self.stats["overruns"] += missed
+                    next_t += missed * period
+                next_t += period
+
+                self.ts[i] = monotonic()
+                try:
+                    self.source.readinto(self.slots[i])
+                except IOError:
+                    self.stats["errors"] += 1
+                    continue
+                i += 1
+                if i == self.block:
+                    self._flush(i)
+                    i = 0
+        finally:
+            self._flush(i)
+
+    def achieved_rate(self):
+        """ Sample rate measured over the ring buffer contents """
+
+        win = self.ring.window()
+        if len(win) < 2:
+            return 0.0
+        return (len(win) - 1) / (win["t"][-1] - win["t"][0])
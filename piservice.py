@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""piservice.py: LED and log service. A single process owns the LED pins
+   and serves set_led, blink, led_bcast and log requests from any number of
+   clients over a Unix domain socket"""
+
+__author__ = "minos197@gmail.com"
+__license__ = "LGPL"
+__version__ = "0.0.1"
+__email__ = "Minos Galanakis"
+__project__ = "smartpi"
+__date__ = "18-10-2026"
+
+import os
+import errno
+import socket
+import select
+import struct
+import threading
+from Queue import Queue, Full
+import pimetrics
+from colorlogger import CLogger
+
+SERVICE_PATH = "/tmp/piblinker.sock"
+
+# Every request is a header followed by len bytes of payload
+HEADER = struct.Struct(">BH")
+OP_SET_LED, OP_BLINK, OP_BCAST, OP_LOG, OP_PING = range(1, 6)
+
+# Payload layouts
+SET_LED = struct.Struct(">BB")      # led, mode
+BLINK = struct.Struct(">BBH")       # led, times, period in ms
+LOG = struct.Struct(">B")           # level, followed by the message text
+PONG = struct.Struct(">II")         # commands, errors
+
+LEDS = ["RED", "GREEN", "BLUE", "PURPLE", "YELLOW", "CYAN", "WHITE"]
+MODES = {"OFF": 0, "ON": 1, "Toggle": 2}
+LEVELS = ["error", "warning", "info", "debug"]
+
+REQUESTS = pimetrics.counter("smartpi_service_requests_total",
+                             "LED service requests by outcome", ["outcome"])
+QUEUE_DEPTH = pimetrics.gauge("smartpi_queue_depth",
+                              "Jobs waiting in a queue", ["queue"])
+_HANDLED, _FAILED = REQUESTS.labels("handled"), REQUESTS.labels("failed")
+
+
+class ServiceError(Exception):
+    __module__ = 'exceptions'
+
+
+class LEDService(object):
+    """ Serves LED and log requests for a PiBlinker set up in this process.
+
+    Clients pipeline requests without waiting for replies. set_led is
+    applied as soon as it is read, blink and log notifications go through
+    the notification mode of the blinker, so an async blinker keeps slow
+    patterns from stalling the socket. Broadcasts take seconds and are
+    played one at a time on a thread of their own. Only ping is answered,
+    after every request the client sent before it has been handled.
+    Replies are written without blocking from a per client output buffer,
+    a client that stops reading is dropped once max_output bytes wait. """
+
+    def __init__(self, blinker, path=SERVICE_PATH, mode=0660, backlog=8,
+                 max_output=65536):
+        self.blinker = blinker
+        self.path = path
+        self.max_output = max_output
+        # bcast_errors is only updated by the broadcast player thread
+        self.stats = {"clients": 0, "commands": 0, "errors": 0, "bytes": 0,
+                      "bcast_errors": 0}
+        self.handlers = {OP_SET_LED: self._set_led,
+                         OP_BLINK: self._blink,
+                         OP_BCAST: self._bcast,
+                         OP_LOG: self._log}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, mode)
+        self.listener.listen(backlog)
+
+        self.clients = {}
+        self.outbufs = {}
+        self.bcasts = Queue(2)
+        QUEUE_DEPTH.labels("bcast").set_function(self.bcasts.qsize)
+        self.running = False
+        self.thread = None
+        self.bcast_thread = None
+
+    def start(self):
+        """ Serve requests on a background thread """
+
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="LEDService")
+        self.thread.daemon = True
+        self.thread.start()
+        self.bcast_thread = threading.Thread(target=self._play_bcasts,
+                                             name="LEDServiceBcast")
+        self.bcast_thread.daemon = True
+        self.bcast_thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving, close the clients and remove the socket """
+
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.bcast_thread:
+            self.bcasts.put(None)
+            self.bcast_thread.join()
+            self.bcast_thread = None
+        for conn in self.clients.keys():
+            conn.close()
+        self.clients.clear()
+        self.outbufs.clear()
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def serve(self):
+        """ Accept clients and handle their requests until stop() """
+
+        while self.running:
+            waiting = [c for c, out in self.outbufs.iteritems() if out]
+            ready, writable, _ = select.select(
+                [self.listener] + self.clients.keys(), waiting, [], 0.5)
+            for sock in writable:
+                if sock in self.clients and not self._flush(sock):
+                    self._drop(sock)
+            for sock in ready:
+                if sock is self.listener:
+                    conn, _ = self.listener.accept()
+                    conn.setblocking(0)
+                    self.clients[conn] = bytearray()
+                    self.outbufs[conn] = bytearray()
+                    self.stats["clients"] += 1
+                    continue
+                if sock not in self.clients:
+                    continue
+                try:
+                    data = sock.recv(65536)
+                    if data:
+                        self.stats["bytes"] += len(data)
+                        buf = self.clients[sock]
+                        buf.extend(data)
+                        del buf[:self._handle(sock, buf)]
+                        if self._flush(sock):
+                            continue
+                except socket.error:
+                    pass
+                self._drop(sock)
+
+    def _flush(self, sock):
+        """ Write what the socket takes of the client's pending replies.
+        Returns False if the client has to be dropped """
+
+        out = self.outbufs[sock]
+        if out:
+            try:
+                del out[:sock.send(out)]
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+        return len(out) <= self.max_output
+
+    def _drop(self, sock):
+        del self.clients[sock]
+        del self.outbufs[sock]
+        sock.close()
+
+    def _handle(self, sock, buf):
+        """ Execute the complete requests in buf, returns the bytes used """
+
+        pos = 0
+        while len(buf) - pos >= HEADER.size:
+            op, size = HEADER.unpack_from(buf, pos)
+            end = pos + HEADER.size + size
+            if end > len(buf):
+                break
+            payload = str(buf[pos + HEADER.size:end])
+            pos = end
+            if op == OP_PING:
+                self.outbufs[sock].extend(
+                    HEADER.pack(OP_PING, PONG.size) +
+                    PONG.pack(self.stats["commands"], self.stats["errors"]))
+                continue
+            try:
+                self.handlers[op](payload)
+                self.stats["commands"] += 1
+                _HANDLED.inc()
+            except Exception as e:
+                self.stats["errors"] += 1
+                _FAILED.inc()
+                CLogger.error("LED service request op %d failed: %r", op, e)
+        return pos
+
+    def _set_led(self, payload):
+        led, mode = SET_LED.unpack(payload)
+        self.blinker.set_led(LEDS[led], -1 if mode == 2 else mode)
+
+    def _blink(self, payload):
+        led, times, period = BLINK.unpack(payload)
+        self.blinker.notify(LEDS[led], times, period / 1000.0)
+
+    def _bcast(self, payload):
+        try:
+            self.bcasts.put_nowait(payload)
+        except Full:
+            self.stats["errors"] += 1
+            _FAILED.inc()
+
+    def _log(self, payload):
+        level, = LOG.unpack_from(payload)
+        getattr(self.blinker, LEVELS[level])("%s", payload[LOG.size:])
+
+    def _play_bcasts(self):
+        while True:
+            data = self.bcasts.get()
+            if data is None:
+                return
+            try:
+                self.blinker.led_bcast(data)
+            except Exception as e:
+                self.stats["bcast_errors"] += 1
+                _FAILED.inc()
+                CLogger.error("LED service broadcast of %r failed: %r",
+                              data, e)
+
+
+class LEDClient(object):
+    """ Client of the LED service. The connection is opened once and
+    requests are written without waiting for a reply, sync() waits until
+    the service has handled everything sent before it. Replies to pings of
+    a sync that timed out are consumed by the next sync, which waits for
+    the reply to its own ping. """
+
+    def __init__(self, path=SERVICE_PATH):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except socket.error as e:
+            self.sock.close()
+            raise ServiceError("LED service %s is not reachable: %s"
+                               % (path, e))
+        self.sent = 0
+        # Pings not answered yet and the bytes of a partial reply
+        self.pings = 0
+        self.rxbuf = bytearray()
+
+    def _send(self, op, payload=""):
+        self.sock.sendall(HEADER.pack(op, len(payload)) + payload)
+        self.sent += 1
+
+    def set_led(self, led, mode):
+        """ Set an LED to ON, OFF, Toggle or 1, 0, -1 """
+
+        if led not in LEDS:
+            return
+        if mode not in MODES and mode not in [1, 0, -1]:
+            raise ServiceError("Mode %s is not recognised" % mode)
+        md = MODES[mode] if mode in MODES else (2 if mode < 0 else mode)
+        self._send(OP_SET_LED, SET_LED.pack(LEDS.index(led), md))
+
+    def blink(self, led, times, period):
+        """ Blink an LED times times with a period given in seconds """
+
+        led = led.upper()
+        if led not in LEDS:
+            return
+        self._send(OP_BLINK, BLINK.pack(LEDS.index(led), min(times, 255),
+                                        int(period * 1000) & 0xFFFF))
+
+    def bcast(self, data):
+        """ Broadcast a number through the LEDs """
+
+        self._send(OP_BCAST, data[:0xFFFF])
+
+    def log(self, level, message):
+        """ Log a message on the service at one of the LEVELS """
+
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        self._send(OP_LOG, LOG.pack(LEVELS.index(level)) +
+                   message[:0xFFFF - LOG.size])
+
+    def sync(self, timeout=None):
+        """ Wait until the service has handled all the requests sent so far.
+        Returns the (commands, errors) counters of the service, or None if
+        the timeout expired first """
+
+        self._send(OP_PING)
+        self.pings += 1
+        size = HEADER.size + PONG.size
+        self.sock.settimeout(timeout)
+        try:
+            # Replies come in order, the last one answers this ping
+            while True:
+                while len(self.rxbuf) >= size:
+                    reply = PONG.unpack_from(self.rxbuf, HEADER.size)
+                    del self.rxbuf[:size]
+                    self.pings -= 1
+                    if not self.pings:
+                        return reply
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ServiceError("LED service closed the connection")
+                self.rxbuf.extend(data)
+        except socket.timeout:
+            return None
+        finally:
+            self.sock.settimeout(None)
+
+    def close(self):
+        self.sock.close()